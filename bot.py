@@ -22,7 +22,7 @@ Telegram Numbers Shop Bot + Session Manager
 - ✅ УПРАВЛЕНИЕ КАНАЛАМИ В АДМИНКЕ
 - ✅ АДМИНЫ ИМЕЮТ БЕСКОНЕЧНЫЙ БАЛАНС (♾)
 - ✅ УДАЛЕНИЕ СЕССИЙ И НОМЕРОВ
-- ✅ СЕССИИ СОХРАНЯЮТСЯ В ФАЙЛЫ
+- ✅ СЕССИИ СОХРАНЯЮТСЯ В БД (ЗАШИФРОВАНЫ)
 - ✅ ПАРАЛЛЕЛЬНАЯ РАБОТА ВЕБ-СЕРВЕРА И БОТА (ИСПРАВЛЕНО)
 - ✅ СИСТЕМА "ВЕЧНОЙ РАБОТЫ" (НЕ ВЫКЛЮЧАЕТСЯ)
 - ✅ АВТОМАТИЧЕСКИЙ ПЕРЕЗАПУСК ПРИ СБОЯХ
@@ -41,12 +41,17 @@ import sys
 import asyncio
 import logging
 import json
+import re
+import struct
+import hashlib
+import heapq
+import bisect
 import time
 import sqlite3
 import random
 import string
 import uuid
-import shutil
+import base64
 import signal
 import traceback
 import threading
@@ -55,9 +60,13 @@ import socket  # Для дополнительной проверки порта
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Optional, Dict, Any, List, Tuple
-from contextlib import contextmanager
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar, copy_context
+from types import MappingProxyType
 from urllib.parse import urlencode
-from functools import wraps
+from functools import wraps, partial
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, defaultdict
 
 # Дополнительные импорты
 import requests
@@ -66,7 +75,7 @@ import certifi
 import psutil
 from dotenv import load_dotenv
 import pytz
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
 from Crypto.Cipher import AES
 
 # Для PostgreSQL
@@ -75,8 +84,8 @@ import psycopg2.extras
 
 # ИМПОРТЫ AIOGRAM
 from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.middlewares.logging import LoggingMiddleware
 from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.handler import current_handler
 from aiogram.types import ParseMode, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.types import Message, CallbackQuery, ContentType
 from aiogram.utils import executor
@@ -87,7 +96,9 @@ from aiogram.utils.callback_data import CallbackData
 from aiogram.utils.exceptions import Unauthorized, RestartingTelegram, TerminatedByOtherGetUpdates
 
 # Pyrogram для управления сессиями
-from pyrogram import Client
+from pyrogram import Client, filters, raw
+from pyrogram.handlers import MessageHandler
+from pyrogram.storage import FileStorage, Storage
 from pyrogram.errors import (
     SessionPasswordNeeded, 
     PhoneCodeInvalid, 
@@ -135,25 +146,28 @@ sys.stdout.flush()
 # ================= ПРОВЕРКА ПОРТА =================
 
 def check_port_availability():
-    """Проверка доступности порта"""
+    """Проверка доступности порта (вызывается до чтения конфигурации, порт берём из окружения)"""
+    port = int(os.environ.get('PORT', 8080))
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    result = sock.connect_ex(('127.0.0.1', PORT))
+    try:
+        result = sock.connect_ex(('127.0.0.1', port))
+    finally:
+        sock.close()
     if result == 0:
-        print(f"❌ Порт {PORT} уже занят!")
+        print(f"❌ Порт {port} уже занят!")
         # Пытаемся найти процесс, который занимает порт
         try:
             import psutil
             for conn in psutil.net_connections():
-                if conn.laddr.port == PORT:
+                if conn.laddr.port == port:
                     print(f"   Процесс: PID={conn.pid}, имя={psutil.Process(conn.pid).name()}")
                     break
         except:
             pass
         return False
     else:
-        print(f"✅ Порт {PORT} свободен")
+        print(f"✅ Порт {port} свободен")
         return True
-    sock.close()
 
 # ================= ПРОВЕРКА НА УНИКАЛЬНОСТЬ ЗАПУСКА =================
 
@@ -280,6 +294,18 @@ if not BOT_TOKEN:
     logger.error("💡 Добавьте BOT_TOKEN в настройках Render (Environment Variables)")
     sys.exit(1)
 
+# ✅ КЛЮЧ ШИФРОВАНИЯ СЕССИЙ PYROGRAM В БД (Fernet, по умолчанию выводится из BOT_TOKEN)
+SESSION_SECRET = os.environ.get('SESSION_SECRET')
+if not SESSION_SECRET:
+    logger.warning("⚠️ SESSION_SECRET не задан, ключ сессий выводится из BOT_TOKEN (смена токена = потеря сессий)")
+    SESSION_SECRET = base64.urlsafe_b64encode(hashlib.sha256(f"sessions:{BOT_TOKEN}".encode()).digest()).decode()
+try:
+    session_cipher = Fernet(SESSION_SECRET)
+except ValueError:
+    logger.error("❌ КРИТИЧЕСКАЯ ОШИБКА: SESSION_SECRET не является ключом Fernet!")
+    logger.error("💡 Сгенерируйте ключ: python -c \"from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())\"")
+    sys.exit(1)
+
 # ✅ АДМИНЫ (обязательно в переменных окружения)
 ADMIN_IDS_STR = os.environ.get('ADMIN_IDS', '')
 if not ADMIN_IDS_STR:
@@ -288,6 +314,7 @@ if not ADMIN_IDS_STR:
     sys.exit(1)
 
 ADMIN_IDS = [int(id.strip()) for id in ADMIN_IDS_STR.split(',') if id.strip()]
+ADMIN_ID_SET = frozenset(ADMIN_IDS)  # Для проверки is_admin за O(1)
 logger.info(f"👥 Администраторы: {ADMIN_IDS}")
 
 # ✅ ЮMoney (опционально)
@@ -316,6 +343,69 @@ MAX_TOPUP_AMOUNT = 100000
 
 # Настройки кэша
 CACHE_TTL = 60
+CACHE_MAX_SIZE = int(os.environ.get('CACHE_MAX_SIZE', 10000))  # Максимум записей, дальше вытеснение по LRU
+CACHE_TTLS = {  # TTL по пространствам имён (сек)
+    'user': CACHE_TTL,
+    'numbers': CACHE_TTL,
+    'setting': 300,  # Настройки меняются только через set_setting, который сбрасывает кэш
+}
+
+# Проверка подписок на обязательные каналы
+MEMBERSHIP_TTL = int(os.environ.get('MEMBERSHIP_TTL', 300))  # Сколько помнить, что пользователь подписан (сек)
+MEMBERSHIP_NEGATIVE_TTL = int(os.environ.get('MEMBERSHIP_NEGATIVE_TTL', 30))  # Сколько помнить, что не подписан (сек)
+GET_CHAT_MEMBER_RATE = float(os.environ.get('GET_CHAT_MEMBER_RATE', 20))  # Вызовов get_chat_member в секунду
+GET_CHAT_MEMBER_BURST = int(os.environ.get('GET_CHAT_MEMBER_BURST', 30))  # Допустимый всплеск вызовов
+
+# Настройки пула соединений с БД
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))  # Ожидание свободного соединения (сек)
+DB_POOL_MAX_AGE = float(os.environ.get('DB_POOL_MAX_AGE', 1800))  # Максимальный возраст соединения (сек)
+DB_POOL_PING_INTERVAL = float(os.environ.get('DB_POOL_PING_INTERVAL', 30))  # Пинг соединений, простаивавших дольше (сек)
+DB_EXECUTOR_WORKERS = int(os.environ.get('DB_EXECUTOR_WORKERS', DB_POOL_MAX))  # Потоки для запросов из async-кода
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get('ACTIVITY_FLUSH_INTERVAL', 5))  # Сброс last_activity в БД (сек)
+
+# Настройки буферизованной записи логов в БД (session_logs / system_logs)
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', 2))  # Максимальная задержка записи (сек)
+LOG_BATCH_SIZE = int(os.environ.get('LOG_BATCH_SIZE', 500))  # Максимум строк в одном INSERT
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))  # При заполнении очереди писатели ждут
+
+# Настройки SQLite (режим без DATABASE_URL)
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))  # Ожидание блокировки файла (мс)
+SQLITE_CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB', 65536))  # Кэш страниц на соединение (КБ)
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))  # Отображение файла в память (байт)
+
+# Остановка бота (Render даёт ~30 сек между SIGTERM и SIGKILL)
+SHUTDOWN_DEADLINE = float(os.environ.get('SHUTDOWN_DEADLINE', 20))  # Общий бюджет on_shutdown (сек)
+SHUTDOWN_DRAIN_TIMEOUT = 5  # Сколько ждать завершения обрабатываемых апдейтов (сек)
+SHUTDOWN_FLUSH_RESERVE = 5  # Сколько оставить от бюджета на сброс буферов и бекап (сек)
+
+# Пул клиентов Pyrogram (подключения аккаунтов-продавцов)
+CLIENT_POOL_MAX = int(os.environ.get('CLIENT_POOL_MAX', 50))  # Максимум одновременно подключенных клиентов
+CLIENT_CONNECT_CONCURRENCY = int(os.environ.get('CLIENT_CONNECT_CONCURRENCY', 5))  # Одновременных подключений
+CLIENT_IDLE_TIMEOUT = float(os.environ.get('CLIENT_IDLE_TIMEOUT', 600))  # Отключать клиента после простоя (сек)
+CLIENT_WARMUP_ACCOUNTS = min(int(os.environ.get('CLIENT_WARMUP_ACCOUNTS', 10)), CLIENT_POOL_MAX)  # Сколько аккаунтов подключать при старте
+CLIENT_WARMUP_BUDGET = float(os.environ.get('CLIENT_WARMUP_BUDGET', 30))  # Бюджет времени на прогрев (сек)
+CLIENT_REAP_INTERVAL = 60  # Как часто проверять простаивающих клиентов (сек)
+SESSION_SUPERVISE_INTERVAL = 30  # Период проверки подключенных сессий (сек)
+ACCOUNT_PICK_ATTEMPTS = 3  # Сколько аккаунтов пробовать для отправки одного кода
+ACCOUNT_FAILURE_BACKOFF = 60  # Пауза после ошибки аккаунта (сек), удваивается при повторных ошибках
+ACCOUNT_FAILURE_BACKOFF_MAX = 1800  # Максимальная пауза после ошибок (сек)
+SERVICE_NOTIFICATIONS_ID = 777000  # Служебный аккаунт Telegram, присылающий коды входа
+LOGIN_CODE_RE = re.compile(r'(?:code|код)\D{0,40}?(\d(?:-?\d){4,7})', re.IGNORECASE)
+PENDING_LOGIN_TTL = 300  # Сколько ждать код/2FA, прежде чем забыть незавершённый вход (сек)
+SESSION_CHECK_CONCURRENCY = int(os.environ.get('SESSION_CHECK_CONCURRENCY', 10))  # Параллельных проверок авторизации
+
+# Бронь номера на время внешней оплаты
+NUMBER_HOLD_TTL = int(os.environ.get('NUMBER_HOLD_TTL', 15 * 60))  # Сколько номер держится за покупателем (сек)
+NUMBER_HOLD_SWEEP_INTERVAL = 30  # Как часто освобождать просроченные брони (сек)
+
+# Сверка счётчиков статистики с исходными таблицами (сек)
+STATS_RECONCILE_INTERVAL = float(os.environ.get('STATS_RECONCILE_INTERVAL', 3600))
+
+# Трассировка апдейтов
+TRACE_SLOW_THRESHOLD = float(os.environ.get('TRACE_SLOW_THRESHOLD', 1.0))  # Апдейт дольше - полная строка в лог (сек)
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0.01))  # Доля остальных апдейтов, попадающих в лог
 
 # Символ бесконечности для админов
 INFINITY = "♾"
@@ -439,7 +529,15 @@ async def health_check(request):
         'ping': ping_count,
         'uptime': time.time() - start_time if 'start_time' in globals() else 0,
         'memory': psutil.virtual_memory().percent if 'psutil' in globals() else 0,
-        'pid': os.getpid()
+        'pid': os.getpid(),
+        'db_pool': db.get_pool_stats() if 'db' in globals() else {},
+        'cache': db.get_cache_stats() if 'db' in globals() else {},
+        'log_sink': log_sink.get_stats() if 'log_sink' in globals() else {},
+        'clients': session_manager.get_pool_stats() if 'session_manager' in globals() else {},
+        'accounts': session_manager.scheduler.get_stats() if 'session_manager' in globals() else {},
+        'chat_member_limiter': chat_member_limiter.get_stats() if 'chat_member_limiter' in globals() else {},
+        'membership_index': membership_index.get_stats() if 'membership_index' in globals() else {},
+        'tracing': tracing.get_stats() if 'tracing' in globals() else {}
     })
 
 async def payment_webhook(request):
@@ -451,44 +549,10 @@ async def payment_webhook(request):
         if data.get('payload'):
             payment_id = data['payload']
             if data.get('status') == 'paid':
-                if DATABASE_URL:
-                    with db.get_cursor() as cursor:
-                        cursor.execute('SELECT * FROM payments WHERE id = %s', (payment_id,))
-                        payment = cursor.fetchone()
-                        
-                        if payment and payment['status'] == 'pending':
-                            cursor.execute('''
-                                UPDATE payments SET status = 'completed', completed_at = %s WHERE id = %s
-                            ''', (time.time(), payment_id))
-                            
-                            cursor.execute('''
-                                UPDATE users SET stars_balance = stars_balance + %s WHERE user_id = %s
-                            ''', (payment['stars_amount'], payment['user_id']))
-                            
-                            cursor.execute('''
-                                UPDATE transactions SET status = 'completed', completed_at = %s 
-                                WHERE user_id = %s AND number_id = %s
-                            ''', (time.time(), payment['user_id'], payment['number_id']))
-                else:
-                    with db.get_cursor() as cursor:
-                        cursor.execute('SELECT * FROM payments WHERE id = ?', (payment_id,))
-                        payment = cursor.fetchone()
-                        
-                        if payment and payment['status'] == 'pending':
-                            cursor.execute('''
-                                UPDATE payments SET status = 'completed', completed_at = ? WHERE id = ?
-                            ''', (time.time(), payment_id))
-                            
-                            cursor.execute('''
-                                UPDATE users SET stars_balance = stars_balance + ? WHERE user_id = ?
-                            ''', (payment['stars_amount'], payment['user_id']))
-                            
-                            cursor.execute('''
-                                UPDATE transactions SET status = 'completed', completed_at = ? 
-                                WHERE user_id = ? AND number_id = ?
-                            ''', (time.time(), payment['user_id'], payment['number_id']))
+                await adb.complete_webhook_payment(payment_id)
                 
                 logger.info(f"✅ Webhook: платеж {payment_id} завершен")
+                await log_sink.system('INFO', 'payments', f"webhook: платеж {payment_id} завершен")
         
         return web.Response(status=200)
     except Exception as e:
@@ -527,11 +591,224 @@ async def web_server():
     # Просто возвращаемся, веб-сервер продолжает работу в фоне
     return web_runner
 
+# ================= ТРАССИРОВКА АПДЕЙТОВ =================
+
+# Трассировка текущего апдейта: {'started', 'db', 'api', 'handler', ...}; None вне обработки апдейта
+current_trace: ContextVar[Optional[Dict[str, Any]]] = ContextVar('current_trace', default=None)
+
+def count_trace(key: str):
+    """Учёт вызова (db / api) в трассировке текущего апдейта"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace[key] += 1
+
+class LatencyHistogram:
+    """Гистограмма задержек с фиксированными корзинами: запись без хранения выборок,
+    перцентили - по верхней границе корзины"""
+    
+    BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+    
+    def __init__(self):
+        self.buckets = [0] * (len(self.BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def observe(self, seconds: float):
+        ms = seconds * 1000
+        self.buckets[bisect.bisect_left(self.BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+    
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return float(self.BUCKETS_MS[i]) if i < len(self.BUCKETS_MS) else round(self.max, 1)
+        return round(self.max, 1)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total / self.count, 1) if self.count else 0.0,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': round(self.max, 1)
+        }
+
 # ================= ИНИЦИАЛИЗАЦИЯ БОТА =================
+
+class TracedBot(Bot):
+    """Bot, учитывающий вызовы Bot API в трассировке апдейта и запоминающий, когда апдейты получены"""
+    
+    RECEIVED_TTL = 300  # Апдейт, не дошедший до TracingMiddleware за это время, забываем (сек)
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received_at: OrderedDict = OrderedDict()  # update_id -> время получения (monotonic), по порядку получения
+    
+    async def request(self, method, data=None, files=None, **kwargs):
+        count_trace('api')
+        result = await super().request(method, data, files, **kwargs)
+        if method == 'getUpdates' and result:
+            now = time.monotonic()
+            # Апдейты, отброшенные до обработки (отмена, ошибка middleware, остановка), не копятся
+            while self.received_at and next(iter(self.received_at.values())) < now - self.RECEIVED_TTL:
+                self.received_at.popitem(last=False)
+            for update in result:
+                self.received_at[update['update_id']] = now
+        return result
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Трассировка апдейтов: обработчик, ожидание в очереди, время обработки, число запросов к БД и Bot API.
+    Метрики копятся в гистограммах в памяти, в лог попадают только выборка и медленные апдейты"""
+    
+    def __init__(self, traced_bot: TracedBot, slow_threshold: float, sample_rate: float):
+        super().__init__()
+        self.bot = traced_bot
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self.latency: Dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+        self.calls: Dict[str, Dict[str, int]] = defaultdict(lambda: {'db': 0, 'api': 0})
+        self.queue_delay = LatencyHistogram()
+        self.stats = {'updates': 0, 'errors': 0, 'slow': 0, 'sampled': 0}
+    
+    async def trigger(self, action, args):
+        # process_<тип> вызывается, когда для апдейта найден обработчик - запоминаем его имя
+        if action.startswith('process_') and action != 'process_update':
+            trace = current_trace.get()
+            if trace is not None:
+                if action == 'process_error':
+                    trace['error'] = True
+                elif 'handler' not in trace:
+                    handler = current_handler.get(None)
+                    trace['handler'] = getattr(handler, '__name__', action[len('process_'):])
+        return await super().trigger(action, args)
+    
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        now = time.monotonic()
+        received = self.bot.received_at.pop(update.update_id, None)
+        queue_delay = now - received if received is not None else None
+        if queue_delay is not None:
+            self.queue_delay.observe(queue_delay)
+        data['trace_token'] = current_trace.set({
+            'started': now, 'queue_delay': queue_delay, 'db': 0, 'api': 0
+        })
+    
+    async def on_post_process_update(self, update: types.Update, result, data: dict):
+        trace = current_trace.get()
+        token = data.pop('trace_token', None)
+        if trace is None or token is None:
+            return
+        current_trace.reset(token)
+        
+        elapsed = time.monotonic() - trace['started']
+        name = trace.get('handler', 'unhandled')
+        self.latency[name].observe(elapsed)
+        calls = self.calls[name]
+        calls['db'] += trace['db']
+        calls['api'] += trace['api']
+        self.stats['updates'] += 1
+        if trace.get('error'):
+            self.stats['errors'] += 1
+        
+        # Форматирование строки - только для медленных и попавших в выборку апдейтов
+        if elapsed >= self.slow_threshold:
+            self.stats['slow'] += 1
+            logger.warning(f"🐢 Медленный апдейт {update.update_id}: {self._describe(name, elapsed, trace)}")
+        elif random.random() < self.sample_rate:
+            self.stats['sampled'] += 1
+            logger.info(f"🔍 Апдейт {update.update_id}: {self._describe(name, elapsed, trace)}")
+    
+    @staticmethod
+    def _describe(name: str, elapsed: float, trace: Dict[str, Any]) -> str:
+        queue = f"{trace['queue_delay'] * 1000:.0f} мс" if trace['queue_delay'] is not None else "н/д"
+        error = ", ошибка" if trace.get('error') else ""
+        return (f"{name} {elapsed * 1000:.0f} мс (очередь {queue}), "
+                f"БД={trace['db']}, API={trace['api']}{error}")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        handlers = {}
+        for name, histogram in self.latency.items():
+            calls = self.calls[name]
+            handlers[name] = {
+                **histogram.get_stats(),
+                'db_per_update': round(calls['db'] / histogram.count, 2) if histogram.count else 0,
+                'api_per_update': round(calls['api'] / histogram.count, 2) if histogram.count else 0
+            }
+        return {
+            **self.stats,
+            'queue_delay': self.queue_delay.get_stats(),
+            'handlers': handlers
+        }
+
+
 storage = MemoryStorage()
-bot = Bot(token=BOT_TOKEN, parse_mode=ParseMode.HTML)
+bot = TracedBot(token=BOT_TOKEN, parse_mode=ParseMode.HTML)
 dp = Dispatcher(bot, storage=storage)
-dp.middleware.setup(LoggingMiddleware())
+tracing = TracingMiddleware(bot, TRACE_SLOW_THRESHOLD, TRACE_SAMPLE_RATE)
+dp.middleware.setup(tracing)
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Загрузка (или регистрация) пользователя один раз на апдейт.
+    Запись передаётся обработчикам аргументом user, активность отмечается в памяти"""
+    
+    async def _load_user(self, from_user: Optional[types.User], data: dict):
+        if from_user is None or from_user.is_bot:
+            return
+        data['user'] = await adb.get_or_create_user(
+            from_user.id,
+            from_user.username or f"user_{from_user.id}",
+            from_user.first_name or "Пользователь"
+        )
+        db.update_user_activity(from_user.id)
+    
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        await self._load_user(message.from_user, data)
+    
+    async def on_pre_process_callback_query(self, callback: types.CallbackQuery, data: dict):
+        await self._load_user(callback.from_user, data)
+
+
+dp.middleware.setup(UserContextMiddleware())
+
+
+class InFlightMiddleware(BaseMiddleware):
+    """Счётчик обрабатываемых апдейтов - при остановке дожидаемся их завершения.
+    Подключается последним: если предыдущий middleware отменит апдейт, счётчик не увеличится"""
+    
+    def __init__(self):
+        super().__init__()
+        self.in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+    
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        self.in_flight += 1
+        self._idle.clear()
+    
+    async def on_post_process_update(self, update: types.Update, result, data: dict):
+        self.in_flight -= 1
+        if self.in_flight <= 0:
+            self.in_flight = 0
+            self._idle.set()
+    
+    async def drain(self) -> int:
+        """Ожидание завершения всех обрабатываемых апдейтов"""
+        await self._idle.wait()
+        return self.in_flight
+
+
+in_flight = InFlightMiddleware()
+dp.middleware.setup(in_flight)
 
 # Callback data для инлайн кнопок
 numbers_cb = CallbackData('numbers', 'page')
@@ -795,7 +1072,7 @@ def protect_coro(coro):
 
 def is_admin(user_id: int) -> bool:
     """Проверка, является ли пользователь админом"""
-    return user_id in ADMIN_IDS
+    return user_id in ADMIN_ID_SET
 
 def get_user_balance_display(user_id: int, balance: int) -> str:
     """Получение отображения баланса (♾ для админов)"""
@@ -803,20 +1080,388 @@ def get_user_balance_display(user_id: int, balance: int) -> str:
         return INFINITY
     return str(balance)
 
-def can_afford(user_id: int, cost: int) -> bool:
-    """Проверка, может ли пользователь позволить себе покупку"""
-    if is_admin(user_id):
+def can_afford(user: Optional[Dict], cost: int) -> bool:
+    """Проверка, может ли пользователь позволить себе покупку (по уже загруженной записи)"""
+    if not user:
+        return False
+    if is_admin(user['user_id']):
         return True  # Админы могут покупать всё
     
-    user = db.get_user(user_id)
-    return user and user['stars_balance'] >= cost
+    return user['stars_balance'] >= cost
 
 # ================= БАЗА ДАННЫХ =================
 
+class PoolExhausted(Exception):
+    """Исключение при исчерпании пула соединений"""
+    pass
+
+class RollbackTransaction(Exception):
+    """Отказ внутри get_cursor (номер занят, не хватает звёзд): транзакция откатывается без записи ошибки в лог.
+    args[0] - результат, который вернёт вызывающий метод"""
+    pass
+
+class ConnectionPool:
+    """Пул соединений с БД с проверкой здоровья, ограничением возраста и метриками"""
+
+    def __init__(self, connect, min_size: int = 1, max_size: int = 10, timeout: float = 10,
+                 max_age: float = 1800, ping_interval: float = 30, name: str = "db"):
+        self._connect = connect
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.timeout = timeout
+        self.max_age = max_age
+        self.ping_interval = ping_interval
+        self.name = name
+
+        self._cond = threading.Condition()
+        self._idle = []  # [(conn, last_used)] - LIFO, самые свежие соединения сверху
+        self._created_at = {}  # id(conn) -> время создания
+        self._size = 0
+        self._closed = False
+
+        self.stats = {
+            'created': 0,
+            'closed': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'health_failures': 0,
+            'max_in_use': 0
+        }
+
+        for _ in range(self.min_size):
+            try:
+                conn = self._open()
+                self._idle.append((conn, time.monotonic()))
+                self._size += 1
+            except Exception as e:
+                logger.error(f"❌ Пул {self.name}: не удалось открыть соединение: {e}")
+                break
+
+    def _open(self):
+        """Открытие соединения (само подключение - вне блокировки, учёт - под ней)"""
+        conn = self._connect()
+        with self._cond:
+            self._created_at[id(conn)] = time.monotonic()
+            self.stats['created'] += 1
+        return conn
+
+    def _close(self, conn):
+        with self._cond:
+            self._created_at.pop(id(conn), None)
+            self.stats['closed'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_expired(self, conn) -> bool:
+        with self._cond:
+            created_at = self._created_at.get(id(conn), 0)
+        return time.monotonic() - created_at > self.max_age
+
+    @staticmethod
+    def is_broken(conn) -> bool:
+        """Проверка, что соединение закрыто (psycopg2 выставляет conn.closed)"""
+        return bool(getattr(conn, 'closed', 0))
+
+    def _is_healthy(self, conn, last_used: float) -> bool:
+        """Проверка соединения при выдаче из пула"""
+        if self.is_broken(conn) or self._is_expired(conn):
+            return False
+
+        # Пингуем только соединения, которые долго простаивали
+        if time.monotonic() - last_used < self.ping_interval:
+            return True
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception as e:
+            with self._cond:
+                self.stats['health_failures'] += 1
+            logger.warning(f"⚠️ Пул {self.name}: соединение не прошло проверку: {e}")
+            return False
+
+    def acquire(self):
+        """Получение соединения из пула"""
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            entry = None
+            with self._cond:
+                if self._closed:
+                    raise PoolExhausted(f"Пул {self.name} закрыт")
+
+                if self._idle:
+                    entry = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                else:
+                    self.stats['waits'] += 1
+                    while not self._idle and self._size >= self.max_size and not self._closed:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.stats['timeouts'] += 1
+                            logger.warning(f"⚠️ Пул {self.name} исчерпан: {self._size}/{self.max_size} соединений занято")
+                            raise PoolExhausted(f"Нет свободных соединений в пуле {self.name}")
+                        self._cond.wait(remaining)
+                    continue
+
+            if entry is None:
+                # Зарезервировали место - открываем новое соединение вне блокировки
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            else:
+                conn, last_used = entry
+                if not self._is_healthy(conn, last_used):
+                    self._discard(conn)
+                    continue
+
+            with self._cond:
+                self.stats['checkouts'] += 1
+                in_use = self._size - len(self._idle)
+                if in_use > self.stats['max_in_use']:
+                    self.stats['max_in_use'] = in_use
+            return conn
+
+    def _discard(self, conn):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+        self._close(conn)
+
+    def release(self, conn, discard: bool = False):
+        """Возврат соединения в пул"""
+        if discard or self._closed or self.is_broken(conn) or self._is_expired(conn):
+            self._discard(conn)
+            return
+
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close_all(self):
+        """Закрытие всех соединений пула"""
+        with self._cond:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+            self._size -= len(idle)
+            self._cond.notify_all()
+
+        for conn, _ in idle:
+            self._close(conn)
+
+    def get_stats(self) -> Dict:
+        """Метрики пула"""
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'max_size': self.max_size,
+                **self.stats
+            }
+
+class TTLCache:
+    """Потокобезопасный кэш с LRU-вытеснением и TTL по пространствам имён"""
+
+    def __init__(self, max_size: int, default_ttl: float, ttls: Dict[str, float] = None):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.ttls = dict(ttls or {})
+        self._data = OrderedDict()  # (namespace, key) -> (value, expires_at)
+        self._namespaces = defaultdict(set)  # namespace -> ключи, для инвалидации без обхода всего кэша
+        self._lock = threading.RLock()
+        self._stats = defaultdict(lambda: {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0})
+
+    def _remove(self, namespace: str, key):
+        self._data.pop((namespace, key), None)
+        keys = self._namespaces.get(namespace)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._namespaces[namespace]
+
+    def get(self, namespace: str, key, default=None):
+        """Значение из кэша или default, если записи нет или она устарела"""
+        with self._lock:
+            item = self._data.get((namespace, key))
+            stats = self._stats[namespace]
+            if item is None:
+                stats['misses'] += 1
+                return default
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                self._remove(namespace, key)
+                stats['expired'] += 1
+                stats['misses'] += 1
+                return default
+            self._data.move_to_end((namespace, key))
+            stats['hits'] += 1
+            return value
+
+    def set(self, namespace: str, key, value, ttl: float = None):
+        """Сохранение значения; при переполнении вытесняется самая старая по использованию запись"""
+        if ttl is None:
+            ttl = self.ttls.get(namespace, self.default_ttl)
+        with self._lock:
+            self._data[(namespace, key)] = (value, time.monotonic() + ttl)
+            self._data.move_to_end((namespace, key))
+            self._namespaces[namespace].add(key)
+            while len(self._data) > self.max_size:
+                (old_ns, old_key), _ = self._data.popitem(last=False)
+                self._remove(old_ns, old_key)
+                self._stats[old_ns]['evictions'] += 1
+
+    def peek(self, namespace: str, key, default=None):
+        """Значение без учёта в статистике и без продвижения в LRU"""
+        with self._lock:
+            item = self._data.get((namespace, key))
+            if item is None or item[1] <= time.monotonic():
+                return default
+            return item[0]
+
+    def delete(self, namespace: str, key):
+        """Удаление одной записи"""
+        with self._lock:
+            self._remove(namespace, key)
+
+    def invalidate(self, namespace: str) -> int:
+        """Удаление всех записей пространства имён (O(размер пространства), а не всего кэша)"""
+        with self._lock:
+            keys = self._namespaces.pop(namespace, set())
+            for key in keys:
+                self._data.pop((namespace, key), None)
+            return len(keys)
+
+    def purge_expired(self) -> int:
+        """Удаление всех устаревших записей"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [k for k, (_, expires_at) in self._data.items() if expires_at <= now]
+            for namespace, key in expired:
+                self._remove(namespace, key)
+                self._stats[namespace]['expired'] += 1
+            return len(expired)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._namespaces.clear()
+
+    def get_stats(self) -> Dict:
+        """Метрики кэша по пространствам имён"""
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'namespaces': {
+                    ns: {**stats, 'size': len(self._namespaces.get(ns, ()))}
+                    for ns, stats in self._stats.items()
+                }
+            }
+
+class TokenBucket:
+    """Ограничитель частоты вызовов (token bucket): rate токенов в секунду, не больше capacity в запасе"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()  # ожидающие обслуживаются по очереди
+        self.stats = {'acquired': 0, 'waited': 0, 'wait_time': 0.0}
+
+    async def acquire(self):
+        async with self._lock:
+            started = time.monotonic()
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+            waited = time.monotonic() - started
+            self.stats['acquired'] += 1
+            if waited > 0.001:
+                self.stats['waited'] += 1
+                self.stats['wait_time'] += waited
+
+    def get_stats(self) -> Dict:
+        return {**self.stats, 'tokens': round(self._tokens, 1), 'wait_time': round(self.stats['wait_time'], 2)}
+
 class Database:
+    # Вторичные индексы под горячие запросы: (имя, таблица, колонки)
+    INDEXES = [
+        # get_available_numbers: WHERE status = ? AND (price_stars, id) > (?, ?) ORDER BY price_stars, id
+        ('idx_numbers_status_price', 'numbers', 'status, price_stars, id'),
+        # show_transactions / show_profile: WHERE user_id = ? ORDER BY created_at DESC
+        ('idx_transactions_user_created', 'transactions', 'user_id, created_at'),
+        # get_topup: WHERE payment_id = ?
+        ('idx_topups_payment_id', 'topups', 'payment_id'),
+        # get_available_tg_accounts: WHERE status/banned/spam_block ORDER BY last_used
+        ('idx_tg_accounts_available', 'tg_accounts', 'status, banned, spam_block, last_used'),
+        # cleanup_task: DELETE FROM session_logs WHERE created_at < ?
+        ('idx_session_logs_created', 'session_logs', 'created_at'),
+        # sweep_number_holds: WHERE expires_at < ?
+        ('idx_number_holds_expires', 'number_holds', 'expires_at'),
+    ]
+
+    # Счётчики статистики в shop_counters, поддерживаются триггерами:
+    # таблица -> ([(выражение имени, выражение приращения)], колонки, при UPDATE которых счётчики меняются)
+    # {row} заменяется на NEW/OLD
+    COUNTERS = {
+        'users': ([("'users_total'", "1")], []),
+        'numbers': ([("'numbers_' || COALESCE({row}.status, '')", "1")], ['status']),
+        'tg_accounts': ([("'accounts_total'", "1"),
+                         ("'accounts_' || COALESCE({row}.status, '')", "1")], ['status']),
+        'channels': ([("'channels_total'", "1")], []),
+        'transactions': ([("'stars_sold'",
+                           "CASE WHEN {row}.status = 'completed' THEN COALESCE({row}.amount_stars, 0) ELSE 0 END")],
+                         ['status', 'amount_stars']),
+    }
+
+    # Пересчёт тех же счётчиков из исходных таблиц (для сверки)
+    COUNTERS_RECONCILE_SQL = '''
+        SELECT 'users_total' AS name, COUNT(*) AS value FROM users
+        UNION ALL
+        SELECT 'numbers_' || COALESCE(status, ''), COUNT(*) FROM numbers GROUP BY status
+        UNION ALL
+        SELECT 'accounts_total', COUNT(*) FROM tg_accounts
+        UNION ALL
+        SELECT 'accounts_' || COALESCE(status, ''), COUNT(*) FROM tg_accounts GROUP BY status
+        UNION ALL
+        SELECT 'channels_total', COUNT(*) FROM channels
+        UNION ALL
+        SELECT 'stars_sold', COALESCE(SUM(amount_stars), 0) FROM transactions WHERE status = 'completed'
+    '''
+
     def __init__(self):
-        self.cache = {}
+        self.cache = TTLCache(CACHE_MAX_SIZE, CACHE_TTL, CACHE_TTLS)
+        self._pending_activity: Dict[int, float] = {}  # user_id -> last_activity, ждут сброса в БД
+        self._activity_lock = threading.Lock()
         self.db_url = DATABASE_URL
+        # SQLite: одно долгоживущее соединение-писатель под блокировкой, чтения - через пул read-only соединений
+        self._writer = None
+        self._write_lock = threading.RLock()
+        self._write_local = threading.local()  # глубина вложенных get_cursor в потоке писателя
+        self.writer_stats = {'transactions': 0, 'lock_waits': 0, 'lock_wait_time': 0.0, 'reconnects': 0}
+        # Снимок каналов подписки: неизменяемый кортеж, при изменениях заменяется целиком
+        self._channels: Tuple[MappingProxyType, ...] = ()
+        self._channels_lock = threading.Lock()  # правки каналов и перечитывание снимка - по одной
         
         if self.db_url:
             logger.info("✅ Инициализация PostgreSQL...")
@@ -825,14 +1470,60 @@ class Database:
             logger.info("⚠️ Инициализация SQLite...")
             self.db_path = "shop.db"
             self._init_sqlite()
-    
-    def create_backup(self):
-        """Создание бекапа БД"""
+
+        self.pool = ConnectionPool(
+            self._get_connection if self.db_url else self._get_read_connection,
+            min_size=DB_POOL_MIN,
+            max_size=DB_POOL_MAX,
+            timeout=DB_POOL_TIMEOUT,
+            max_age=DB_POOL_MAX_AGE,
+            ping_interval=DB_POOL_PING_INTERVAL,
+            name="postgres" if self.db_url else "sqlite-ro"
+        )
+        logger.info(f"✅ Пул соединений создан: {DB_POOL_MIN}-{DB_POOL_MAX} соединений")
+
+        # Заполняем/сверяем счётчики статистики при старте
+        self.reconcile_stats()
+        self._reload_channels()
+
+    def close(self):
+        """Закрытие пула соединений (и соединения-писателя SQLite)"""
+        self.pool.close_all()
+        with self._write_lock:
+            if self._writer is not None:
+                try:
+                    self._writer.close()
+                except Exception:
+                    pass
+                self._writer = None
+        logger.info("✅ Пул соединений с БД закрыт")
+
+    def get_pool_stats(self) -> Dict:
+        """Метрики пула соединений"""
+        stats = self.pool.get_stats()
+        if not self.db_url:
+            stats['writer'] = dict(self.writer_stats)
+        return stats
+
+    def get_cache_stats(self) -> Dict:
+        """Метрики кэша"""
+        return self.cache.get_stats()
+
+    def create_backup(self, backup_file: str = None):
+        """Создание бекапа БД (онлайн-копия через backup API: в режиме WAL
+        простое копирование файла теряет незачекпойнтенные изменения)"""
         try:
             if not self.db_url:  # Только для SQLite
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                backup_file = os.path.join(DATABASE_BACKUP_DIR, f"backup_{timestamp}.db")
-                shutil.copy2(self.db_path, backup_file)
+                if backup_file is None:
+                    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+                    backup_file = os.path.join(DATABASE_BACKUP_DIR, f"backup_{timestamp}.db")
+                with self._write_lock:
+                    source = self._get_writer()
+                    target = sqlite3.connect(backup_file)
+                    try:
+                        source.backup(target)
+                    finally:
+                        target.close()
                 logger.info(f"✅ Бекап создан: {backup_file}")
                 return backup_file
             return None
@@ -840,6 +1531,97 @@ class Database:
             logger.error(f"❌ Ошибка создания бекапа: {e}")
             return None
     
+    def _create_indexes(self, cursor):
+        """Создание вторичных индексов (идемпотентно, синтаксис общий для PG и SQLite)"""
+        for name, table, columns in self.INDEXES:
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})')
+
+    def _create_counters_postgres(self, cursor):
+        """Таблица счётчиков и триггеры, поддерживающие её (PostgreSQL)"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS shop_counters (
+                name TEXT PRIMARY KEY,
+                value BIGINT NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute('''
+            CREATE OR REPLACE FUNCTION shop_counter_add(counter TEXT, delta BIGINT) RETURNS void AS $$
+            BEGIN
+                IF delta <> 0 THEN
+                    INSERT INTO shop_counters (name, value) VALUES (counter, delta)
+                    ON CONFLICT (name) DO UPDATE SET value = shop_counters.value + EXCLUDED.value;
+                END IF;
+            END;
+            $$ LANGUAGE plpgsql
+        ''')
+        for table, (counters, update_columns) in self.COUNTERS.items():
+            old_calls = "\n".join(
+                f"PERFORM shop_counter_add({name.format(row='OLD')}, -({delta.format(row='OLD')}));"
+                for name, delta in counters
+            )
+            new_calls = "\n".join(
+                f"PERFORM shop_counter_add({name.format(row='NEW')}, {delta.format(row='NEW')});"
+                for name, delta in counters
+            )
+            cursor.execute(f'''
+                CREATE OR REPLACE FUNCTION shop_counters_{table}() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                        {old_calls}
+                    END IF;
+                    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                        {new_calls}
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+            ''')
+            cursor.execute(f'DROP TRIGGER IF EXISTS trg_counters_{table} ON {table}')
+            cursor.execute(f'''
+                CREATE TRIGGER trg_counters_{table} AFTER INSERT OR DELETE ON {table}
+                FOR EACH ROW EXECUTE PROCEDURE shop_counters_{table}()
+            ''')
+            cursor.execute(f'DROP TRIGGER IF EXISTS trg_counters_{table}_upd ON {table}')
+            if update_columns:
+                changed = " OR ".join(f"OLD.{c} IS DISTINCT FROM NEW.{c}" for c in update_columns)
+                cursor.execute(f'''
+                    CREATE TRIGGER trg_counters_{table}_upd AFTER UPDATE OF {", ".join(update_columns)} ON {table}
+                    FOR EACH ROW WHEN ({changed}) EXECUTE PROCEDURE shop_counters_{table}()
+                ''')
+
+    def _create_counters_sqlite(self, cursor):
+        """Таблица счётчиков и триггеры, поддерживающие её (SQLite)"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS shop_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        upsert = '''INSERT INTO shop_counters (name, value) VALUES ({name}, {delta})
+                    ON CONFLICT (name) DO UPDATE SET value = shop_counters.value + excluded.value;'''
+        for table, (counters, update_columns) in self.COUNTERS.items():
+            old_stmts = "\n".join(upsert.format(name=name.format(row='OLD'), delta=f"-({delta.format(row='OLD')})")
+                                  for name, delta in counters)
+            new_stmts = "\n".join(upsert.format(name=name.format(row='NEW'), delta=delta.format(row='NEW'))
+                                  for name, delta in counters)
+            for suffix in ('ins', 'del', 'upd'):
+                cursor.execute(f'DROP TRIGGER IF EXISTS trg_counters_{table}_{suffix}')
+            cursor.execute(f'''
+                CREATE TRIGGER trg_counters_{table}_ins AFTER INSERT ON {table}
+                BEGIN {new_stmts} END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER trg_counters_{table}_del AFTER DELETE ON {table}
+                BEGIN {old_stmts} END
+            ''')
+            if update_columns:
+                changed = " OR ".join(f"OLD.{c} IS NOT NEW.{c}" for c in update_columns)
+                cursor.execute(f'''
+                    CREATE TRIGGER trg_counters_{table}_upd AFTER UPDATE OF {", ".join(update_columns)} ON {table}
+                    WHEN {changed}
+                    BEGIN {old_stmts} {new_stmts} END
+                ''')
+
     def _init_postgres(self):
         """Инициализация PostgreSQL"""
         try:
@@ -949,6 +1731,60 @@ class Database:
                 )
             ''')
             
+            # Таблица броней номеров на время внешней оплаты
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS number_holds (
+                    number_id INTEGER PRIMARY KEY,
+                    user_id BIGINT,
+                    payment_id TEXT,
+                    created_at DOUBLE PRECISION,
+                    expires_at DOUBLE PRECISION
+                )
+            ''')
+            # Ранее созданные таблицы хранили время в REAL (float4): точности не хватает на epoch-секунды
+            cursor.execute('''
+                SELECT column_name FROM information_schema.columns
+                WHERE table_name = 'number_holds' AND column_name IN ('created_at', 'expires_at')
+                  AND data_type = 'real'
+            ''')
+            for row in cursor.fetchall():
+                cursor.execute(f'ALTER TABLE number_holds ALTER COLUMN {row["column_name"]} TYPE DOUBLE PRECISION')
+            
+            # Таблица незавершённых входов в аккаунты (ожидание кода/2FA), переживает перезапуск
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS pending_logins (
+                    phone TEXT PRIMARY KEY,
+                    stage TEXT,
+                    action TEXT,
+                    number_id INTEGER,
+                    user_id BIGINT,
+                    phone_code_hash TEXT,
+                    session_name TEXT,
+                    created_at DOUBLE PRECISION,
+                    updated_at DOUBLE PRECISION
+                )
+            ''')
+            
+            # Сессии Pyrogram (строка сессии, зашифрованная Fernet) вместо файлов .session
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS tg_sessions (
+                    phone TEXT PRIMARY KEY,
+                    session_data TEXT,
+                    updated_at DOUBLE PRECISION
+                )
+            ''')
+            
+            # Индекс подписок на обязательные каналы (обновляется апдейтами chat_member)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS channel_members (
+                    channel_id TEXT,
+                    user_id BIGINT,
+                    is_member INTEGER,
+                    updated_at DOUBLE PRECISION,
+                    PRIMARY KEY (channel_id, user_id)
+                )
+            ''')
+            
             # Таблица пополнений
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS topups (
@@ -1018,6 +1854,12 @@ class Database:
                 ON CONFLICT (key) DO NOTHING
             ''', ('welcome_media', '', time.time()))
             
+            # Индексы
+            self._create_indexes(cursor)
+            
+            # Счётчики статистики
+            self._create_counters_postgres(cursor)
+            
             conn.commit()
             cursor.close()
             conn.close()
@@ -1035,6 +1877,9 @@ class Database:
             conn = sqlite3.connect(self.db_path, timeout=30)
             cursor = conn.cursor()
             
+            # WAL: читатели не блокируют писателя и наоборот (режим сохраняется в файле БД)
+            cursor.execute('PRAGMA journal_mode = WAL')
+            
             # Таблица пользователей
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS users (
@@ -1138,6 +1983,52 @@ class Database:
                 )
             ''')
             
+            # Таблица броней номеров на время внешней оплаты
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS number_holds (
+                    number_id INTEGER PRIMARY KEY,
+                    user_id INTEGER,
+                    payment_id TEXT,
+                    created_at REAL,
+                    expires_at REAL
+                )
+            ''')
+            
+            # Таблица незавершённых входов в аккаунты (ожидание кода/2FA), переживает перезапуск
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS pending_logins (
+                    phone TEXT PRIMARY KEY,
+                    stage TEXT,
+                    action TEXT,
+                    number_id INTEGER,
+                    user_id INTEGER,
+                    phone_code_hash TEXT,
+                    session_name TEXT,
+                    created_at REAL,
+                    updated_at REAL
+                )
+            ''')
+            
+            # Сессии Pyrogram (строка сессии, зашифрованная Fernet) вместо файлов .session
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS tg_sessions (
+                    phone TEXT PRIMARY KEY,
+                    session_data TEXT,
+                    updated_at REAL
+                )
+            ''')
+            
+            # Индекс подписок на обязательные каналы (обновляется апдейтами chat_member)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS channel_members (
+                    channel_id TEXT,
+                    user_id INTEGER,
+                    is_member INTEGER,
+                    updated_at REAL,
+                    PRIMARY KEY (channel_id, user_id)
+                )
+            ''')
+            
             # Таблица пополнений
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS topups (
@@ -1204,6 +2095,12 @@ class Database:
                 INSERT OR IGNORE INTO bot_settings (key, value, updated_at) VALUES (?, ?, ?)
             ''', ('welcome_media', '', time.time()))
             
+            # Индексы
+            self._create_indexes(cursor)
+            
+            # Счётчики статистики
+            self._create_counters_sqlite(cursor)
+            
             conn.commit()
             cursor.close()
             conn.close()
@@ -1213,7 +2110,7 @@ class Database:
             logger.error(f"❌ Ошибка инициализации SQLite: {e}")
     
     def _get_connection(self):
-        """Получение соединения с БД"""
+        """Открытие нового соединения с БД (используется пулом)"""
         if self.db_url:
             try:
                 conn = psycopg2.connect(self.db_url)
@@ -1224,57 +2121,192 @@ class Database:
                 raise
         else:
             try:
-                conn = sqlite3.connect(self.db_path, timeout=30)
-                conn.row_factory = sqlite3.Row
+                conn = sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT / 1000, check_same_thread=False)
+                self._configure_sqlite(conn)
+                # Чтобы INSERT OR REPLACE срабатывал и на триггеры удаления (счётчики shop_counters)
+                conn.execute('PRAGMA recursive_triggers = ON')
                 return conn
             except sqlite3.Error as e:
                 logger.error(f"❌ Ошибка подключения к SQLite: {e}")
                 raise
-    
+
+    def _get_read_connection(self):
+        """Открытие read-only соединения SQLite (для пула читателей)"""
+        try:
+            uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, timeout=SQLITE_BUSY_TIMEOUT / 1000, check_same_thread=False)
+            self._configure_sqlite(conn)
+            return conn
+        except sqlite3.Error as e:
+            logger.error(f"❌ Ошибка подключения к SQLite (read-only): {e}")
+            raise
+
+    @staticmethod
+    def _configure_sqlite(conn):
+        """Прагмы соединения SQLite"""
+        conn.row_factory = sqlite3.Row
+        conn.execute(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT}')
+        conn.execute('PRAGMA synchronous = NORMAL')  # В WAL безопасно: теряются максимум последние коммиты при сбое ОС
+        conn.execute(f'PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_SIZE}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute('PRAGMA foreign_keys = OFF')
+
+    def _get_writer(self):
+        """Долгоживущее соединение-писатель SQLite (вызывать под self._write_lock)"""
+        if self._writer is None:
+            self._writer = self._get_connection()
+            self.writer_stats['reconnects'] += 1
+        return self._writer
+
     @contextmanager
     def get_cursor(self):
-        """Контекстный менеджер для БД"""
+        """Контекстный менеджер для БД (соединение берётся из пула).
+        SQLite: все записи идут через одно соединение-писатель по очереди"""
+        count_trace('db')
+        if not self.db_url:
+            with self._sqlite_write_cursor() as cursor:
+                yield cursor
+            return
+        
         conn = None
         cursor = None
+        broken = False
         try:
-            conn = self._get_connection()
+            conn = self.pool.acquire()
             cursor = conn.cursor()
             yield cursor
             conn.commit()
         except Exception as e:
-            logger.error(f"❌ Ошибка базы данных: {e}")
+            if not isinstance(e, RollbackTransaction):
+                logger.error(f"❌ Ошибка базы данных: {e}")
             if conn:
-                conn.rollback()
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
             raise
         finally:
             if cursor:
-                cursor.close()
+                try:
+                    cursor.close()
+                except Exception:
+                    broken = True
             if conn:
-                conn.close()
+                self.pool.release(conn, discard=broken)
     
+    @contextmanager
+    def _sqlite_write_cursor(self):
+        """Курсор соединения-писателя SQLite: одна транзакция за раз, коммит на внешнем уровне"""
+        started = time.monotonic()
+        if not self._write_lock.acquire(blocking=False):
+            self.writer_stats['lock_waits'] += 1
+            self._write_lock.acquire()
+            self.writer_stats['lock_wait_time'] += time.monotonic() - started
+        
+        depth = getattr(self._write_local, 'depth', 0)
+        self._write_local.depth = depth + 1
+        cursor = None
+        try:
+            conn = self._get_writer()
+            cursor = conn.cursor()
+            savepoint = f'nested_{depth}'
+            if depth:
+                # Вложенный вызов - точка сохранения: его откат не затрагивает внешнюю транзакцию
+                if not conn.in_transaction:
+                    conn.execute('BEGIN')
+                conn.execute(f'SAVEPOINT {savepoint}')
+            try:
+                yield cursor
+                if depth == 0:
+                    conn.commit()
+                    self.writer_stats['transactions'] += 1
+                else:
+                    conn.execute(f'RELEASE {savepoint}')
+            except Exception as e:
+                if depth:
+                    try:
+                        conn.execute(f'ROLLBACK TO {savepoint}')
+                        conn.execute(f'RELEASE {savepoint}')
+                    except Exception:
+                        pass  # внешний уровень откатит транзакцию целиком
+                else:
+                    if not isinstance(e, RollbackTransaction):
+                        logger.error(f"❌ Ошибка базы данных: {e}")
+                    try:
+                        conn.rollback()
+                    except Exception:
+                        # Соединение в неизвестном состоянии - откроем новое
+                        try:
+                            conn.close()
+                        except Exception:
+                            pass
+                        self._writer = None
+                raise
+        finally:
+            if cursor is not None:
+                try:
+                    cursor.close()
+                except Exception:
+                    pass
+            self._write_local.depth = depth
+            self._write_lock.release()
+
+    @contextmanager
+    def get_read_cursor(self):
+        """Курсор только для чтения. SQLite: read-only соединение из пула, не ждёт писателя
+        (WAL); PostgreSQL: обычное соединение из пула"""
+        if self.db_url:
+            with self.get_cursor() as cursor:
+                yield cursor
+            return
+        
+        count_trace('db')
+        conn = None
+        cursor = None
+        broken = False
+        try:
+            conn = self.pool.acquire()
+            cursor = conn.cursor()
+            yield cursor
+        except Exception as e:
+            logger.error(f"❌ Ошибка базы данных: {e}")
+            raise
+        finally:
+            if cursor:
+                try:
+                    cursor.close()
+                except Exception:
+                    broken = True
+            if conn:
+                try:
+                    # Завершаем читающую транзакцию, чтобы не держать снимок WAL
+                    conn.rollback()
+                except Exception:
+                    broken = True
+                self.pool.release(conn, discard=broken)
+
     # ===== Методы для настроек бота =====
     
     def get_setting(self, key: str, default: str = "") -> str:
         """Получение настройки бота"""
-        cache_key = f'setting_{key}'
-        if cache_key in self.cache:
-            cached, timestamp = self.cache[cache_key]
-            if time.time() - timestamp < CACHE_TTL:
-                return cached
+        cached = self.cache.get('setting', key)
+        if cached is not None:
+            return cached
         
         try:
             if self.db_url:
-                with self.get_cursor() as cursor:
+                with self.get_read_cursor() as cursor:
                     cursor.execute('SELECT value FROM bot_settings WHERE key = %s', (key,))
                     row = cursor.fetchone()
                     value = row['value'] if row else default
             else:
-                with self.get_cursor() as cursor:
+                with self.get_read_cursor() as cursor:
                     cursor.execute('SELECT value FROM bot_settings WHERE key = ?', (key,))
                     row = cursor.fetchone()
                     value = row['value'] if row else default
             
-            self.cache[cache_key] = (value, time.time())
+            self.cache.set('setting', key, value)
             return value
         except Exception as e:
             logger.error(f"Ошибка получения настройки {key}: {e}")
@@ -1298,9 +2330,7 @@ class Database:
                     ''', (key, value, time.time()))
             
             # Очищаем кэш
-            cache_key = f'setting_{key}'
-            if cache_key in self.cache:
-                del self.cache[cache_key]
+            self.cache.delete('setting', key)
             
             logger.info(f"✅ Настройка {key} обновлена")
             return True
@@ -1323,28 +2353,26 @@ class Database:
     # ===== Методы для пользователей =====
     
     def get_user(self, user_id: int) -> Optional[Dict]:
-        cache_key = f'user_{user_id}'
-        if cache_key in self.cache:
-            cached, timestamp = self.cache[cache_key]
-            if time.time() - timestamp < CACHE_TTL:
-                return cached
+        cached = self.cache.get('user', user_id)
+        if cached is not None:
+            return cached
         
         try:
             if self.db_url:
-                with self.get_cursor() as cursor:
+                with self.get_read_cursor() as cursor:
                     cursor.execute('SELECT * FROM users WHERE user_id = %s', (user_id,))
                     row = cursor.fetchone()
                     if row:
                         user = dict(row)
-                        self.cache[cache_key] = (user, time.time())
+                        self.cache.set('user', user_id, user)
                         return user
             else:
-                with self.get_cursor() as cursor:
+                with self.get_read_cursor() as cursor:
                     cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
                     row = cursor.fetchone()
                     if row:
                         user = dict(row)
-                        self.cache[cache_key] = (user, time.time())
+                        self.cache.set('user', user_id, user)
                         return user
         except Exception as e:
             logger.error(f"Ошибка получения пользователя {user_id}: {e}")
@@ -1371,20 +2399,69 @@ class Database:
             logger.error(f"Ошибка создания пользователя {user_id}: {e}")
             return False
     
+    def get_or_create_user(self, user_id: int, username: str, first_name: str) -> Optional[Dict]:
+        """Получение пользователя с регистрацией при первом обращении (из кэша - без запросов к БД)"""
+        user = self.get_user(user_id)
+        if user is None and self.create_user(user_id, username, first_name):
+            user = self.get_user(user_id)
+            if user:
+                logger.info(f"✅ Новый пользователь: {user_id}")
+        return user
+    
     def update_user_activity(self, user_id: int):
+        """Отметка активности (только в памяти, в БД пишет flush_user_activity)"""
+        now = time.time()
+        with self._activity_lock:
+            self._pending_activity[user_id] = now
+        
+        user = self.cache.peek('user', user_id)
+        if user is not None:
+            user['last_activity'] = now
+    
+    def flush_user_activity(self) -> int:
+        """Сброс накопленных отметок активности одним пакетным запросом"""
+        with self._activity_lock:
+            if not self._pending_activity:
+                return 0
+            pending, self._pending_activity = self._pending_activity, {}
+        
+        rows = list(pending.items())
         try:
             if self.db_url:
                 with self.get_cursor() as cursor:
-                    cursor.execute('UPDATE users SET last_activity = %s WHERE user_id = %s', 
-                                  (time.time(), user_id))
+                    psycopg2.extras.execute_values(cursor, '''
+                        UPDATE users AS u SET last_activity = v.last_activity
+                        FROM (VALUES %s) AS v(user_id, last_activity)
+                        WHERE u.user_id = v.user_id
+                    ''', rows)
             else:
                 with self.get_cursor() as cursor:
-                    cursor.execute('UPDATE users SET last_activity = ? WHERE user_id = ?', 
-                                  (time.time(), user_id))
-            if f'user_{user_id}' in self.cache:
-                del self.cache[f'user_{user_id}']
+                    cursor.executemany('UPDATE users SET last_activity = ? WHERE user_id = ?',
+                                       [(ts, user_id) for user_id, ts in rows])
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Ошибка сброса активности ({len(rows)} польз.): {e}")
+            # Возвращаем отметки обратно, более свежие значения не затираем
+            with self._activity_lock:
+                for user_id, ts in rows:
+                    if self._pending_activity.get(user_id, 0) < ts:
+                        self._pending_activity[user_id] = ts
+            return 0
+    
+    def get_recent_users(self, limit: int = 20) -> List[Dict]:
+        """Последние зарегистрированные пользователи (для админки)"""
+        try:
+            if self.db_url:
+                with self.get_read_cursor() as cursor:
+                    cursor.execute('SELECT user_id, username, first_name, stars_balance, is_admin, banned, registered_at FROM users ORDER BY registered_at DESC LIMIT %s', (limit,))
+                    return [dict(row) for row in cursor.fetchall()]
+            else:
+                with self.get_read_cursor() as cursor:
+                    cursor.execute('SELECT user_id, username, first_name, stars_balance, is_admin, banned, registered_at FROM users ORDER BY registered_at DESC LIMIT ?', (limit,))
+                    return [dict(row) for row in cursor.fetchall()]
         except Exception as e:
-            logger.error(f"Ошибка обновления активности {user_id}: {e}")
+            logger.error(f"Ошибка получения пользователей: {e}")
+            return []
     
     def add_stars(self, user_id: int, amount: int, payment_system: str = "admin", payment_id: str = None) -> bool:
         """Добавление звёзд пользователю"""
@@ -1413,8 +2490,7 @@ class Database:
                     ''', (user_id, amount, amount * STAR_TO_RUB, 'credit', payment_system, payment_id, 'completed', time.time()))
             
             # Очищаем кэш
-            if f'user_{user_id}' in self.cache:
-                del self.cache[f'user_{user_id}']
+            self.cache.delete('user', user_id)
             
             logger.info(f"✅ Добавлено {amount}⭐ пользователю {user_id} через {payment_system}")
             return True
@@ -1442,8 +2518,7 @@ class Database:
                             VALUES (%s, %s, 'debit', %s, %s)
                         ''', (user_id, amount, description, time.time()))
                         
-                        if f'user_{user_id}' in self.cache:
-                            del self.cache[f'user_{user_id}']
+                        self.cache.delete('user', user_id)
                         return True
             else:
                 with self.get_cursor() as cursor:
@@ -1457,8 +2532,7 @@ class Database:
                             VALUES (?, ?, 'debit', ?, ?)
                         ''', (user_id, amount, description, time.time()))
                         
-                        if f'user_{user_id}' in self.cache:
-                            del self.cache[f'user_{user_id}']
+                        self.cache.delete('user', user_id)
                         return True
             return False
         except Exception as e:
@@ -1505,12 +2579,12 @@ class Database:
     def get_topup(self, payment_id: str) -> Optional[Dict]:
         try:
             if self.db_url:
-                with self.get_cursor() as cursor:
+                with self.get_read_cursor() as cursor:
                     cursor.execute('SELECT * FROM topups WHERE payment_id = %s', (payment_id,))
                     row = cursor.fetchone()
                     return dict(row) if row else None
             else:
-                with self.get_cursor() as cursor:
+                with self.get_read_cursor() as cursor:
                     cursor.execute('SELECT * FROM topups WHERE payment_id = ?', (payment_id,))
                     row = cursor.fetchone()
                     return dict(row) if row else None
@@ -1556,31 +2630,234 @@ class Database:
                     ''', (topup['user_id'], topup['stars_amount'], topup['amount_rub'],
                           topup['payment_system'], payment_id, time.time(), time.time()))
             
-            if f'user_{topup["user_id"]}' in self.cache:
-                del self.cache[f'user_{topup["user_id"]}']
+            self.cache.delete('user', topup["user_id"])
             
             logger.info(f"✅ Пополнение {payment_id} завершено, пользователь {topup['user_id']} получил {topup['stars_amount']}⭐")
             return True
-            
+
         except Exception as e:
             logger.error(f"Ошибка завершения пополнения {payment_id}: {e}")
             return False
-    
-    # ===== Методы для Telegram аккаунтов =====
-    
-    def add_tg_account(self, phone: str, session_name: str, api_id: int, api_hash: str, 
-                       user_info: Dict, added_by: int, has_2fa: bool = False) -> bool:
+
+    # ===== Методы для платежей =====
+
+    def create_payment(self, payment_id: str, user_id: int, number_id: int, amount_rub: float,
+                       stars_amount: int, payment_system: str, payment_url: str) -> bool:
+        """Создание записи о платеже за номер"""
         try:
             if self.db_url:
                 with self.get_cursor() as cursor:
                     cursor.execute('''
-                        INSERT INTO tg_accounts 
-                        (phone, session_name, api_id, api_hash, first_name, last_name, username, user_id, 
-                         added_by, added_at, last_used, status, has_2fa)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        ON CONFLICT (phone) DO UPDATE SET
-                            session_name = EXCLUDED.session_name,
-                            first_name = EXCLUDED.first_name,
+                        INSERT INTO payments (id, user_id, number_id, amount_rub, stars_amount, payment_system, created_at, payment_url)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    ''', (payment_id, user_id, number_id, amount_rub, stars_amount,
+                          payment_system, time.time(), payment_url))
+            else:
+                with self.get_cursor() as cursor:
+                    cursor.execute('''
+                        INSERT INTO payments (id, user_id, number_id, amount_rub, stars_amount, payment_system, created_at, payment_url)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', (payment_id, user_id, number_id, amount_rub, stars_amount,
+                          payment_system, time.time(), payment_url))
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка создания платежа {payment_id}: {e}")
+            return False
+
+    def get_payment(self, payment_id: str) -> Optional[Dict]:
+        try:
+            if self.db_url:
+                with self.get_read_cursor() as cursor:
+                    cursor.execute('SELECT * FROM payments WHERE id = %s', (payment_id,))
+                    row = cursor.fetchone()
+                    return dict(row) if row else None
+            else:
+                with self.get_read_cursor() as cursor:
+                    cursor.execute('SELECT * FROM payments WHERE id = ?', (payment_id,))
+                    row = cursor.fetchone()
+                    return dict(row) if row else None
+        except Exception as e:
+            logger.error(f"Ошибка получения платежа {payment_id}: {e}")
+            return None
+
+    def complete_payment(self, payment: Dict, charge: bool = True) -> Tuple[str, Optional[int]]:
+        """Атомарное завершение платежа за номер: pending -> completed, резерв номера
+        и списание звёзд в одной транзакции. Возвращает (результат, новый баланс), результат:
+        'ok', 'already_completed', 'number_unavailable', 'insufficient_funds'"""
+        try:
+            with self.get_cursor() as cursor:
+                if self.db_url:
+                    cursor.execute('''
+                        UPDATE payments SET status = 'completed', completed_at = %s
+                        WHERE id = %s AND status = 'pending'
+                    ''', (time.time(), payment['id']))
+                else:
+                    cursor.execute('''
+                        UPDATE payments SET status = 'completed', completed_at = ?
+                        WHERE id = ? AND status = 'pending'
+                    ''', (time.time(), payment['id']))
+                if cursor.rowcount == 0:
+                    return 'already_completed', None
+                
+                if not self._reserve_number(cursor, payment['number_id'], payment['user_id']):
+                    raise RollbackTransaction('number_unavailable')
+                
+                new_balance = None
+                if charge:
+                    new_balance = self._charge_stars(cursor, payment['user_id'], payment['stars_amount'])
+                    if new_balance is None:
+                        raise RollbackTransaction('insufficient_funds')
+                
+                if self.db_url:
+                    cursor.execute('''
+                        UPDATE transactions SET status = 'completed', completed_at = %s
+                        WHERE user_id = %s AND number_id = %s
+                    ''', (time.time(), payment['user_id'], payment['number_id']))
+                else:
+                    cursor.execute('''
+                        UPDATE transactions SET status = 'completed', completed_at = ?
+                        WHERE user_id = ? AND number_id = ?
+                    ''', (time.time(), payment['user_id'], payment['number_id']))
+        except RollbackTransaction as e:
+            return e.args[0], None
+        
+        self.cache.invalidate('numbers')
+        self.cache.delete('user', payment["user_id"])
+        return 'ok', new_balance
+
+    def complete_webhook_payment(self, payment_id: str) -> bool:
+        """Завершение платежа по webhook с начислением звёзд (повторный webhook ничего не меняет)"""
+        with self.get_cursor() as cursor:
+            if self.db_url:
+                cursor.execute('''
+                    UPDATE payments SET status = 'completed', completed_at = %s
+                    WHERE id = %s AND status = 'pending'
+                    RETURNING user_id, number_id, stars_amount
+                ''', (time.time(), payment_id))
+            else:
+                cursor.execute('''
+                    UPDATE payments SET status = 'completed', completed_at = ?
+                    WHERE id = ? AND status = 'pending'
+                    RETURNING user_id, number_id, stars_amount
+                ''', (time.time(), payment_id))
+            payment = cursor.fetchone()
+            if not payment:
+                return False
+            
+            if self.db_url:
+                cursor.execute('''
+                    UPDATE users SET stars_balance = stars_balance + %s WHERE user_id = %s
+                ''', (payment['stars_amount'], payment['user_id']))
+            else:
+                cursor.execute('''
+                    UPDATE users SET stars_balance = stars_balance + ? WHERE user_id = ?
+                ''', (payment['stars_amount'], payment['user_id']))
+            
+            if self.db_url:
+                cursor.execute('''
+                    UPDATE transactions SET status = 'completed', completed_at = %s
+                    WHERE user_id = %s AND number_id = %s
+                ''', (time.time(), payment['user_id'], payment['number_id']))
+            else:
+                cursor.execute('''
+                    UPDATE transactions SET status = 'completed', completed_at = ?
+                    WHERE user_id = ? AND number_id = ?
+                ''', (time.time(), payment['user_id'], payment['number_id']))
+        
+        self.cache.delete('user', payment["user_id"])
+        return True
+
+    # ===== Методы для транзакций =====
+
+    def get_user_transactions(self, user_id: int, limit: int = 20) -> List[Dict]:
+        try:
+            if self.db_url:
+                with self.get_read_cursor() as cursor:
+                    cursor.execute('''
+                        SELECT * FROM transactions
+                        WHERE user_id = %s
+                        ORDER BY created_at DESC
+                        LIMIT %s
+                    ''', (user_id, limit))
+                    return [dict(row) for row in cursor.fetchall()]
+            else:
+                with self.get_read_cursor() as cursor:
+                    cursor.execute('''
+                        SELECT * FROM transactions
+                        WHERE user_id = ?
+                        ORDER BY created_at DESC
+                        LIMIT ?
+                    ''', (user_id, limit))
+                    return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Ошибка получения транзакций {user_id}: {e}")
+            return []
+
+    def count_user_purchases(self, user_id: int) -> int:
+        """Количество завершённых транзакций пользователя"""
+        try:
+            if self.db_url:
+                with self.get_read_cursor() as cursor:
+                    cursor.execute('SELECT COUNT(*) as count FROM transactions WHERE user_id = %s AND status = %s',
+                                  (user_id, 'completed'))
+                    return cursor.fetchone()['count'] or 0
+            else:
+                with self.get_read_cursor() as cursor:
+                    cursor.execute('SELECT COUNT(*) as count FROM transactions WHERE user_id = ? AND status = "completed"',
+                                  (user_id,))
+                    return cursor.fetchone()['count'] or 0
+        except Exception as e:
+            logger.error(f"Ошибка получения транзакций: {e}")
+            return 0
+
+    def get_transaction_stats(self) -> Dict:
+        """Статистика завершённых транзакций для админки"""
+        stats = {'completed': 0, 'today': 0, 'avg_price': 0}
+        try:
+            if self.db_url:
+                with self.get_read_cursor() as cursor:
+                    cursor.execute('SELECT COUNT(*) as count FROM transactions WHERE status = %s', ('completed',))
+                    stats['completed'] = cursor.fetchone()['count'] or 0
+
+                    cursor.execute('''
+                        SELECT COUNT(*) as count FROM transactions
+                        WHERE status = %s AND to_timestamp(created_at)::date = CURRENT_DATE
+                    ''', ('completed',))
+                    stats['today'] = cursor.fetchone()['count'] or 0
+
+                    cursor.execute('SELECT AVG(amount_stars) as avg FROM transactions WHERE status = %s', ('completed',))
+                    row = cursor.fetchone()
+                    stats['avg_price'] = float(row['avg'] or 0)
+            else:
+                with self.get_read_cursor() as cursor:
+                    cursor.execute('SELECT COUNT(*) as count FROM transactions WHERE status = "completed"')
+                    stats['completed'] = cursor.fetchone()['count'] or 0
+
+                    cursor.execute('SELECT COUNT(*) as count FROM transactions WHERE status = "completed" AND date(created_at, "unixepoch") = date("now")')
+                    stats['today'] = cursor.fetchone()['count'] or 0
+
+                    cursor.execute('SELECT AVG(amount_stars) as avg FROM transactions WHERE status = "completed"')
+                    row = cursor.fetchone()
+                    stats['avg_price'] = row['avg'] or 0
+        except Exception as e:
+            logger.error(f"Ошибка получения статистики транзакций: {e}")
+        return stats
+
+    # ===== Методы для Telegram аккаунтов =====
+    
+    def add_tg_account(self, phone: str, session_name: str, api_id: int, api_hash: str, 
+                       user_info: Dict, added_by: int, has_2fa: bool = False) -> bool:
+        try:
+            if self.db_url:
+                with self.get_cursor() as cursor:
+                    cursor.execute('''
+                        INSERT INTO tg_accounts 
+                        (phone, session_name, api_id, api_hash, first_name, last_name, username, user_id, 
+                         added_by, added_at, last_used, status, has_2fa)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                        ON CONFLICT (phone) DO UPDATE SET
+                            session_name = EXCLUDED.session_name,
+                            first_name = EXCLUDED.first_name,
                             last_name = EXCLUDED.last_name,
                             username = EXCLUDED.username,
                             user_id = EXCLUDED.user_id,
@@ -1621,12 +2898,12 @@ class Database:
     def get_tg_account(self, phone: str) -> Optional[Dict]:
         try:
             if self.db_url:
-                with self.get_cursor() as cursor:
+                with self.get_read_cursor() as cursor:
                     cursor.execute('SELECT * FROM tg_accounts WHERE phone = %s', (phone,))
                     row = cursor.fetchone()
                     return dict(row) if row else None
             else:
-                with self.get_cursor() as cursor:
+                with self.get_read_cursor() as cursor:
                     cursor.execute('SELECT * FROM tg_accounts WHERE phone = ?', (phone,))
                     row = cursor.fetchone()
                     return dict(row) if row else None
@@ -1637,11 +2914,11 @@ class Database:
     def get_all_tg_accounts(self) -> List[Dict]:
         try:
             if self.db_url:
-                with self.get_cursor() as cursor:
+                with self.get_read_cursor() as cursor:
                     cursor.execute('SELECT * FROM tg_accounts ORDER BY added_at DESC')
                     return [dict(row) for row in cursor.fetchall()]
             else:
-                with self.get_cursor() as cursor:
+                with self.get_read_cursor() as cursor:
                     cursor.execute('SELECT * FROM tg_accounts ORDER BY added_at DESC')
                     return [dict(row) for row in cursor.fetchall()]
         except Exception as e:
@@ -1655,7 +2932,7 @@ class Database:
             if not account:
                 return False
             
-            # Удаляем файл сессии
+            # Удаляем старый файл сессии, если он остался
             session_path = os.path.join(SESSIONS_DIR, account['session_name'])
             if os.path.exists(f"{session_path}.session"):
                 os.remove(f"{session_path}.session")
@@ -1663,10 +2940,12 @@ class Database:
             
             if self.db_url:
                 with self.get_cursor() as cursor:
+                    cursor.execute('DELETE FROM tg_sessions WHERE phone = %s', (phone,))
                     cursor.execute('DELETE FROM tg_accounts WHERE phone = %s', (phone,))
                     return cursor.rowcount > 0
             else:
                 with self.get_cursor() as cursor:
+                    cursor.execute('DELETE FROM tg_sessions WHERE phone = ?', (phone,))
                     cursor.execute('DELETE FROM tg_accounts WHERE phone = ?', (phone,))
                     return cursor.rowcount > 0
         except Exception as e:
@@ -1711,49 +2990,123 @@ class Database:
         except Exception as e:
             logger.error(f"Ошибка установки кода {phone}: {e}")
     
-    def get_available_tg_account(self) -> Optional[Dict]:
+    def get_available_tg_accounts(self) -> List[Dict]:
+        """Аккаунты, пригодные для отправки кода, от давно использованных к свежим"""
         try:
-            if self.db_url:
-                with self.get_cursor() as cursor:
-                    cursor.execute('''
-                        SELECT * FROM tg_accounts 
-                        WHERE status = 'active' AND banned = 0 AND spam_block = 0
-                        ORDER BY last_used ASC
-                        LIMIT 1
-                    ''')
-                    row = cursor.fetchone()
-                    return dict(row) if row else None
-            else:
-                with self.get_cursor() as cursor:
-                    cursor.execute('''
-                        SELECT * FROM tg_accounts 
-                        WHERE status = 'active' AND banned = 0 AND spam_block = 0
-                        ORDER BY last_used ASC
-                        LIMIT 1
-                    ''')
-                    row = cursor.fetchone()
-                    return dict(row) if row else None
+            with self.get_read_cursor() as cursor:
+                cursor.execute('''
+                    SELECT phone, last_used FROM tg_accounts 
+                    WHERE status = 'active' AND banned = 0 AND spam_block = 0
+                    ORDER BY last_used ASC
+                ''')
+                return [dict(row) for row in cursor.fetchall()]
         except Exception as e:
-            logger.error(f"Ошибка получения доступного аккаунта: {e}")
-            return None
+            logger.error(f"Ошибка получения доступных аккаунтов: {e}")
+            return []
     
-    def log_session_action(self, phone: str, action: str, result: str, error: str = ""):
+    def touch_tg_account(self, phone: str):
+        """Отметка использования аккаунта"""
         try:
-            if self.db_url:
-                with self.get_cursor() as cursor:
-                    cursor.execute('''
-                        INSERT INTO session_logs (phone, action, result, error, created_at)
-                        VALUES (%s, %s, %s, %s, %s)
-                    ''', (phone, action, result, error, time.time()))
-            else:
-                with self.get_cursor() as cursor:
-                    cursor.execute('''
-                        INSERT INTO session_logs (phone, action, result, error, created_at)
-                        VALUES (?, ?, ?, ?, ?)
-                    ''', (phone, action, result, error, time.time()))
+            with self.get_cursor() as cursor:
+                if self.db_url:
+                    cursor.execute('UPDATE tg_accounts SET last_used = %s WHERE phone = %s', (time.time(), phone))
+                else:
+                    cursor.execute('UPDATE tg_accounts SET last_used = ? WHERE phone = ?', (time.time(), phone))
         except Exception as e:
-            logger.error(f"Ошибка логирования {phone}: {e}")
+            logger.error(f"Ошибка обновления last_used для {phone}: {e}")
     
+    def insert_session_logs(self, rows: List[Tuple]) -> int:
+        """Пакетная запись логов сессий: строки (phone, action, result, error, created_at)"""
+        if not rows:
+            return 0
+        if self.db_url:
+            with self.get_cursor() as cursor:
+                psycopg2.extras.execute_values(cursor, '''
+                    INSERT INTO session_logs (phone, action, result, error, created_at) VALUES %s
+                ''', rows, page_size=len(rows))
+        else:
+            with self.get_cursor() as cursor:
+                cursor.executemany('''
+                    INSERT INTO session_logs (phone, action, result, error, created_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', rows)
+        return len(rows)
+
+    def insert_system_logs(self, rows: List[Tuple]) -> int:
+        """Пакетная запись системных событий: строки (level, module, message, created_at)"""
+        if not rows:
+            return 0
+        if self.db_url:
+            with self.get_cursor() as cursor:
+                psycopg2.extras.execute_values(cursor, '''
+                    INSERT INTO system_logs (level, module, message, created_at) VALUES %s
+                ''', rows, page_size=len(rows))
+        else:
+            with self.get_cursor() as cursor:
+                cursor.executemany('''
+                    INSERT INTO system_logs (level, module, message, created_at)
+                    VALUES (?, ?, ?, ?)
+                ''', rows)
+        return len(rows)
+
+    def cleanup_session_logs(self, max_age: float = 7 * 24 * 3600) -> int:
+        """Удаление старых логов сессий"""
+        older_than = time.time() - max_age
+        if self.db_url:
+            with self.get_cursor() as cursor:
+                cursor.execute('DELETE FROM session_logs WHERE created_at < %s', (older_than,))
+                return cursor.rowcount
+        else:
+            with self.get_cursor() as cursor:
+                cursor.execute('DELETE FROM session_logs WHERE created_at < ?', (older_than,))
+                return cursor.rowcount
+
+    def add_pending_tg_account(self, phone: str, session_name: str, api_id: int, api_hash: str, added_by: int):
+        """Добавление аккаунта, ожидающего подтверждения кодом"""
+        if self.db_url:
+            with self.get_cursor() as cursor:
+                cursor.execute('''
+                    INSERT INTO tg_accounts
+                    (phone, session_name, api_id, api_hash, added_by, added_at, status)
+                    VALUES (%s, %s, %s, %s, %s, %s, 'pending')
+                ''', (phone, session_name, api_id, api_hash, added_by, time.time()))
+        else:
+            with self.get_cursor() as cursor:
+                cursor.execute('''
+                    INSERT INTO tg_accounts
+                    (phone, session_name, api_id, api_hash, added_by, added_at, status)
+                    VALUES (?, ?, ?, ?, ?, ?, 'pending')
+                ''', (phone, session_name, api_id, api_hash, added_by, time.time()))
+
+    def update_tg_account_profile(self, phone: str, first_name: str, last_name: str, username: str,
+                                  tg_user_id: int, has_2fa: bool = False):
+        """Сохранение профиля подтверждённого аккаунта и перевод в статус active"""
+        if self.db_url:
+            with self.get_cursor() as cursor:
+                cursor.execute('''
+                    UPDATE tg_accounts
+                    SET first_name = %s, last_name = %s, username = %s, user_id = %s,
+                        status = 'active', last_used = %s, has_2fa = GREATEST(has_2fa, %s)
+                    WHERE phone = %s
+                ''', (first_name, last_name, username, tg_user_id, time.time(), 1 if has_2fa else 0, phone))
+        else:
+            with self.get_cursor() as cursor:
+                cursor.execute('''
+                    UPDATE tg_accounts
+                    SET first_name = ?, last_name = ?, username = ?, user_id = ?,
+                        status = 'active', last_used = ?, has_2fa = MAX(has_2fa, ?)
+                    WHERE phone = ?
+                ''', (first_name, last_name, username, tg_user_id, time.time(), 1 if has_2fa else 0, phone))
+
+    def set_account_2fa(self, phone: str):
+        """Отметка, что у аккаунта есть 2FA"""
+        if self.db_url:
+            with self.get_cursor() as cursor:
+                cursor.execute('UPDATE tg_accounts SET has_2fa = 1 WHERE phone = %s', (phone,))
+        else:
+            with self.get_cursor() as cursor:
+                cursor.execute('UPDATE tg_accounts SET has_2fa = 1 WHERE phone = ?', (phone,))
+
     def set_account_owner(self, phone: str, owner_id: int, owner_username: str):
         try:
             if self.db_url:
@@ -1776,13 +3129,13 @@ class Database:
     def check_account_owner(self, phone: str) -> Tuple[bool, int]:
         try:
             if self.db_url:
-                with self.get_cursor() as cursor:
+                with self.get_read_cursor() as cursor:
                     cursor.execute('SELECT owner_id, owner_checked FROM tg_accounts WHERE phone = %s', (phone,))
                     row = cursor.fetchone()
                     if row and row['owner_checked'] and row['owner_id'] > 0:
                         return True, row['owner_id']
             else:
-                with self.get_cursor() as cursor:
+                with self.get_read_cursor() as cursor:
                     cursor.execute('SELECT owner_id, owner_checked FROM tg_accounts WHERE phone = ?', (phone,))
                     row = cursor.fetchone()
                     if row and row['owner_checked'] and row['owner_id'] > 0:
@@ -1792,16 +3145,262 @@ class Database:
             logger.error(f"Ошибка проверки владельца {phone}: {e}")
             return False, 0
     
+    def save_tg_session(self, phone: str, session_string: str):
+        """Сохранение строки сессии Pyrogram (в БД хранится только зашифрованной)"""
+        data = session_cipher.encrypt(session_string.encode()).decode()
+        with self.get_cursor() as cursor:
+            if self.db_url:
+                cursor.execute('''
+                    INSERT INTO tg_sessions (phone, session_data, updated_at) VALUES (%s, %s, %s)
+                    ON CONFLICT (phone) DO UPDATE SET session_data = EXCLUDED.session_data, updated_at = EXCLUDED.updated_at
+                ''', (phone, data, time.time()))
+            else:
+                cursor.execute('''
+                    INSERT INTO tg_sessions (phone, session_data, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT (phone) DO UPDATE SET session_data = EXCLUDED.session_data, updated_at = EXCLUDED.updated_at
+                ''', (phone, data, time.time()))
+    
+    def get_tg_session(self, phone: str) -> Optional[str]:
+        """Строка сессии Pyrogram для аккаунта (None - сессии нет или ключ не подходит)"""
+        try:
+            with self.get_read_cursor() as cursor:
+                if self.db_url:
+                    cursor.execute('SELECT session_data FROM tg_sessions WHERE phone = %s', (phone,))
+                else:
+                    cursor.execute('SELECT session_data FROM tg_sessions WHERE phone = ?', (phone,))
+                row = cursor.fetchone()
+            if not row:
+                return None
+            return session_cipher.decrypt(row['session_data'].encode()).decode()
+        except InvalidToken:
+            logger.error(f"❌ Сессия {phone} зашифрована другим ключом (SESSION_SECRET)")
+            return None
+        except Exception as e:
+            logger.error(f"Ошибка получения сессии {phone}: {e}")
+            return None
+    
+    def delete_tg_session(self, phone: str):
+        try:
+            with self.get_cursor() as cursor:
+                if self.db_url:
+                    cursor.execute('DELETE FROM tg_sessions WHERE phone = %s', (phone,))
+                else:
+                    cursor.execute('DELETE FROM tg_sessions WHERE phone = ?', (phone,))
+        except Exception as e:
+            logger.error(f"Ошибка удаления сессии {phone}: {e}")
+    
+    def get_tg_session_phones(self) -> set:
+        """Телефоны, для которых в БД есть сессия"""
+        try:
+            with self.get_read_cursor() as cursor:
+                cursor.execute('SELECT phone FROM tg_sessions')
+                return {row['phone'] for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"Ошибка получения списка сессий: {e}")
+            return set()
+    
+    def _reload_channels(self):
+        """Перечитывание каналов из БД и атомарная замена снимка"""
+        with self.get_read_cursor() as cursor:
+            cursor.execute('SELECT * FROM channels ORDER BY position, id')
+            self._channels = tuple(MappingProxyType(dict(row)) for row in cursor.fetchall())
+    
+    def get_all_channels(self) -> Tuple[MappingProxyType, ...]:
+        """Каналы подписки (из снимка в памяти, без запроса к БД)"""
+        return self._channels
+    
+    def get_channel(self, channel_id: str) -> Optional[MappingProxyType]:
+        return next((channel for channel in self._channels if channel['channel_id'] == channel_id), None)
+    
+    def add_channel(self, channel_id: str, channel_name: str, channel_url: str, invite_link: str,
+                    created_by: int, is_mandatory: bool = True) -> bool:
+        """Добавление канала подписки (не больше MAX_CHANNELS)"""
+        try:
+            with self._channels_lock:
+                if len(self._channels) >= MAX_CHANNELS or self.get_channel(channel_id):
+                    return False
+                with self.get_cursor() as cursor:
+                    if self.db_url:
+                        cursor.execute('''
+                            INSERT INTO channels
+                            (channel_id, channel_name, channel_url, invite_link, is_mandatory, position, created_at, created_by)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                        ''', (channel_id, channel_name, channel_url, invite_link,
+                              is_mandatory,
+                              len(self._channels), time.time(), created_by))
+                    else:
+                        cursor.execute('''
+                            INSERT INTO channels
+                            (channel_id, channel_name, channel_url, invite_link, is_mandatory, position, created_at, created_by)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                        ''', (channel_id, channel_name, channel_url, invite_link,
+                              int(is_mandatory),
+                              len(self._channels), time.time(), created_by))
+                self._reload_channels()
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка добавления канала {channel_id}: {e}")
+            return False
+    
+    def delete_channel(self, channel_id: str) -> bool:
+        """Удаление канала подписки вместе с его индексом подписок"""
+        try:
+            with self._channels_lock:
+                with self.get_cursor() as cursor:
+                    if self.db_url:
+                        cursor.execute('DELETE FROM channel_members WHERE channel_id = %s', (channel_id,))
+                        cursor.execute('DELETE FROM channels WHERE channel_id = %s', (channel_id,))
+                    else:
+                        cursor.execute('DELETE FROM channel_members WHERE channel_id = ?', (channel_id,))
+                        cursor.execute('DELETE FROM channels WHERE channel_id = ?', (channel_id,))
+                    deleted = cursor.rowcount > 0
+                self._reload_channels()
+            return deleted
+        except Exception as e:
+            logger.error(f"Ошибка удаления канала {channel_id}: {e}")
+            return False
+    
+    def toggle_channel_mandatory(self, channel_id: str) -> Optional[bool]:
+        """Переключение обязательности подписки; возвращает новое значение (None - канал не найден)"""
+        try:
+            with self._channels_lock:
+                with self.get_cursor() as cursor:
+                    if self.db_url:
+                        cursor.execute('''
+                            UPDATE channels SET is_mandatory = NOT is_mandatory
+                            WHERE channel_id = %s
+                            RETURNING is_mandatory
+                        ''', (channel_id,))
+                    else:
+                        cursor.execute('''
+                            UPDATE channels SET is_mandatory = NOT is_mandatory
+                            WHERE channel_id = ?
+                            RETURNING is_mandatory
+                        ''', (channel_id,))
+                    row = cursor.fetchone()
+                self._reload_channels()
+            return bool(row['is_mandatory']) if row else None
+        except Exception as e:
+            logger.error(f"Ошибка изменения канала {channel_id}: {e}")
+            return None
+    
+    def set_channel_member(self, channel_id: str, user_id: int, is_member: bool):
+        """Запись подписки пользователя на канал в индекс"""
+        try:
+            with self.get_cursor() as cursor:
+                if self.db_url:
+                    cursor.execute('''
+                        INSERT INTO channel_members (channel_id, user_id, is_member, updated_at) VALUES (%s, %s, %s, %s)
+                        ON CONFLICT (channel_id, user_id) DO UPDATE SET is_member = EXCLUDED.is_member, updated_at = EXCLUDED.updated_at
+                    ''', (channel_id, user_id, int(is_member), time.time()))
+                else:
+                    cursor.execute('''
+                        INSERT INTO channel_members (channel_id, user_id, is_member, updated_at) VALUES (?, ?, ?, ?)
+                        ON CONFLICT (channel_id, user_id) DO UPDATE SET is_member = EXCLUDED.is_member, updated_at = EXCLUDED.updated_at
+                    ''', (channel_id, user_id, int(is_member), time.time()))
+        except Exception as e:
+            logger.error(f"Ошибка записи подписки {user_id} на {channel_id}: {e}")
+    
+    def get_channel_members(self, channel_ids: List[str]) -> List[Dict]:
+        """Индекс подписок для набора каналов"""
+        if not channel_ids:
+            return []
+        try:
+            with self.get_read_cursor() as cursor:
+                if self.db_url:
+                    cursor.execute('SELECT channel_id, user_id, is_member FROM channel_members WHERE channel_id = ANY(%s)',
+                                   (list(channel_ids),))
+                else:
+                    placeholders = ','.join('?' * len(channel_ids))
+                    cursor.execute(f'SELECT channel_id, user_id, is_member FROM channel_members WHERE channel_id IN ({placeholders})',
+                                   tuple(channel_ids))
+                return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Ошибка получения индекса подписок: {e}")
+            return []
+    
+    def save_pending_login(self, phone: str, stage: str, info: Dict):
+        """Сохранение незавершённого входа (stage: code или 2fa)"""
+        try:
+            with self.get_cursor() as cursor:
+                if self.db_url:
+                    cursor.execute('''
+                        INSERT INTO pending_logins
+                        (phone, stage, action, number_id, user_id, phone_code_hash, session_name, created_at, updated_at)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                        ON CONFLICT (phone) DO UPDATE SET stage = EXCLUDED.stage, action = EXCLUDED.action,
+                            number_id = EXCLUDED.number_id, user_id = EXCLUDED.user_id,
+                            phone_code_hash = EXCLUDED.phone_code_hash, session_name = EXCLUDED.session_name,
+                            created_at = EXCLUDED.created_at, updated_at = EXCLUDED.updated_at
+                    ''', (phone, stage, info.get('action'), info.get('number_id'), info.get('user_id'),
+                          info.get('phone_code_hash'), info.get('session_name'), info['timestamp'], time.time()))
+                else:
+                    cursor.execute('''
+                        INSERT INTO pending_logins
+                        (phone, stage, action, number_id, user_id, phone_code_hash, session_name, created_at, updated_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (phone) DO UPDATE SET stage = EXCLUDED.stage, action = EXCLUDED.action,
+                            number_id = EXCLUDED.number_id, user_id = EXCLUDED.user_id,
+                            phone_code_hash = EXCLUDED.phone_code_hash, session_name = EXCLUDED.session_name,
+                            created_at = EXCLUDED.created_at, updated_at = EXCLUDED.updated_at
+                    ''', (phone, stage, info.get('action'), info.get('number_id'), info.get('user_id'),
+                          info.get('phone_code_hash'), info.get('session_name'), info['timestamp'], time.time()))
+        except Exception as e:
+            logger.error(f"Ошибка сохранения ожидающего входа {phone}: {e}")
+    
+    def delete_pending_login(self, phone: str):
+        """Удаление завершённого или просроченного входа"""
+        try:
+            with self.get_cursor() as cursor:
+                if self.db_url:
+                    cursor.execute('DELETE FROM pending_logins WHERE phone = %s', (phone,))
+                else:
+                    cursor.execute('DELETE FROM pending_logins WHERE phone = ?', (phone,))
+        except Exception as e:
+            logger.error(f"Ошибка удаления ожидающего входа {phone}: {e}")
+    
+    def get_pending_logins(self) -> List[Dict]:
+        """Все незавершённые входы"""
+        try:
+            with self.get_read_cursor() as cursor:
+                cursor.execute('SELECT * FROM pending_logins ORDER BY created_at')
+                return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Ошибка получения ожидающих входов: {e}")
+            return []
+    
+    def get_account_owners(self, phones: List[str]) -> Dict[str, int]:
+        """Владельцы для набора аккаунтов одним запросом: phone -> owner_id (только аккаунты с владельцем)"""
+        if not phones:
+            return {}
+        try:
+            with self.get_read_cursor() as cursor:
+                if self.db_url:
+                    cursor.execute('''
+                        SELECT phone, owner_id FROM tg_accounts
+                        WHERE phone = ANY(%s) AND owner_checked = 1 AND owner_id > 0
+                    ''', (list(phones),))
+                else:
+                    placeholders = ','.join('?' * len(phones))
+                    cursor.execute(f'''
+                        SELECT phone, owner_id FROM tg_accounts
+                        WHERE phone IN ({placeholders}) AND owner_checked = 1 AND owner_id > 0
+                    ''', tuple(phones))
+                return {row['phone']: row['owner_id'] for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"Ошибка проверки владельцев аккаунтов: {e}")
+            return {}
+    
     def account_has_2fa(self, phone: str) -> bool:
         """Проверка, есть ли у аккаунта 2FA"""
         try:
             if self.db_url:
-                with self.get_cursor() as cursor:
+                with self.get_read_cursor() as cursor:
                     cursor.execute('SELECT has_2fa FROM tg_accounts WHERE phone = %s', (phone,))
                     row = cursor.fetchone()
                     return bool(row and row['has_2fa'])
             else:
-                with self.get_cursor() as cursor:
+                with self.get_read_cursor() as cursor:
                     cursor.execute('SELECT has_2fa FROM tg_accounts WHERE phone = ?', (phone,))
                     row = cursor.fetchone()
                     return bool(row and row['has_2fa'])
@@ -1843,61 +3442,82 @@ class Database:
             logger.error(f"❌ Ошибка добавления номера {phone}: {e}")
             return False
     
-    def get_available_numbers(self, page: int = 1, limit: int = 5) -> Tuple[List[Dict], int]:
-        offset = (page - 1) * limit
-        cache_key = f'numbers_{page}_{limit}'
+    def get_available_numbers(self, limit: int = 5, after: Tuple[int, int] = None,
+                              before: Tuple[int, int] = None, start: Tuple[int, int] = None) -> Tuple[List[Dict], bool]:
+        """Страница доступных номеров по ключу (price_stars, id), без OFFSET.
+        after/before/start - позиция (price_stars, id): после неё, до неё, начиная с неё.
+        Возвращает номера по возрастанию цены и признак, что в направлении чтения есть ещё"""
+        cache_key = (limit, after, before, start)
         
-        if cache_key in self.cache:
-            cached, timestamp = self.cache[cache_key]
-            if time.time() - timestamp < CACHE_TTL:
-                return cached
+        cached = self.cache.get('numbers', cache_key)
+        if cached is not None:
+            return cached
+        
+        # Условие по ключу; у первой страницы его нет
+        if before is not None:
+            keyset, params, order = ' AND (price_stars, id) < ({p}, {p})', before, 'price_stars DESC, id DESC'
+        elif after is not None:
+            keyset, params, order = ' AND (price_stars, id) > ({p}, {p})', after, 'price_stars ASC, id ASC'
+        elif start is not None:
+            keyset, params, order = ' AND (price_stars, id) >= ({p}, {p})', start, 'price_stars ASC, id ASC'
+        else:
+            keyset, params, order = '', (), 'price_stars ASC, id ASC'
         
         try:
             if self.db_url:
-                with self.get_cursor() as cursor:
-                    cursor.execute('SELECT COUNT(*) as count FROM numbers WHERE status = %s', ('available',))
-                    total = cursor.fetchone()['count']
-                    
-                    cursor.execute('''
+                with self.get_read_cursor() as cursor:
+                    cursor.execute(f'''
                         SELECT * FROM numbers 
-                        WHERE status = %s 
-                        ORDER BY price_stars ASC 
-                        LIMIT %s OFFSET %s
-                    ''', ('available', limit, offset))
-                    
-                    numbers = [dict(row) for row in cursor.fetchall()]
-                    result = (numbers, total)
-                    self.cache[cache_key] = (result, time.time())
-                    return result
+                        WHERE status = %s{keyset.format(p='%s')}
+                        ORDER BY {order} 
+                        LIMIT %s
+                    ''', ('available', *params, limit + 1))
+                    rows = [dict(row) for row in cursor.fetchall()]
             else:
-                with self.get_cursor() as cursor:
-                    cursor.execute("SELECT COUNT(*) as count FROM numbers WHERE status = 'available'")
-                    total = cursor.fetchone()['count']
-                    
-                    cursor.execute('''
+                with self.get_read_cursor() as cursor:
+                    cursor.execute(f'''
                         SELECT * FROM numbers 
-                        WHERE status = 'available' 
-                        ORDER BY price_stars ASC 
-                        LIMIT ? OFFSET ?
-                    ''', (limit, offset))
-                    
-                    numbers = [dict(row) for row in cursor.fetchall()]
-                    result = (numbers, total)
-                    self.cache[cache_key] = (result, time.time())
-                    return result
+                        WHERE status = 'available'{keyset.format(p='?')}
+                        ORDER BY {order} 
+                        LIMIT ?
+                    ''', (*params, limit + 1))
+                    rows = [dict(row) for row in cursor.fetchall()]
+            
+            has_more = len(rows) > limit
+            numbers = rows[:limit]
+            if before is not None:
+                numbers.reverse()
+            
+            result = (numbers, has_more)
+            self.cache.set('numbers', cache_key, result)
+            return result
         except Exception as e:
             logger.error(f"Ошибка получения номеров: {e}")
-            return [], 0
+            return [], False
+    
+    def get_available_numbers_count(self) -> int:
+        """Количество доступных номеров (из счётчиков shop_counters)"""
+        try:
+            with self.get_read_cursor() as cursor:
+                if self.db_url:
+                    cursor.execute('SELECT value FROM shop_counters WHERE name = %s', ('numbers_available',))
+                else:
+                    cursor.execute('SELECT value FROM shop_counters WHERE name = ?', ('numbers_available',))
+                row = cursor.fetchone()
+                return row['value'] if row else 0
+        except Exception as e:
+            logger.error(f"Ошибка получения количества номеров: {e}")
+            return 0
     
     def get_number(self, number_id: int) -> Optional[Dict]:
         try:
             if self.db_url:
-                with self.get_cursor() as cursor:
+                with self.get_read_cursor() as cursor:
                     cursor.execute('SELECT * FROM numbers WHERE id = %s', (number_id,))
                     row = cursor.fetchone()
                     return dict(row) if row else None
             else:
-                with self.get_cursor() as cursor:
+                with self.get_read_cursor() as cursor:
                     cursor.execute('SELECT * FROM numbers WHERE id = ?', (number_id,))
                     row = cursor.fetchone()
                     return dict(row) if row else None
@@ -1905,6 +3525,21 @@ class Database:
             logger.error(f"Ошибка получения номера {number_id}: {e}")
             return None
     
+    def get_recent_numbers(self, limit: int = 20) -> List[Dict]:
+        """Последние добавленные номера (для админки)"""
+        try:
+            if self.db_url:
+                with self.get_read_cursor() as cursor:
+                    cursor.execute('SELECT * FROM numbers ORDER BY id DESC LIMIT %s', (limit,))
+                    return [dict(row) for row in cursor.fetchall()]
+            else:
+                with self.get_read_cursor() as cursor:
+                    cursor.execute('SELECT * FROM numbers ORDER BY id DESC LIMIT ?', (limit,))
+                    return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Ошибка получения номеров: {e}")
+            return []
+    
     def delete_number(self, number_id: int) -> bool:
         """Удаление номера из продажи"""
         try:
@@ -1913,82 +3548,245 @@ class Database:
                     cursor.execute('DELETE FROM numbers WHERE id = %s', (number_id,))
                     if cursor.rowcount > 0:
                         logger.info(f"✅ Номер {number_id} удален из магазина")
-                        self.cache = {k: v for k, v in self.cache.items() if not k.startswith('numbers_')}
+                        self.cache.invalidate('numbers')
                         return True
             else:
                 with self.get_cursor() as cursor:
                     cursor.execute('DELETE FROM numbers WHERE id = ?', (number_id,))
                     if cursor.rowcount > 0:
                         logger.info(f"✅ Номер {number_id} удален из магазина")
-                        self.cache = {k: v for k, v in self.cache.items() if not k.startswith('numbers_')}
+                        self.cache.invalidate('numbers')
                         return True
             return False
         except Exception as e:
-            logger.error(f"❌ Ошибка удаления номера {number_id}: {e}")
+            logger.error(f"❌ Ошибка удаления номера {number_id}: {e}")
+            return False
+    
+    def _reserve_number(self, cursor, number_id: int, user_id: int) -> Optional[Dict]:
+        """Условный перевод номера available (или held этим же покупателем) -> pending
+        (внутри транзакции). Из параллельных покупателей строку получает только один"""
+        if self.db_url:
+            cursor.execute('''
+                UPDATE numbers 
+                SET status = 'pending', sold_to = %s, sold_at = %s
+                WHERE id = %s AND (
+                    status = 'available'
+                    OR (status = 'held' AND EXISTS (
+                        SELECT 1 FROM number_holds h WHERE h.number_id = numbers.id AND h.user_id = %s
+                    ))
+                )
+                RETURNING *
+            ''', (user_id, time.time(), number_id, user_id))
+        else:
+            cursor.execute('''
+                UPDATE numbers 
+                SET status = 'pending', sold_to = ?, sold_at = ?
+                WHERE id = ? AND (
+                    status = 'available'
+                    OR (status = 'held' AND EXISTS (
+                        SELECT 1 FROM number_holds h WHERE h.number_id = numbers.id AND h.user_id = ?
+                    ))
+                )
+                RETURNING *
+            ''', (user_id, time.time(), number_id, user_id))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        number = dict(row)
+        if self.db_url:
+            cursor.execute('DELETE FROM number_holds WHERE number_id = %s', (number_id,))
+        else:
+            cursor.execute('DELETE FROM number_holds WHERE number_id = ?', (number_id,))
+        return number
+
+    def hold_number(self, number_id: int, user_id: int, ttl: int) -> Optional[Dict]:
+        """Бронь номера за покупателем на время внешней оплаты (available -> held).
+        Повторная бронь тем же покупателем продлевает её. None - номер недоступен"""
+        now = time.time()
+        try:
+            with self.get_cursor() as cursor:
+                if self.db_url:
+                    cursor.execute('''
+                        UPDATE numbers SET status = 'held'
+                        WHERE id = %s AND status = 'available'
+                        RETURNING *
+                    ''', (number_id,))
+                else:
+                    cursor.execute('''
+                        UPDATE numbers SET status = 'held'
+                        WHERE id = ? AND status = 'available'
+                        RETURNING *
+                    ''', (number_id,))
+                row = cursor.fetchone()
+                if row:
+                    if self.db_url:
+                        cursor.execute('''
+                            INSERT INTO number_holds (number_id, user_id, payment_id, created_at, expires_at)
+                            VALUES (%s, %s, NULL, %s, %s)
+                            ON CONFLICT (number_id) DO UPDATE SET user_id = EXCLUDED.user_id,
+                                payment_id = NULL, created_at = EXCLUDED.created_at, expires_at = EXCLUDED.expires_at
+                        ''', (number_id, user_id, now, now + ttl))
+                    else:
+                        cursor.execute('''
+                            INSERT INTO number_holds (number_id, user_id, payment_id, created_at, expires_at)
+                            VALUES (?, ?, NULL, ?, ?)
+                            ON CONFLICT (number_id) DO UPDATE SET user_id = EXCLUDED.user_id,
+                                payment_id = NULL, created_at = EXCLUDED.created_at, expires_at = EXCLUDED.expires_at
+                        ''', (number_id, user_id, now, now + ttl))
+                else:
+                    # Уже забронирован - продлеваем, только если бронь наша
+                    if self.db_url:
+                        cursor.execute('''
+                            UPDATE number_holds SET expires_at = %s
+                            WHERE number_id = %s AND user_id = %s
+                        ''', (now + ttl, number_id, user_id))
+                    else:
+                        cursor.execute('''
+                            UPDATE number_holds SET expires_at = ?
+                            WHERE number_id = ? AND user_id = ?
+                        ''', (now + ttl, number_id, user_id))
+                    if cursor.rowcount == 0:
+                        return None
+                    if self.db_url:
+                        cursor.execute("SELECT * FROM numbers WHERE id = %s AND status = 'held'", (number_id,))
+                    else:
+                        cursor.execute("SELECT * FROM numbers WHERE id = ? AND status = 'held'", (number_id,))
+                    row = cursor.fetchone()
+                    if not row:
+                        return None
+            
+            self.cache.invalidate('numbers')
+            return dict(row)
+        except Exception as e:
+            logger.error(f"Ошибка брони номера {number_id}: {e}")
+            return None
+
+    def attach_hold_payment(self, number_id: int, user_id: int, payment_id: str) -> bool:
+        """Привязка созданного платежа к брони"""
+        try:
+            with self.get_cursor() as cursor:
+                if self.db_url:
+                    cursor.execute('''
+                        UPDATE number_holds SET payment_id = %s WHERE number_id = %s AND user_id = %s
+                    ''', (payment_id, number_id, user_id))
+                else:
+                    cursor.execute('''
+                        UPDATE number_holds SET payment_id = ? WHERE number_id = ? AND user_id = ?
+                    ''', (payment_id, number_id, user_id))
+                return cursor.rowcount > 0
+        except Exception as e:
+            logger.error(f"Ошибка привязки платежа к брони {number_id}: {e}")
+            return False
+
+    def release_hold(self, number_id: int, user_id: int = None) -> bool:
+        """Снятие брони (held -> available); user_id - снять только свою бронь"""
+        try:
+            with self.get_cursor() as cursor:
+                if self.db_url:
+                    if user_id is None:
+                        cursor.execute('DELETE FROM number_holds WHERE number_id = %s', (number_id,))
+                    else:
+                        cursor.execute('DELETE FROM number_holds WHERE number_id = %s AND user_id = %s',
+                                       (number_id, user_id))
+                else:
+                    if user_id is None:
+                        cursor.execute('DELETE FROM number_holds WHERE number_id = ?', (number_id,))
+                    else:
+                        cursor.execute('DELETE FROM number_holds WHERE number_id = ? AND user_id = ?',
+                                       (number_id, user_id))
+                if cursor.rowcount == 0:
+                    return False
+                if self.db_url:
+                    cursor.execute("UPDATE numbers SET status = 'available' WHERE id = %s AND status = 'held'",
+                                   (number_id,))
+                else:
+                    cursor.execute("UPDATE numbers SET status = 'available' WHERE id = ? AND status = 'held'",
+                                   (number_id,))
+            self.cache.invalidate('numbers')
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка снятия брони {number_id}: {e}")
             return False
-    
-    def purchase_number(self, number_id: int, user_id: int) -> Optional[Dict]:
+
+    def sweep_number_holds(self) -> int:
+        """Освобождение просроченных броней, возвращает количество вернувшихся в продажу номеров"""
+        now = time.time()
         try:
-            if self.db_url:
-                with self.get_cursor() as cursor:
-                    cursor.execute('SELECT * FROM numbers WHERE id = %s AND status = %s', 
-                                 (number_id, 'available'))
-                    number = cursor.fetchone()
-                    if not number:
-                        return None
-                    number = dict(number)
-                    
-                    cursor.execute('SELECT stars_balance FROM users WHERE user_id = %s', (user_id,))
-                    user = cursor.fetchone()
-                    if not user or user['stars_balance'] < number['price_stars']:
-                        return None
-                    
-                    cursor.execute('UPDATE users SET stars_balance = stars_balance - %s WHERE user_id = %s', 
-                                 (number['price_stars'], user_id))
-                    
+            with self.get_cursor() as cursor:
+                if self.db_url:
                     cursor.execute('''
-                        UPDATE numbers 
-                        SET status = 'pending', sold_to = %s, sold_at = %s
-                        WHERE id = %s
-                    ''', (user_id, time.time(), number_id))
-                    
+                        UPDATE numbers SET status = 'available'
+                        WHERE status = 'held' AND id IN (
+                            SELECT number_id FROM number_holds WHERE expires_at < %s
+                        )
+                    ''', (now,))
+                else:
+                    cursor.execute('''
+                        UPDATE numbers SET status = 'available'
+                        WHERE status = 'held' AND id IN (
+                            SELECT number_id FROM number_holds WHERE expires_at < ?
+                        )
+                    ''', (now,))
+                released = cursor.rowcount
+                if self.db_url:
+                    cursor.execute('DELETE FROM number_holds WHERE expires_at < %s', (now,))
+                else:
+                    cursor.execute('DELETE FROM number_holds WHERE expires_at < ?', (now,))
+            if released:
+                self.cache.invalidate('numbers')
+            return released
+        except Exception as e:
+            logger.error(f"Ошибка освобождения броней: {e}")
+            return 0
+
+    def _charge_stars(self, cursor, user_id: int, amount: int) -> Optional[int]:
+        """Условное списание звёзд (внутри транзакции): не уходит в минус,
+        возвращает новый баланс или None при нехватке"""
+        if self.db_url:
+            cursor.execute('''
+                UPDATE users SET stars_balance = stars_balance - %s
+                WHERE user_id = %s AND stars_balance >= %s
+                RETURNING stars_balance
+            ''', (amount, user_id, amount))
+        else:
+            cursor.execute('''
+                UPDATE users SET stars_balance = stars_balance - ?
+                WHERE user_id = ? AND stars_balance >= ?
+                RETURNING stars_balance
+            ''', (amount, user_id, amount))
+        row = cursor.fetchone()
+        return row['stars_balance'] if row else None
+
+    def purchase_number(self, number_id: int, user_id: int, charge: bool = True) -> Optional[Dict]:
+        """Атомарная покупка номера за звёзды: резерв номера, списание и транзакция
+        в одной транзакции БД; при любой неудаче ничего не меняется"""
+        try:
+            with self.get_cursor() as cursor:
+                number = self._reserve_number(cursor, number_id, user_id)
+                if not number:
+                    return None
+                
+                if charge and self._charge_stars(cursor, user_id, number['price_stars']) is None:
+                    raise RollbackTransaction(None)
+                
+                if self.db_url:
                     cursor.execute('''
                         INSERT INTO transactions (user_id, number_id, amount_stars, status, created_at)
                         VALUES (%s, %s, %s, 'pending', %s)
                     ''', (user_id, number_id, number['price_stars'], time.time()))
-            else:
-                with self.get_cursor() as cursor:
-                    cursor.execute('SELECT * FROM numbers WHERE id = ? AND status = "available"', (number_id,))
-                    number = cursor.fetchone()
-                    if not number:
-                        return None
-                    number = dict(number)
-                    
-                    cursor.execute('SELECT stars_balance FROM users WHERE user_id = ?', (user_id,))
-                    user = cursor.fetchone()
-                    if not user or user['stars_balance'] < number['price_stars']:
-                        return None
-                    
-                    cursor.execute('UPDATE users SET stars_balance = stars_balance - ? WHERE user_id = ?', 
-                                 (number['price_stars'], user_id))
-                    
-                    cursor.execute('''
-                        UPDATE numbers 
-                        SET status = 'pending', sold_to = ?, sold_at = ?
-                        WHERE id = ?
-                    ''', (user_id, time.time(), number_id))
-                    
+                else:
                     cursor.execute('''
                         INSERT INTO transactions (user_id, number_id, amount_stars, status, created_at)
                         VALUES (?, ?, ?, 'pending', ?)
                     ''', (user_id, number_id, number['price_stars'], time.time()))
             
-            self.cache = {k: v for k, v in self.cache.items() if not k.startswith('numbers_')}
-            if f'user_{user_id}' in self.cache:
-                del self.cache[f'user_{user_id}']
+            self.cache.invalidate('numbers')
+            self.cache.delete('user', user_id)
             
             return number
             
+        except RollbackTransaction:
+            return None
         except Exception as e:
             logger.error(f"Ошибка покупки {number_id}: {e}")
             return None
@@ -2024,14 +3822,14 @@ class Database:
                                  (number_id, 'sold'))
                     if cursor.rowcount > 0:
                         logger.info(f"✅ Номер {number_id} удален из магазина")
-                        self.cache = {k: v for k, v in self.cache.items() if not k.startswith('numbers_')}
+                        self.cache.invalidate('numbers')
                         return True
             else:
                 with self.get_cursor() as cursor:
                     cursor.execute('DELETE FROM numbers WHERE id = ? AND status = "sold"', (number_id,))
                     if cursor.rowcount > 0:
                         logger.info(f"✅ Номер {number_id} удален из магазина")
-                        self.cache = {k: v for k, v in self.cache.items() if not k.startswith('numbers_')}
+                        self.cache.invalidate('numbers')
                         return True
             return False
         except Exception as e:
@@ -2039,64 +3837,28 @@ class Database:
             return False
     
     def get_stats(self) -> Dict:
+        """Статистика магазина - одно чтение из shop_counters"""
         try:
-            if self.db_url:
-                with self.get_cursor() as cursor:
-                    cursor.execute('SELECT COUNT(*) as count FROM users')
-                    total_users = cursor.fetchone()['count']
-                    
-                    cursor.execute("SELECT COUNT(*) as count FROM numbers WHERE status = 'available'")
-                    available_numbers = cursor.fetchone()['count']
-                    
-                    cursor.execute("SELECT COUNT(*) as count FROM numbers WHERE status = 'sold'")
-                    sold_numbers = cursor.fetchone()['count']
-                    
-                    cursor.execute("SELECT COUNT(*) as count FROM numbers WHERE status = 'pending'")
-                    pending_numbers = cursor.fetchone()['count']
-                    
-                    cursor.execute('SELECT COUNT(*) as count FROM tg_accounts')
-                    total_accounts = cursor.fetchone()['count']
-                    
-                    cursor.execute("SELECT COUNT(*) as count FROM tg_accounts WHERE status = 'active'")
-                    active_accounts = cursor.fetchone()['count']
-                    
-                    cursor.execute('SELECT COUNT(*) as count FROM channels')
-                    total_channels = cursor.fetchone()['count'] or 0
-                    
-                    cursor.execute('SELECT SUM(amount_stars) as total FROM transactions WHERE status = %s', 
-                                 ('completed',))
-                    total_stars_sold = cursor.fetchone()['total'] or 0
-            else:
-                with self.get_cursor() as cursor:
-                    cursor.execute('SELECT COUNT(*) as count FROM users')
-                    total_users = cursor.fetchone()['count']
-                    
-                    cursor.execute("SELECT COUNT(*) as count FROM numbers WHERE status = 'available'")
-                    available_numbers = cursor.fetchone()['count']
-                    
-                    cursor.execute("SELECT COUNT(*) as count FROM numbers WHERE status = 'sold'")
-                    sold_numbers = cursor.fetchone()['count']
-                    
-                    cursor.execute("SELECT COUNT(*) as count FROM numbers WHERE status = 'pending'")
-                    pending_numbers = cursor.fetchone()['count']
-                    
-                    cursor.execute('SELECT COUNT(*) as count FROM tg_accounts')
-                    total_accounts = cursor.fetchone()['count']
-                    
-                    cursor.execute("SELECT COUNT(*) as count FROM tg_accounts WHERE status = 'active'")
-                    active_accounts = cursor.fetchone()['count']
-                    
-                    cursor.execute('SELECT COUNT(*) as count FROM channels')
-                    total_channels = cursor.fetchone()['count'] or 0
-                    
-                    cursor.execute('SELECT SUM(amount_stars) as total FROM transactions WHERE status = "completed"')
-                    total_stars_sold = cursor.fetchone()['total'] or 0
+            with self.get_read_cursor() as cursor:
+                cursor.execute('SELECT name, value FROM shop_counters')
+                counters = {row['name']: row['value'] or 0 for row in cursor.fetchall()}
+            
+            total_users = counters.get('users_total', 0)
+            available_numbers = counters.get('numbers_available', 0)
+            sold_numbers = counters.get('numbers_sold', 0)
+            pending_numbers = counters.get('numbers_pending', 0)
+            held_numbers = counters.get('numbers_held', 0)
+            total_accounts = counters.get('accounts_total', 0)
+            active_accounts = counters.get('accounts_active', 0)
+            total_channels = counters.get('channels_total', 0)
+            total_stars_sold = counters.get('stars_sold', 0)
             
             return {
                 'total_users': total_users,
                 'available_numbers': available_numbers,
                 'sold_numbers': sold_numbers,
                 'pending_numbers': pending_numbers,
+                'held_numbers': held_numbers,
                 'total_accounts': total_accounts,
                 'active_accounts': active_accounts,
                 'total_channels': total_channels,
@@ -2110,6 +3872,7 @@ class Database:
                 'available_numbers': 0,
                 'sold_numbers': 0,
                 'pending_numbers': 0,
+                'held_numbers': 0,
                 'total_accounts': 0,
                 'active_accounts': 0,
                 'total_channels': 0,
@@ -2117,86 +3880,694 @@ class Database:
                 'total_revenue_rub': 0
             }
 
+    def reconcile_stats(self) -> Dict[str, int]:
+        """Пересчёт shop_counters из исходных таблиц; возвращает исправленные расхождения.
+        Счётчики и пересчёт читаются из одного снимка без блокировок, затем короткой
+        транзакцией применяются только разницы - записи, сделанные после снимка, не теряются"""
+        try:
+            with self.get_read_cursor() as cursor:
+                # Один снимок: счётчики и агрегаты видят одни и те же закоммиченные записи
+                if self.db_url:
+                    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+                else:
+                    cursor.execute('BEGIN')
+                try:
+                    cursor.execute('SELECT name, value FROM shop_counters')
+                    current = {row['name']: row['value'] or 0 for row in cursor.fetchall()}
+                    
+                    cursor.execute(self.COUNTERS_RECONCILE_SQL)
+                    actual = {row['name']: int(row['value'] or 0) for row in cursor.fetchall()}
+                finally:
+                    if not self.db_url:
+                        cursor.connection.rollback()
+            
+            drift = {name: actual.get(name, 0) - current.get(name, 0)
+                     for name in set(current) | set(actual)
+                     if actual.get(name, 0) != current.get(name, 0)}
+            if drift:
+                # Прибавляем разницу к текущему значению: триггеры тем временем могли его изменить
+                with self.get_cursor() as cursor:
+                    if self.db_url:
+                        psycopg2.extras.execute_values(cursor, '''
+                            INSERT INTO shop_counters (name, value) VALUES %s
+                            ON CONFLICT (name) DO UPDATE SET value = shop_counters.value + EXCLUDED.value
+                        ''', list(drift.items()))
+                    else:
+                        cursor.executemany('''
+                            INSERT INTO shop_counters (name, value) VALUES (?, ?)
+                            ON CONFLICT (name) DO UPDATE SET value = shop_counters.value + excluded.value
+                        ''', list(drift.items()))
+                logger.info(f"🔁 Счётчики статистики пересчитаны, расхождения: {drift}")
+            return drift
+        except Exception as e:
+            logger.error(f"❌ Ошибка сверки счётчиков статистики: {e}")
+            return {}
+
+class AsyncDatabase:
+    """Асинхронный доступ к Database: запросы выполняются в отдельном ограниченном пуле потоков,
+    чтобы не блокировать цикл событий (polling, pyrogram, веб-сервер)"""
+
+    def __init__(self, database: Database, max_workers: int):
+        self._db = database
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+
+        async def method(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+
+        method.__name__ = name
+        # Кэшируем обёртку, чтобы __getattr__ больше не вызывался для этого метода
+        self.__dict__[name] = method
+        return method
+
+    async def run(self, func, *args, **kwargs):
+        """Выполнение синхронной функции работы с БД в пуле потоков
+        (в контексте вызывающего, чтобы запросы учитывались в трассировке апдейта)"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(copy_context().run, func, *args, **kwargs))
+
+    def shutdown(self, wait: bool = True):
+        """Остановка пула потоков (ещё не начатые запросы отменяет, начатые при wait=True дожидается)"""
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+class LogSink:
+    """Буферизованная запись session_logs и system_logs: события копятся в очереди
+    и сбрасываются фоновой задачей пакетными INSERT"""
+
+    TABLES = {
+        'session_logs': 'insert_session_logs',
+        'system_logs': 'insert_system_logs',
+    }
+
+    def __init__(self, database: AsyncDatabase, flush_interval: float, batch_size: int, queue_size: int):
+        self._db = database
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.stats = {'queued': 0, 'written': 0, 'batches': 0, 'failed': 0, 'blocked': 0}
+
+    def start(self):
+        """Запуск фоновой задачи (вызывается из on_startup, внутри цикла событий)"""
+        if self._task is None:
+            self._stopping = False
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._task = asyncio.create_task(self._run())
+
+    async def put(self, table: str, row: Tuple):
+        """Постановка строки в очередь; если очередь заполнена - ждём (backpressure)"""
+        if self._queue is None:
+            # Буфер ещё не запущен или уже остановлен - пишем сразу
+            await self._write({table: [row]})
+            return
+        if self._queue.full():
+            self.stats['blocked'] += 1
+        await self._queue.put((table, row))
+        self.stats['queued'] += 1
+
+    async def session(self, phone: str, action: str, result: str, error: str = ""):
+        """Событие сессии Telegram аккаунта"""
+        await self.put('session_logs', (phone, action, result, error, time.time()))
+
+    async def system(self, level: str, module: str, message: str):
+        """Структурированное системное событие"""
+        await self.put('system_logs', (level, module, message, time.time()))
+
+    def _drain(self) -> Dict[str, List[Tuple]]:
+        """Забирает из очереди до batch_size строк, сгруппированных по таблицам"""
+        batch = defaultdict(list)
+        count = 0
+        while count < self.batch_size and not self._queue.empty():
+            table, row = self._queue.get_nowait()
+            batch[table].append(row)
+            count += 1
+        return batch
+
+    async def _write(self, batch: Dict[str, List[Tuple]]):
+        for table, rows in batch.items():
+            try:
+                await getattr(self._db, self.TABLES[table])(rows)
+                self.stats['written'] += len(rows)
+                self.stats['batches'] += 1
+            except Exception as e:
+                self.stats['failed'] += len(rows)
+                logger.error(f"❌ Ошибка записи {len(rows)} строк в {table}: {e}")
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                continue
+            
+            # Даём набраться пачке, но не дольше flush_interval
+            deadline = time.monotonic() + self.flush_interval
+            while (self._queue.qsize() < self.batch_size - 1 and time.monotonic() < deadline
+                   and not self._stopping):
+                await asyncio.sleep(min(0.2, self.flush_interval))
+            
+            batch = self._drain()
+            batch[item[0]].insert(0, item[1])
+            await self._write(batch)
+
+    async def flush(self):
+        """Запись всего, что накопилось в очереди"""
+        if self._queue is None:
+            return
+        while not self._queue.empty():
+            await self._write(self._drain())
+
+    async def stop(self):
+        """Остановка фоновой задачи с записью остатка очереди"""
+        if self._task is not None:
+            self._stopping = True
+            try:
+                # Задача сама выходит не позже чем через flush_interval (+ текущая запись)
+                await self._task
+            except Exception as e:
+                logger.error(f"❌ Ошибка остановки буфера логов: {e}")
+            self._task = None
+        await self.flush()
+        self._queue = None
+
+    def get_stats(self) -> Dict:
+        return {**self.stats, 'pending': self._queue.qsize() if self._queue else 0}
+
 # Инициализация БД
 db = Database()
+adb = AsyncDatabase(db, DB_EXECUTOR_WORKERS)
+log_sink = LogSink(adb, LOG_FLUSH_INTERVAL, LOG_BATCH_SIZE, LOG_QUEUE_SIZE)
 
 # ================= УПРАВЛЕНИЕ СЕССИЯМИ TELEGRAM =================
 
+def parse_login_code(text: str) -> Optional[str]:
+    """Код входа из служебного сообщения Telegram ("Login code: 12345", "Код для входа в Telegram: 12345")"""
+    match = LOGIN_CODE_RE.search(text or '')
+    return match.group(1).replace('-', '') if match else None
+
+
+class AccountScheduler:
+    """Выбор аккаунта для отправки кода: по кругу, в обход FloodWait и недавно сбоивших аккаунтов"""
+    
+    def __init__(self, failure_backoff: float = ACCOUNT_FAILURE_BACKOFF,
+                 failure_backoff_max: float = ACCOUNT_FAILURE_BACKOFF_MAX):
+        self.failure_backoff = failure_backoff
+        self.failure_backoff_max = failure_backoff_max
+        self.cooldowns = {}  # phone -> time.monotonic(), до которого аккаунт не трогаем
+        self.failures = {}  # phone -> число ошибок подряд
+        self.last_picked = {}  # phone -> time.monotonic() последнего выбора
+        self.stats = {'picks': 0, 'floods': 0, 'failures': 0, 'exhausted': 0}
+    
+    def is_available(self, phone: str) -> bool:
+        return self.cooldowns.get(phone, 0) <= time.monotonic()
+    
+    def order(self, accounts: List[Dict], busy) -> List[str]:
+        """Доступные аккаунты в порядке очереди: сначала давно не выбранные этим процессом, затем по last_used"""
+        candidates = [a for a in accounts if a['phone'] not in busy and self.is_available(a['phone'])]
+        candidates.sort(key=lambda a: (self.last_picked.get(a['phone'], 0), a['last_used'] or 0))
+        return [a['phone'] for a in candidates]
+    
+    def picked(self, phone: str):
+        self.last_picked[phone] = time.monotonic()
+        self.stats['picks'] += 1
+    
+    def report_success(self, phone: str):
+        self.failures.pop(phone, None)
+    
+    def report_flood(self, phone: str, seconds: int):
+        self.cooldowns[phone] = time.monotonic() + seconds
+        self.stats['floods'] += 1
+    
+    def report_failure(self, phone: str):
+        count = self.failures.get(phone, 0) + 1
+        self.failures[phone] = count
+        backoff = min(self.failure_backoff * 2 ** (count - 1), self.failure_backoff_max)
+        self.cooldowns[phone] = max(self.cooldowns.get(phone, 0), time.monotonic() + backoff)
+        self.stats['failures'] += 1
+    
+    def forget(self, phone: str):
+        self.cooldowns.pop(phone, None)
+        self.failures.pop(phone, None)
+        self.last_picked.pop(phone, None)
+    
+    def get_stats(self) -> Dict:
+        now = time.monotonic()
+        return {
+            **self.stats,
+            'cooling_down': sum(1 for until in self.cooldowns.values() if until > now),
+            'failing': len(self.failures),
+        }
+
+
 class SessionManager:
     """Класс для управления сессиями Telegram аккаунтов"""
     
-    def __init__(self):
-        self.active_sessions = {}  # phone -> client
+    def __init__(self, max_clients: int = CLIENT_POOL_MAX, connect_concurrency: int = CLIENT_CONNECT_CONCURRENCY,
+                 idle_timeout: float = CLIENT_IDLE_TIMEOUT):
+        self.active_sessions = OrderedDict()  # phone -> client, порядок - от давно использованных к свежим (LRU)
         self.waiting_codes = {}  # phone -> {'number_id': id, 'user_id': id}
         self.waiting_2fa = {}  # phone -> {'number_id': id, 'user_id': id, 'client': client}
-        self.session_watchers = {}  # phone -> task
+        self.lost_auth = set()  # телефоны, о потере авторизации которых уже сообщили
+        self.scheduler = AccountScheduler()
+        self._login_locks = {}  # phone -> [блокировка входа (ручной ввод и перехват кода), число пользователей]
+        self._expiry_heap = []  # мин-куча (дедлайн, phone, timestamp записи) для ожидающих входов
+        self._expiry_wakeup = asyncio.Event()
+        self._check_semaphore = asyncio.Semaphore(SESSION_CHECK_CONCURRENCY)
+        
+        # Пул клиентов
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        self.last_used = {}  # phone -> time.monotonic() последнего обращения
+        self._connect_semaphore = asyncio.Semaphore(connect_concurrency)
+        self._connect_locks = {}  # phone -> [блокировка, чтобы не подключить одну сессию дважды, число пользователей]
+        self._held = {}  # phone -> сколько вызывающих сейчас работают с клиентом (вытеснять нельзя)
+        self._evicted = set()  # телефоны, отключенные пулом (следующее подключение - переподключение)
+        self.warmup_report = {}  # итоги прогрева при старте
+        self.shutdown_progress = {'total': 0, 'closed': 0}  # ход close_all (виден и после таймаута фазы)
+        self.pool_stats = {
+            'connecting': 0,
+            'connects': 0,
+            'reconnects': 0,
+            'connect_failures': 0,
+            'evicted_lru': 0,
+            'evicted_idle': 0,
+            'connect_time_total': 0.0,
+            'connect_time_max': 0.0,
+            'reconnect_time_total': 0.0,
+        }
+    
+    async def _set_waiting(self, stage: str, phone: str, info: Dict):
+        """Запись ожидания кода/2FA в память и в БД (клиент в БД не сохраняется)"""
+        waiting, other = (self.waiting_codes, self.waiting_2fa) if stage == 'code' else (self.waiting_2fa, self.waiting_codes)
+        other.pop(phone, None)
+        waiting[phone] = info
+        self._schedule_expiry(phone, info)
+        await adb.save_pending_login(phone, stage, info)
+    
+    async def _clear_waiting(self, phone: str):
+        """Завершение ожидания кода/2FA"""
+        self.waiting_codes.pop(phone, None)
+        self.waiting_2fa.pop(phone, None)
+        await adb.delete_pending_login(phone)
+    
+    def _schedule_expiry(self, phone: str, info: Dict):
+        deadline = info['timestamp'] + PENDING_LOGIN_TTL
+        wake = not self._expiry_heap or deadline < self._expiry_heap[0][0]
+        heapq.heappush(self._expiry_heap, (deadline, phone, info['timestamp']))
+        if wake:
+            self._expiry_wakeup.set()
+    
+    async def wait_for_expiry(self):
+        """Сон до ближайшего дедлайна (или до появления более раннего)"""
+        self._expiry_wakeup.clear()
+        timeout = max(0, self._expiry_heap[0][0] - time.time()) if self._expiry_heap else None
+        try:
+            await asyncio.wait_for(self._expiry_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    
+    async def expire_pending_logins(self) -> int:
+        """Удаление ожидающих входов с истёкшим дедлайном.
+        Записи в куче не удаляются при завершении входа - устаревшие отсеиваются здесь по timestamp"""
+        now = time.time()
+        expired = 0
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            _, phone, timestamp = heapq.heappop(self._expiry_heap)
+            info = self.waiting_codes.get(phone) or self.waiting_2fa.get(phone)
+            if not info or info['timestamp'] != timestamp:
+                continue
+            stage = "2FA" if phone in self.waiting_2fa else "код"
+            await self._clear_waiting(phone)
+            expired += 1
+            logger.info(f"🧹 Истекло ожидание ({stage}) для {phone}")
+            # Клиент держали ради входа - если он больше никому не нужен, не ждём вытеснения
+            if not self._is_pinned(phone):
+                await self._disconnect_client(phone, "истекло ожидание входа")
+        return expired
+    
+    async def restore_pending_logins(self) -> List[Dict]:
+        """Восстановление незавершённых входов после перезапуска.
+        Клиенты не подключаются сразу - get_client/_login_client поднимут их из сохранённой сессии по требованию"""
+        restored = []
+        now = time.time()
+        for row in await adb.get_pending_logins():
+            phone = row['phone']
+            if now - (row['created_at'] or 0) > PENDING_LOGIN_TTL:
+                await adb.delete_pending_login(phone)
+                continue
+            
+            info = {'timestamp': row['created_at']}
+            for key in ('action', 'number_id', 'user_id', 'phone_code_hash', 'session_name'):
+                if row[key] is not None:
+                    info[key] = row[key]
+            if row['stage'] == 'code':
+                self.waiting_codes[phone] = info
+            else:
+                self.waiting_2fa[phone] = info
+            self._schedule_expiry(phone, info)
+            restored.append(row)
+        
+        if restored:
+            logger.info(f"♻️ Восстановлено незавершённых входов: {len(restored)}")
+        return restored
+    
+    @staticmethod
+    def _make_client(session_name: str, api_id: int, api_hash: str, session_string: str = None) -> Client:
+        """Клиент с сессией в памяти: ключ авторизации берётся из БД, а не из файла"""
+        return Client(
+            name=session_name,
+            api_id=api_id,
+            api_hash=api_hash,
+            session_string=session_string,
+            in_memory=True,
+            device_model="Server Bot",
+            system_version="4.16.30-vxCUSTOM",
+            app_version="1.0.0"
+        )
+    
+    @staticmethod
+    async def _export_session(storage: Storage, api_id: int) -> str:
+        """Строка сессии в формате Pyrogram. В отличие от export_session_string работает и до входа
+        (user_id ещё не известен), чтобы ожидающий кода вход пережил перезапуск"""
+        packed = struct.pack(
+            Storage.SESSION_STRING_FORMAT,
+            await storage.dc_id(),
+            await storage.api_id() or api_id,
+            bool(await storage.test_mode()),
+            await storage.auth_key(),
+            await storage.user_id() or 0,
+            bool(await storage.is_bot())
+        )
+        return base64.urlsafe_b64encode(packed).decode().rstrip("=")
+    
+    async def _save_session(self, phone: str, client: Client):
+        """Сохранение ключа авторизации подключенного клиента в БД"""
+        await adb.save_tg_session(phone, await self._export_session(client.storage, client.api_id))
+    
+    async def _migrate_session_file(self, account: Dict) -> bool:
+        """Перенос старого файла .session в БД (без подключения к Telegram)"""
+        phone = account['phone']
+        storage = FileStorage(account['session_name'], Path(SESSIONS_DIR))
+        try:
+            await storage.open()
+            if not await storage.auth_key():
+                return False
+            await adb.save_tg_session(phone, await self._export_session(storage, account['api_id']))
+            logger.info(f"📦 Сессия {phone} перенесена из файла в БД")
+            return True
+        except Exception as e:
+            logger.error(f"❌ Ошибка переноса сессии {phone}: {e}")
+            return False
+        finally:
+            try:
+                await storage.close()
+            except Exception:
+                pass
+    
+    async def _login_client(self, phone: str) -> Optional[Client]:
+        """Клиент для добавляемого аккаунта из сохранённой в БД сессии (в т.ч. после перезапуска)"""
+        account = await adb.get_tg_account(phone)
+        session_string = await adb.get_tg_session(phone)
+        if not account or not session_string:
+            return None
+        return self._make_client(account['session_name'], account['api_id'], account['api_hash'], session_string)
+    
+    def _is_pinned(self, phone: str) -> bool:
+        """Клиент участвует в незавершённом входе (код/2FA) или с ним сейчас работают - вытеснять нельзя"""
+        return phone in self.waiting_codes or phone in self.waiting_2fa or phone in self._held
+    
+    @asynccontextmanager
+    async def _hold(self, phone: str):
+        """Закрепление клиента за вызывающим: пока блок не завершён, пул его не вытеснит"""
+        self._held[phone] = self._held.get(phone, 0) + 1
+        try:
+            yield
+        finally:
+            self._held[phone] -= 1
+            if not self._held[phone]:
+                del self._held[phone]
+    
+    @staticmethod
+    @asynccontextmanager
+    async def _phone_lock(locks: Dict, phone: str):
+        """Блокировка по телефону. Запись удаляется, как только её никто не держит и не ждёт,
+        поэтому словарь не растёт с числом когда-либо подключавшихся аккаунтов"""
+        entry = locks.get(phone)
+        if entry is None:
+            entry = locks[phone] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del locks[phone]
+    
+    def _touch(self, phone: str):
+        self.active_sessions.move_to_end(phone)
+        self.last_used[phone] = time.monotonic()
+    
+    async def close_client(self, client: Client):
+        """Остановка обработки обновлений и отключение клиента"""
+        if client.is_initialized:
+            await client.terminate()
+        if client.is_connected:
+            await client.disconnect()
+    
+    async def _listen_for_codes(self, phone: str, client: Client):
+        """Подписка клиента на служебные сообщения 777000 - коды входа приходят сами"""
+        async def on_service_message(_, message):
+            await self.on_service_message(phone, message)
+        
+        try:
+            client.add_handler(MessageHandler(on_service_message, filters.user(SERVICE_NOTIFICATIONS_ID)))
+            await client.initialize()
+            # Без запроса состояния сервер не начнёт присылать обновления
+            await client.invoke(raw.functions.updates.GetState())
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось подписаться на коды для {phone}: {e}")
+    
+    async def on_service_message(self, phone: str, message):
+        """Перехват кода входа и автоматическое завершение ожидающей покупки"""
+        code = parse_login_code(message.text or message.caption)
+        if not code:
+            return
+        
+        info = self.waiting_codes.get(phone)
+        if not info or info.get('action'):
+            return
+        
+        logger.info(f"📨 Перехвачен код входа для {phone}")
+        result = await self.submit_code(phone, code)
+        if result and ('code' in result or result.get('error') == '2fa_required'):
+            await log_sink.session(phone, 'code_push', 'success')
+            await deliver_login_result(info['user_id'], phone, info['number_id'], result)
+        else:
+            # Покупатель по-прежнему может ввести код вручную
+            error = result.get('error') if result else 'no pending login'
+            await log_sink.session(phone, 'code_push', 'fail', error)
+    
+    async def _disconnect_client(self, phone: str, reason: str):
+        """Отключение клиента из пула (сессия остаётся в БД, подключимся заново по требованию)"""
+        client = self.active_sessions.pop(phone, None)
+        self.last_used.pop(phone, None)
+        self.lost_auth.discard(phone)
+        if client is None:
+            return
+        try:
+            await self.close_client(client)
+        except Exception as e:
+            logger.error(f"❌ Ошибка отключения клиента {phone}: {e}")
+        self._evicted.add(phone)
+        logger.info(f"🔌 Клиент {phone} отключен ({reason})")
+    
+    async def close_all(self) -> int:
+        """Параллельное отключение всех клиентов пула (при остановке бота)"""
+        clients = list(self.active_sessions.items())
+        self.active_sessions.clear()
+        self.last_used.clear()
+        progress = self.shutdown_progress
+        progress.update(total=len(clients), closed=0)
+        
+        async def close(phone, client):
+            try:
+                await self.close_client(client)
+                progress['closed'] += 1
+            except Exception as e:
+                logger.error(f"❌ Ошибка при закрытии сессии {phone}: {e}")
+        
+        await asyncio.gather(*(close(phone, client) for phone, client in clients))
+        return progress['closed']
+    
+    async def _evict_lru(self):
+        """Освобождение места в пуле: отключаем давно не использованных клиентов"""
+        while len(self.active_sessions) >= self.max_clients:
+            victim = next((p for p in self.active_sessions if not self._is_pinned(p)), None)
+            if victim is None:
+                logger.warning(f"⚠️ Пул клиентов переполнен ({len(self.active_sessions)}), все клиенты заняты входом или запросами")
+                return
+            self.pool_stats['evicted_lru'] += 1
+            await self._disconnect_client(victim, "вытеснен из пула (LRU)")
+    
+    async def reap_idle_clients(self) -> int:
+        """Отключение клиентов, простаивающих дольше idle_timeout"""
+        now = time.monotonic()
+        idle = [phone for phone in list(self.active_sessions)
+                if now - self.last_used.get(phone, 0) > self.idle_timeout and not self._is_pinned(phone)]
+        for phone in idle:
+            self.pool_stats['evicted_idle'] += 1
+            await self._disconnect_client(phone, "простой")
+        return len(idle)
+    
+    def get_pool_stats(self) -> Dict:
+        """Метрики пула клиентов"""
+        stats = self.pool_stats
+        return {
+            'live': len(self.active_sessions),
+            'max': self.max_clients,
+            'pinned': sum(1 for p in self.active_sessions if self._is_pinned(p)),
+            'connecting': stats['connecting'],
+            'connects': stats['connects'],
+            'reconnects': stats['reconnects'],
+            'connect_failures': stats['connect_failures'],
+            'evicted_lru': stats['evicted_lru'],
+            'evicted_idle': stats['evicted_idle'],
+            'connect_avg_ms': round(stats['connect_time_total'] / stats['connects'] * 1000, 1) if stats['connects'] else 0,
+            'connect_max_ms': round(stats['connect_time_max'] * 1000, 1),
+            'reconnect_avg_ms': round(stats['reconnect_time_total'] / stats['reconnects'] * 1000, 1) if stats['reconnects'] else 0,
+            'warmup': self.warmup_report,
+        }
     
     async def load_saved_sessions(self):
-        """Загрузка сохраненных сессий из файлов"""
+        """Загрузка сохраненных сессий из БД (старые файлы .session переносятся в БД)"""
         try:
-            accounts = db.get_all_tg_accounts()
+            accounts = await adb.get_all_tg_accounts()
+            stored = await adb.get_tg_session_phones()
             loaded = 0
             for account in accounts:
-                if account['status'] == 'active' and account.get('owner_id', 0) == 0:
-                    # Проверяем, существует ли файл сессии
+                if account['phone'] not in stored:
                     session_path = os.path.join(SESSIONS_DIR, account['session_name'])
-                    if os.path.exists(f"{session_path}.session"):
-                        logger.info(f"🔄 Найдена сохраненная сессия для {account['phone']}")
-                        loaded += 1
+                    if os.path.exists(f"{session_path}.session") and await self._migrate_session_file(account):
+                        stored.add(account['phone'])
+                if account['status'] == 'active' and account.get('owner_id', 0) == 0 and account['phone'] in stored:
+                    loaded += 1
             logger.info(f"✅ Загружено {loaded} сохраненных сессий")
         except Exception as e:
             logger.error(f"❌ Ошибка загрузки сессий: {e}")
     
-    async def watch_session(self, phone: str, client: Client):
-        """Наблюдение за сессией (бесконечное)"""
-        try:
-            while True:
-                try:
-                    if not await client.is_user_authorized():
-                        logger.warning(f"⚠️ Сессия {phone} потеряла авторизацию")
-                        break
-                    
-                    has_owner, owner_id = db.check_account_owner(phone)
-                    if has_owner:
-                        logger.info(f"👤 Аккаунт {phone} имеет владельца {owner_id}, выходим...")
-                        await self.logout_session(phone, "owner_logged_in")
-                        break
-                    
-                    await asyncio.sleep(30)
-                    
-                except Exception as e:
-                    logger.error(f"❌ Ошибка в watcher для {phone}: {e}")
-                    await asyncio.sleep(60)
-        except asyncio.CancelledError:
-            logger.info(f"🛑 Watcher для {phone} остановлен")
+    async def _warm_up_one(self, phone: str) -> Tuple[str, bool, float]:
+        started = time.monotonic()
+        client = await self.get_client(phone)
+        if not client:
+            # Неавторизованный аккаунт get_client уже перевёл в статус unauthorized
+            self.scheduler.report_failure(phone)
+        return phone, client is not None, time.monotonic() - started
+    
+    async def warm_up(self, limit: int = CLIENT_WARMUP_ACCOUNTS, budget: float = CLIENT_WARMUP_BUDGET) -> Dict:
+        """Прогрев пула: параллельное подключение аккаунтов, которые планировщик выберет первыми.
+        Параллельность ограничена семафором подключений, всё, что не успело за budget, отменяется"""
+        started = time.monotonic()
+        accounts = await adb.get_available_tg_accounts()
+        phones = self.scheduler.order(accounts, self.lost_auth)[:limit]
+        if not phones:
+            self.warmup_report = {'accounts': 0, 'connected': 0, 'failed': 0, 'timed_out': 0}
+            return self.warmup_report
+        
+        tasks = [asyncio.create_task(self._warm_up_one(phone)) for phone in phones]
+        done, pending = await asyncio.wait(tasks, timeout=budget)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        
+        latencies = {}
+        failed = 0
+        for task in done:
+            if task.exception():
+                failed += 1
+                continue
+            phone, ok, elapsed = task.result()
+            if ok:
+                latencies[phone] = round(elapsed * 1000, 1)
+                logger.info(f"🔥 Прогрет {phone}: {latencies[phone]} мс")
+            else:
+                failed += 1
+        
+        self.warmup_report = {
+            'accounts': len(phones),
+            'connected': len(latencies),
+            'failed': failed,
+            'timed_out': len(pending),
+            'elapsed_ms': round((time.monotonic() - started) * 1000, 1),
+            'latency_ms': latencies,
+        }
+        logger.info(f"🔥 Прогрев пула: {len(latencies)}/{len(phones)} подключено, ошибок={failed}, "
+                   f"не успели={len(pending)}, {self.warmup_report['elapsed_ms']} мс")
+        return self.warmup_report
+    
+    async def _check_authorized(self, phone: str, client: Client):
+        """Проверка авторизации одного клиента (с ограничением параллельности)"""
+        async with self._check_semaphore:
+            try:
+                if await client.is_user_authorized():
+                    return
+            except Exception as e:
+                logger.error(f"❌ Ошибка проверки авторизации {phone}: {e}")
+                return
+        if phone not in self.lost_auth:
+            self.lost_auth.add(phone)
+            logger.warning(f"⚠️ Сессия {phone} потеряла авторизацию")
+            await log_sink.system('WARNING', 'sessions', f"сессия {phone} потеряла авторизацию")
+    
+    async def supervise_sessions(self) -> int:
+        """Один проход надзора за подключенными сессиями: владельцы - одним запросом, авторизация - параллельно"""
+        phones = list(self.active_sessions)
+        if not phones:
+            return 0
+        
+        owners = await adb.get_account_owners(phones)
+        for phone, owner_id in owners.items():
+            logger.info(f"👤 Аккаунт {phone} имеет владельца {owner_id}, выходим...")
+            await self.logout_session(phone, "owner_logged_in")
+        
+        checks = [self._check_authorized(phone, client)
+                  for phone, client in list(self.active_sessions.items())
+                  if phone not in self.lost_auth]
+        await asyncio.gather(*checks)
+        return len(owners)
     
     async def logout_session(self, phone: str, reason: str):
         """Принудительный выход из сессии"""
         try:
             if phone in self.active_sessions:
-                client = self.active_sessions[phone]
+                client = self.active_sessions.pop(phone)
+                self.last_used.pop(phone, None)
+                self._evicted.discard(phone)
+                self.lost_auth.discard(phone)
                 try:
                     await client.log_out()
                 except:
                     pass
-                await client.disconnect()
-                
-                del self.active_sessions[phone]
+                await self.close_client(client)
                 
-                if phone in self.session_watchers:
-                    self.session_watchers[phone].cancel()
-                    del self.session_watchers[phone]
-                
-                # Удаляем файл сессии
-                account = db.get_tg_account(phone)
+                # Удаляем сессию (и старый файл, если остался)
+                await adb.delete_tg_session(phone)
+                account = await adb.get_tg_account(phone)
                 if account:
                     session_path = os.path.join(SESSIONS_DIR, account['session_name'])
                     if os.path.exists(f"{session_path}.session"):
                         os.remove(f"{session_path}.session")
-                        logger.info(f"🗑 Удален файл сессии для {phone}")
+                logger.info(f"🗑 Удалена сессия для {phone}")
                 
-                db.update_tg_account_status(phone, 'logged_out', f"Причина: {reason}")
-                db.log_session_action(phone, 'logout', 'success', reason)
+                await adb.update_tg_account_status(phone, 'logged_out', f"Причина: {reason}")
+                await log_sink.session(phone, 'logout', 'success', reason)
                 logger.info(f"✅ Сессия {phone} завершена: {reason}")
         except Exception as e:
             logger.error(f"❌ Ошибка выхода из сессии {phone}: {e}")
@@ -2209,7 +4580,8 @@ class SessionManager:
                 await self.logout_session(phone, "admin_deleted")
             
             # Удаляем из базы данных
-            result = db.delete_tg_account(phone)
+            result = await adb.delete_tg_account(phone)
+            self.scheduler.forget(phone)
             
             if result:
                 logger.info(f"✅ Сессия {phone} полностью удалена")
@@ -2220,83 +4592,146 @@ class SessionManager:
             return False
     
     async def get_client(self, phone: str) -> Optional[Client]:
-        """Получение клиента для аккаунта с сохранением сессии в файл"""
+        """Получение клиента для аккаунта из пула (подключение из файла сессии по требованию)"""
         if phone in self.active_sessions:
+            self._touch(phone)
             return self.active_sessions[phone]
         
-        account = db.get_tg_account(phone)
+        async with self._phone_lock(self._connect_locks, phone):
+            # Пока ждали блокировку, клиента мог подключить параллельный запрос
+            if phone in self.active_sessions:
+                self._touch(phone)
+                return self.active_sessions[phone]
+            
+            async with self._connect_semaphore:
+                return await self._connect_client(phone)
+    
+    async def _connect_client(self, phone: str) -> Optional[Client]:
+        """Подключение клиента и регистрация в пуле"""
+        account = await adb.get_tg_account(phone)
         if not account:
             logger.error(f"❌ Аккаунт {phone} не найден в БД")
             return None
         
-        has_owner, owner_id = db.check_account_owner(phone)
+        has_owner, owner_id = await adb.check_account_owner(phone)
         if has_owner:
             logger.warning(f"⚠️ Аккаунт {phone} имеет владельца {owner_id}, не подключаемся")
             return None
         
-        session_path = os.path.join(SESSIONS_DIR, account['session_name'])
+        session_string = await adb.get_tg_session(phone)
+        if not session_string:
+            logger.warning(f"⚠️ Нет сохраненной сессии для {phone}")
+            await adb.update_tg_account_status(phone, 'unauthorized', "Нет сохраненной сессии")
+            return None
         
-        client = Client(
-            name=session_path,
-            api_id=account['api_id'],
-            api_hash=account['api_hash'],
-            workdir=SESSIONS_DIR,
-            device_model="Server Bot",
-            system_version="4.16.30-vxCUSTOM",
-            app_version="1.0.0"
-        )
+        client = self._make_client(account['session_name'], account['api_id'], account['api_hash'], session_string)
         
+        is_reconnect = phone in self._evicted
+        started = time.monotonic()
+        self.pool_stats['connecting'] += 1
         try:
             await client.connect()
             if await client.is_user_authorized():
-                self.active_sessions[phone] = client
-                db.update_tg_account_status(phone, 'active')
-                db.log_session_action(phone, 'connect', 'success')
+                elapsed = time.monotonic() - started
+                self.pool_stats['connects'] += 1
+                self.pool_stats['connect_time_total'] += elapsed
+                self.pool_stats['connect_time_max'] = max(self.pool_stats['connect_time_max'], elapsed)
+                if is_reconnect:
+                    self.pool_stats['reconnects'] += 1
+                    self.pool_stats['reconnect_time_total'] += elapsed
+                    self._evicted.discard(phone)
                 
-                watcher_task = asyncio.create_task(self.watch_session(phone, client))
-                self.session_watchers[phone] = watcher_task
+                await self._evict_lru()
+                await self._listen_for_codes(phone, client)
+                self.active_sessions[phone] = client
+                self._touch(phone)
+                await adb.update_tg_account_status(phone, 'active')
+                await log_sink.session(phone, 'connect', 'success')
                 
-                logger.info(f"✅ Подключена сессия для {phone} из файла {session_path}.session")
+                logger.info(f"✅ Подключена сессия для {phone}")
                 return client
             else:
+                self.pool_stats['connect_failures'] += 1
                 await client.disconnect()
-                db.update_tg_account_status(phone, 'unauthorized')
-                db.log_session_action(phone, 'connect', 'fail', 'not authorized')
+                await adb.update_tg_account_status(phone, 'unauthorized')
+                await log_sink.session(phone, 'connect', 'fail', 'not authorized')
                 return None
         except Exception as e:
+            self.pool_stats['connect_failures'] += 1
             logger.error(f"❌ Ошибка подключения к аккаунту {phone}: {e}")
-            db.log_session_action(phone, 'connect', 'error', str(e))
+            await log_sink.session(phone, 'connect', 'error', str(e))
             return None
+        except asyncio.CancelledError:
+            # Отмена (например, по бюджету прогрева) - не оставляем висящее подключение
+            if self.active_sessions.get(phone) is not client:
+                try:
+                    await self.close_client(client)
+                except Exception:
+                    pass
+            raise
+        finally:
+            self.pool_stats['connecting'] -= 1
+    
+    async def request_code_any(self, number_id: int, user_id: int) -> Tuple[Optional[str], int]:
+        """Запрос кода через первый подходящий аккаунт из очереди планировщика.
+        Возвращает (телефон аккаунта или None, сколько аккаунтов попробовали)"""
+        accounts = await adb.get_available_tg_accounts()
+        # Аккаунт с незавершённым входом занят другим покупателем, без авторизации - бесполезен
+        busy = set(self.waiting_codes) | set(self.waiting_2fa) | self.lost_auth
+        attempts = 0
+        for phone in self.scheduler.order(accounts, busy)[:ACCOUNT_PICK_ATTEMPTS]:
+            attempts += 1
+            self.scheduler.picked(phone)
+            if await self.request_code(phone, number_id, user_id):
+                return phone, attempts
+        if accounts:
+            self.scheduler.stats['exhausted'] += 1
+        return None, attempts
     
     async def request_code(self, phone: str, number_id: int, user_id: int) -> bool:
         """Запрос кода на указанный номер через аккаунт"""
+        # send_code идёт до _set_waiting - без закрепления клиента параллельное подключение
+        # могло бы вытеснить его посреди запроса, и здоровый аккаунт получил бы штраф
+        async with self._hold(phone):
+            return await self._request_code(phone, number_id, user_id)
+    
+    async def _request_code(self, phone: str, number_id: int, user_id: int) -> bool:
         client = await self.get_client(phone)
         if not client:
+            self.scheduler.report_failure(phone)
             return False
         
         try:
             sent_code = await client.send_code(phone)
             
-            self.waiting_codes[phone] = {
+            await self._set_waiting('code', phone, {
                 'number_id': number_id,
                 'user_id': user_id,
                 'phone_code_hash': sent_code.phone_code_hash,
                 'timestamp': time.time()
-            }
+            })
             
-            db.log_session_action(phone, 'request_code', 'success')
+            self.scheduler.report_success(phone)
+            await adb.touch_tg_account(phone)
+            await log_sink.session(phone, 'request_code', 'success')
             return True
         except FloodWait as e:
             logger.warning(f"⚠️ Flood wait на {phone}: {e.value} сек")
-            db.log_session_action(phone, 'request_code', 'flood', str(e.value))
+            self.scheduler.report_flood(phone, e.value)
+            await log_sink.session(phone, 'request_code', 'flood', str(e.value))
             return False
         except Exception as e:
             logger.error(f"❌ Ошибка запроса кода на {phone}: {e}")
-            db.log_session_action(phone, 'request_code', 'error', str(e))
+            self.scheduler.report_failure(phone)
+            await log_sink.session(phone, 'request_code', 'error', str(e))
             return False
     
     async def submit_code(self, phone: str, code: str) -> Optional[Dict]:
-        """Отправка кода подтверждения"""
+        """Отправка кода подтверждения (код введён покупателем или перехвачен у 777000)"""
+        async with self._phone_lock(self._login_locks, phone), self._hold(phone):
+            return await self._submit_code(phone, code)
+    
+    async def _submit_code(self, phone: str, code: str) -> Optional[Dict]:
         if phone not in self.waiting_codes:
             logger.error(f"❌ Нет ожидающего кода для {phone}")
             return None
@@ -2315,15 +4750,16 @@ class SessionManager:
             
             me = await client.get_me()
             
-            db.set_number_code(wait_info['number_id'], code)
-            db.update_tg_account_status(phone, 'active')
-            db.set_tg_account_code(phone, code)
-            db.set_account_owner(phone, wait_info['user_id'], f"user_{wait_info['user_id']}")
+            await self._save_session(phone, client)
+            await adb.set_number_code(wait_info['number_id'], code)
+            await adb.update_tg_account_status(phone, 'active')
+            await adb.set_tg_account_code(phone, code)
+            await adb.set_account_owner(phone, wait_info['user_id'], f"user_{wait_info['user_id']}")
             
-            del self.waiting_codes[phone]
-            db.log_session_action(phone, 'submit_code', 'success')
+            await self._clear_waiting(phone)
+            await log_sink.session(phone, 'submit_code', 'success')
             
-            logger.info(f"✅ Сессия для {phone} сохранена в файл")
+            logger.info(f"✅ Сессия для {phone} сохранена в БД")
             return {
                 'number_id': wait_info['number_id'],
                 'user_id': wait_info['user_id'],
@@ -2337,15 +4773,13 @@ class SessionManager:
         except SessionPasswordNeeded:
             logger.info(f"⚠️ Аккаунт {phone} требует 2FA")
             
-            self.waiting_2fa[phone] = {
+            await self._set_waiting('2fa', phone, {
                 'number_id': wait_info['number_id'],
                 'user_id': wait_info['user_id'],
                 'client': client,
                 'timestamp': time.time()
-            }
-            
-            del self.waiting_codes[phone]
-            db.log_session_action(phone, 'submit_code', '2fa_required')
+            })
+            await log_sink.session(phone, 'submit_code', '2fa_required')
             return {'error': '2fa_required', 'phone': phone}
         except PhoneCodeInvalid:
             logger.warning(f"⚠️ Неверный код для {phone}")
@@ -2359,38 +4793,41 @@ class SessionManager:
     
     async def submit_2fa(self, phone: str, password: str) -> Optional[Dict]:
         """Отправка пароля 2FA"""
+        async with self._hold(phone):
+            return await self._submit_2fa(phone, password)
+    
+    async def _submit_2fa(self, phone: str, password: str) -> Optional[Dict]:
         if phone not in self.waiting_2fa:
             logger.error(f"❌ Нет ожидающего 2FA для {phone}")
             return None
         
         info = self.waiting_2fa[phone]
-        client = info['client']
+        client = info.get('client') or await self.get_client(phone)
+        if not client:
+            return None
         
         try:
             await client.check_password(password)
             
             me = await client.get_me()
             
+            await self._save_session(phone, client)
+            
             # Генерируем случайный код для продажи
             fake_code = ''.join(random.choices(string.digits, k=5))
-            db.set_number_code(info['number_id'], fake_code)
+            await adb.set_number_code(info['number_id'], fake_code)
             
-            db.update_tg_account_status(phone, 'active')
-            db.set_tg_account_code(phone, fake_code)
-            db.set_account_owner(phone, info['user_id'], f"user_{info['user_id']}")
+            await adb.update_tg_account_status(phone, 'active')
+            await adb.set_tg_account_code(phone, fake_code)
+            await adb.set_account_owner(phone, info['user_id'], f"user_{info['user_id']}")
             
             # Отмечаем, что у аккаунта есть 2FA
-            if db.db_url:
-                with db.get_cursor() as cursor:
-                    cursor.execute('UPDATE tg_accounts SET has_2fa = 1 WHERE phone = %s', (phone,))
-            else:
-                with db.get_cursor() as cursor:
-                    cursor.execute('UPDATE tg_accounts SET has_2fa = 1 WHERE phone = ?', (phone,))
+            await adb.set_account_2fa(phone)
             
-            del self.waiting_2fa[phone]
-            db.log_session_action(phone, 'submit_2fa', 'success')
+            await self._clear_waiting(phone)
+            await log_sink.session(phone, 'submit_2fa', 'success')
             
-            logger.info(f"✅ Сессия с 2FA для {phone} сохранена в файл")
+            logger.info(f"✅ Сессия с 2FA для {phone} сохранена в БД")
             return {
                 'number_id': info['number_id'],
                 'user_id': info['user_id'],
@@ -2412,46 +4849,27 @@ class SessionManager:
                              added_by: int) -> Tuple[bool, str]:
         """Добавление нового аккаунта"""
         try:
-            if db.get_tg_account(phone):
+            if await adb.get_tg_account(phone):
                 return False, "Аккаунт уже существует"
             
             session_name = f"acc_{phone.replace('+', '')}_{random.randint(1000, 9999)}"
             
-            client = Client(
-                name=session_name,
-                api_id=api_id,
-                api_hash=api_hash,
-                workdir=SESSIONS_DIR,
-                device_model="Server Bot",
-                system_version="4.16.30-vxCUSTOM",
-                app_version="1.0.0"
-            )
+            client = self._make_client(session_name, api_id, api_hash)
             
             await client.connect()
             sent_code = await client.send_code(phone)
             
-            if db.db_url:
-                with db.get_cursor() as cursor:
-                    cursor.execute('''
-                        INSERT INTO tg_accounts 
-                        (phone, session_name, api_id, api_hash, added_by, added_at, status)
-                        VALUES (%s, %s, %s, %s, %s, %s, 'pending')
-                    ''', (phone, session_name, api_id, api_hash, added_by, time.time()))
-            else:
-                with db.get_cursor() as cursor:
-                    cursor.execute('''
-                        INSERT INTO tg_accounts 
-                        (phone, session_name, api_id, api_hash, added_by, added_at, status)
-                        VALUES (?, ?, ?, ?, ?, ?, 'pending')
-                    ''', (phone, session_name, api_id, api_hash, added_by, time.time()))
+            await adb.add_pending_tg_account(phone, session_name, api_id, api_hash, added_by)
+            # phone_code_hash привязан к ключу авторизации - сохраняем его до ввода кода
+            await self._save_session(phone, client)
             
-            self.waiting_codes[phone] = {
+            await self._set_waiting('code', phone, {
                 'action': 'add_account',
+                'user_id': added_by,
                 'phone_code_hash': sent_code.phone_code_hash,
-                'client': client,
                 'session_name': session_name,
                 'timestamp': time.time()
-            }
+            })
             
             await client.disconnect()
             
@@ -2488,7 +4906,9 @@ class SessionManager:
             return False, "Нет ожидающего подтверждения", None
         
         info = self.waiting_codes[phone]
-        client = info['client']
+        client = await self._login_client(phone)
+        if not client:
+            return False, "Аккаунт не найден", None
         
         try:
             await client.connect()
@@ -2500,29 +4920,14 @@ class SessionManager:
             
             me = await client.get_me()
             
-            if db.db_url:
-                with db.get_cursor() as cursor:
-                    cursor.execute('''
-                        UPDATE tg_accounts 
-                        SET first_name = %s, last_name = %s, username = %s, user_id = %s, 
-                            status = 'active', last_used = %s
-                        WHERE phone = %s
-                    ''', (me.first_name or '', me.last_name or '', me.username or '', 
-                          me.id, time.time(), phone))
-            else:
-                with db.get_cursor() as cursor:
-                    cursor.execute('''
-                        UPDATE tg_accounts 
-                        SET first_name = ?, last_name = ?, username = ?, user_id = ?, 
-                            status = 'active', last_used = ?
-                        WHERE phone = ?
-                    ''', (me.first_name or '', me.last_name or '', me.username or '', 
-                          me.id, time.time(), phone))
+            await self._save_session(phone, client)
+            await adb.update_tg_account_profile(
+                phone, me.first_name or '', me.last_name or '', me.username or '', me.id
+            )
             
-            await client.disconnect()
-            del self.waiting_codes[phone]
+            await self._clear_waiting(phone)
             
-            logger.info(f"✅ Аккаунт {phone} добавлен, сессия сохранена в файл")
+            logger.info(f"✅ Аккаунт {phone} добавлен, сессия сохранена в БД")
             return True, "Аккаунт успешно добавлен", {
                 'id': me.id,
                 'first_name': me.first_name,
@@ -2532,14 +4937,12 @@ class SessionManager:
         except SessionPasswordNeeded:
             logger.info(f"⚠️ Аккаунт {phone} требует 2FA")
             
-            self.waiting_2fa[phone] = {
+            await self._set_waiting('2fa', phone, {
                 'action': 'add_account_2fa',
-                'client': client,
+                'user_id': info.get('user_id'),
                 'session_name': info['session_name'],
                 'timestamp': time.time()
-            }
-            
-            del self.waiting_codes[phone]
+            })
             
             return False, "2FA_REQUIRED", None
             
@@ -2550,14 +4953,17 @@ class SessionManager:
         except Exception as e:
             logger.error(f"❌ Ошибка подтверждения аккаунта: {e}")
             return False, str(e), None
+        finally:
+            await self.close_client(client)
     
     async def submit_account_2fa(self, phone: str, password: str) -> Tuple[bool, str, Optional[Dict]]:
         """Подтверждение аккаунта с 2FA"""
         if phone not in self.waiting_2fa or self.waiting_2fa[phone].get('action') != 'add_account_2fa':
             return False, "Нет ожидающего 2FA", None
         
-        info = self.waiting_2fa[phone]
-        client = info['client']
+        client = await self._login_client(phone)
+        if not client:
+            return False, "Аккаунт не найден", None
         
         try:
             await client.connect()
@@ -2565,29 +4971,14 @@ class SessionManager:
             
             me = await client.get_me()
             
-            if db.db_url:
-                with db.get_cursor() as cursor:
-                    cursor.execute('''
-                        UPDATE tg_accounts 
-                        SET first_name = %s, last_name = %s, username = %s, user_id = %s, 
-                            status = 'active', last_used = %s, has_2fa = 1
-                        WHERE phone = %s
-                    ''', (me.first_name or '', me.last_name or '', me.username or '', 
-                          me.id, time.time(), phone))
-            else:
-                with db.get_cursor() as cursor:
-                    cursor.execute('''
-                        UPDATE tg_accounts 
-                        SET first_name = ?, last_name = ?, username = ?, user_id = ?, 
-                            status = 'active', last_used = ?, has_2fa = 1
-                        WHERE phone = ?
-                    ''', (me.first_name or '', me.last_name or '', me.username or '', 
-                          me.id, time.time(), phone))
+            await self._save_session(phone, client)
+            await adb.update_tg_account_profile(
+                phone, me.first_name or '', me.last_name or '', me.username or '', me.id, has_2fa=True
+            )
             
-            await client.disconnect()
-            del self.waiting_2fa[phone]
+            await self._clear_waiting(phone)
             
-            logger.info(f"✅ Аккаунт {phone} с 2FA добавлен, сессия сохранена в файл")
+            logger.info(f"✅ Аккаунт {phone} с 2FA добавлен, сессия сохранена в БД")
             return True, "Аккаунт успешно добавлен с 2FA", {
                 'id': me.id,
                 'first_name': me.first_name,
@@ -2599,58 +4990,142 @@ class SessionManager:
         except Exception as e:
             logger.error(f"❌ Ошибка подтверждения 2FA: {e}")
             return False, str(e), None
+        finally:
+            await self.close_client(client)
+    
+    async def cleanup(self):
+        """Очистка неактивных сессий (подстраховка к pending_logins_expirer)"""
+        await self.expire_pending_logins()
+
+# Инициализация менеджера сессий
+session_manager = SessionManager()
+
+# ================= ФУНКЦИИ ПРОВЕРКИ ПОДПИСОК =================
+
+# Ограничение частоты get_chat_member, чтобы не упираться в лимиты Bot API
+chat_member_limiter = TokenBucket(GET_CHAT_MEMBER_RATE, GET_CHAT_MEMBER_BURST)
+
+class MembershipIndex:
+    """Индекс подписок на обязательные каналы. Telegram присылает апдейты chat_member только
+    по каналам, где бот - администратор, поэтому индексу доверяем только для таких каналов"""
+    
+    ADMIN_STATUSES = ('administrator', 'creator')
     
-    async def cleanup(self):
-        """Очистка неактивных сессий"""
-        current_time = time.time()
-        to_remove = []
-        
-        for phone, info in self.waiting_codes.items():
-            if current_time - info['timestamp'] > 300:
-                to_remove.append(phone)
-        
-        for phone in to_remove:
-            del self.waiting_codes[phone]
-            logger.info(f"🧹 Очищена ожидающая сессия для {phone}")
+    def __init__(self):
+        self.members = {}  # (channel_id, user_id) -> подписан ли
+        self.negative_at = {}  # (channel_id, user_id) -> time.monotonic() записи "не подписан"
+        self.tracked = {}  # chat.id -> channel_id из таблицы channels (каналы, где бот - админ)
+        self.stats = {'hits': 0, 'misses': 0, 'events': 0}
+    
+    def is_tracked(self, channel_id: str) -> bool:
+        return channel_id in self.tracked.values()
+    
+    def lookup(self, user_id: int, channel_id: str) -> Optional[bool]:
+        """Ответ из индекса или None, если канал не отслеживается или пользователь неизвестен.
+        "Не подписан" живёт не дольше MEMBERSHIP_NEGATIVE_TTL, как и в кэше (загруженное из БД - сразу устаревшее)"""
+        if not self.is_tracked(channel_id):
+            return None
+        key = (channel_id, user_id)
+        is_member = self.members.get(key)
+        if is_member is False and time.monotonic() - self.negative_at.get(key, float('-inf')) > MEMBERSHIP_NEGATIVE_TTL:
+            is_member = None
+        self.stats['hits' if is_member is not None else 'misses'] += 1
+        return is_member
+    
+    async def refresh_channels(self):
+        """Определение каналов, где бот - админ, и загрузка их индекса из БД"""
+        tracked = {}
+        for channel in db.get_all_channels():
+            try:
+                chat = await bot.get_chat(channel['channel_id'])
+                me = await bot.get_chat_member(chat.id, bot.id)
+                if me.status in self.ADMIN_STATUSES:
+                    tracked[chat.id] = channel['channel_id']
+                else:
+                    logger.warning(f"⚠️ Бот не админ в {channel['channel_id']}, подписки проверяются запросами")
+            except Exception as e:
+                logger.error(f"❌ Ошибка проверки прав бота в {channel['channel_id']}: {e}")
         
-        # Очистка ожидающих 2FA
-        to_remove_2fa = []
-        for phone, info in self.waiting_2fa.items():
-            if current_time - info['timestamp'] > 300:
-                to_remove_2fa.append(phone)
+        # Каналы начинаем отслеживать до загрузки: апдейты, пришедшие во время неё, попадут в индекс
+        self.tracked = tracked
+        channel_ids = set(tracked.values())
+        for key in [key for key in self.members if key[0] not in channel_ids]:
+            del self.members[key]
+            self.negative_at.pop(key, None)
         
-        for phone in to_remove_2fa:
-            del self.waiting_2fa[phone]
-            logger.info(f"🧹 Очищена ожидающая 2FA для {phone}")
+        # Слияние, а не замена: записи из апдейтов, пришедших во время загрузки, свежее строк БД
+        for row in await adb.get_channel_members(list(channel_ids)):
+            self.members.setdefault((row['channel_id'], row['user_id']), bool(row['is_member']))
+        logger.info(f"📇 Индекс подписок: каналов={len(tracked)}, записей={len(self.members)}")
+    
+    async def record(self, channel_id: str, user_id: int, is_member: bool):
+        """Запись ответа в индекс (только для отслеживаемых каналов)"""
+        if not self.is_tracked(channel_id):
+            return
+        key = (channel_id, user_id)
+        if is_member:
+            self.negative_at.pop(key, None)
+        else:
+            self.negative_at[key] = time.monotonic()
+        if self.members.get(key) == is_member:
+            return
+        self.members[key] = is_member
+        await adb.set_channel_member(channel_id, user_id, is_member)
+    
+    async def on_chat_member(self, update: types.ChatMemberUpdated):
+        """Вступление или выход пользователя из отслеживаемого канала"""
+        channel_id = self.tracked.get(update.chat.id)
+        if channel_id is None:
+            return
+        member = update.new_chat_member
+        is_member = member.status not in ('left', 'kicked') and getattr(member, 'is_member', True) is not False
+        self.stats['events'] += 1
+        db.cache.delete('member', (member.user.id, channel_id))
+        await self.record(channel_id, member.user.id, is_member)
+    
+    def get_stats(self) -> Dict:
+        return {**self.stats, 'channels': len(self.tracked), 'entries': len(self.members)}
 
-# Инициализация менеджера сессий
-session_manager = SessionManager()
+membership_index = MembershipIndex()
 
-# ================= ФУНКЦИИ ПРОВЕРКИ ПОДПИСОК =================
+async def is_channel_member(user_id: int, channel_id, fresh: bool = False) -> bool:
+    """Подписан ли пользователь на канал. Сначала индекс из апдейтов chat_member, затем кэш:
+    "подписан" хранится MEMBERSHIP_TTL, "не подписан" - более короткий MEMBERSHIP_NEGATIVE_TTL.
+    fresh=True перепроверяет отрицательный ответ"""
+    indexed = membership_index.lookup(user_id, channel_id)
+    if indexed is True or (indexed is False and not fresh):
+        return indexed
+    
+    cached = db.cache.get('member', (user_id, channel_id))
+    if cached is True or (cached is False and not fresh):
+        return cached
+    
+    try:
+        await chat_member_limiter.acquire()
+        # Проверяем, является ли пользователь участником
+        member = await bot.get_chat_member(channel_id, user_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка проверки подписки на канал {channel_id}: {e}")
+        # Если не удалось проверить, считаем что не подписан (и не кэшируем)
+        return False
+    
+    # Если пользователь не участник или покинул канал
+    is_member = member.status not in ['left', 'kicked']
+    db.cache.set('member', (user_id, channel_id), is_member,
+                 ttl=MEMBERSHIP_TTL if is_member else MEMBERSHIP_NEGATIVE_TTL)
+    # Дальнейшие изменения по каналу, где бот - админ, придут апдейтами
+    await membership_index.record(channel_id, user_id, is_member)
+    return is_member
 
-async def check_subscriptions(user_id: int) -> Tuple[bool, List[Dict]]:
-    """Проверка подписок пользователя на каналы"""
+async def check_subscriptions(user_id: int, fresh: bool = False) -> Tuple[bool, List[Dict]]:
+    """Проверка подписок пользователя на каналы (все каналы проверяются параллельно)"""
     channels = db.get_all_channels()
-    if not channels:
+    mandatory = [channel for channel in channels if channel['is_mandatory']]
+    if not mandatory:
         return True, []  # Нет обязательных каналов
     
-    not_subscribed = []
-    
-    for channel in channels:
-        if not channel['is_mandatory']:
-            continue
-        
-        try:
-            # Проверяем, является ли пользователь участником
-            member = await bot.get_chat_member(channel['channel_id'], user_id)
-            
-            # Если пользователь не участник или покинул канал
-            if member.status in ['left', 'kicked']:
-                not_subscribed.append(channel)
-        except Exception as e:
-            logger.error(f"❌ Ошибка проверки подписки на канал {channel['channel_id']}: {e}")
-            # Если не удалось проверить, считаем что не подписан
-            not_subscribed.append(channel)
+    results = await asyncio.gather(*(is_channel_member(user_id, channel['channel_id'], fresh) for channel in mandatory))
+    not_subscribed = [channel for channel, is_member in zip(mandatory, results) if not is_member]
     
     return len(not_subscribed) == 0, not_subscribed
 
@@ -2703,16 +5178,15 @@ class AdminStates(StatesGroup):
 
 # ================= КЛАВИАТУРЫ =================
 
-def get_main_keyboard(user_id: int = None):
-    """Главная клавиатура"""
+def get_main_keyboard(user: Optional[Dict] = None):
+    """Главная клавиатура (по уже загруженной записи пользователя)"""
     keyboard = InlineKeyboardMarkup(row_width=2)
     keyboard.add(
         InlineKeyboardButton("📱 Доступные номера", callback_data="numbers_page_1"),
         InlineKeyboardButton("👤 Мой профиль", callback_data="profile"),
     )
     
-    user = db.get_user(user_id) if user_id else None
-    if user_id in ADMIN_IDS or (user and user.get('is_admin')):
+    if user and (is_admin(user['user_id']) or user.get('is_admin')):
         keyboard.add(InlineKeyboardButton("⚙️ Админ-панель", callback_data="admin"))
     
     return keyboard
@@ -2729,24 +5203,42 @@ def get_profile_keyboard():
     )
     return keyboard
 
-def get_numbers_keyboard(page: int, total_pages: int):
-    """Клавиатура для списка номеров с пагинацией"""
+def encode_numbers_cursor(number: Dict) -> str:
+    """Непрозрачный курсор позиции в каталоге номеров: (price_stars, id)"""
+    raw = f"{number['price_stars']}:{number['id']}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_numbers_cursor(token: str) -> Optional[Tuple[int, int]]:
+    """Разбор курсора каталога; None если курсор повреждён"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        price, number_id = raw.split(':')
+        return int(price), int(number_id)
+    except Exception:
+        return None
+
+def get_numbers_keyboard(page: int, total_pages: int, numbers: List[Dict], has_prev: bool, has_next: bool):
+    """Клавиатура для списка номеров с пагинацией по курсорам
+    (numbers_after_/numbers_before_/numbers_from_<стр>_<курсор>, первая страница - numbers_page_1)"""
     keyboard = InlineKeyboardMarkup(row_width=3)
     
     nav_buttons = []
-    if page > 1:
-        nav_buttons.append(InlineKeyboardButton("◀️", callback_data=f"numbers_page_{page-1}"))
+    if has_prev:
+        nav_buttons.append(InlineKeyboardButton(
+            "◀️", callback_data=f"numbers_before_{page-1}_{encode_numbers_cursor(numbers[0])}"))
     
     nav_buttons.append(InlineKeyboardButton(f"📄 {page}/{total_pages}", callback_data="current_page"))
     
-    if page < total_pages:
-        nav_buttons.append(InlineKeyboardButton("▶️", callback_data=f"numbers_page_{page+1}"))
+    if has_next:
+        nav_buttons.append(InlineKeyboardButton(
+            "▶️", callback_data=f"numbers_after_{page+1}_{encode_numbers_cursor(numbers[-1])}"))
     
     keyboard.row(*nav_buttons)
     
+    refresh_data = f"numbers_from_{page}_{encode_numbers_cursor(numbers[0])}" if page > 1 else "numbers_page_1"
     keyboard.row(
         InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu"),
-        InlineKeyboardButton("🔄 Обновить", callback_data=f"numbers_page_{page}")
+        InlineKeyboardButton("🔄 Обновить", callback_data=refresh_data)
     )
     
     return keyboard
@@ -2936,7 +5428,7 @@ class StarsPayment:
         """Создание платежа звёздами (мгновенное начисление)"""
         payment_id = str(uuid.uuid4())
         
-        success = db.add_stars(user_id, amount, "stars", payment_id)
+        success = await adb.add_stars(user_id, amount, "stars", payment_id)
         
         if success:
             logger.info(f"✅ Пользователь {user_id} пополнил {amount}⭐ звёздами")
@@ -2946,8 +5438,8 @@ class StarsPayment:
 # ================= ОБРАБОТЧИКИ КОМАНД =================
 
 @dp.message_handler(commands=['start'])
-async def cmd_start(message: Message):
-    """Обработчик команды /start"""
+async def cmd_start(message: Message, user: Optional[Dict] = None):
+    """Обработчик команды /start (пользователь уже загружен/зарегистрирован UserContextMiddleware)"""
     global last_message_time
     last_message_time = time.time()
     
@@ -2961,17 +5453,6 @@ async def cmd_start(message: Message):
         await message.reply("❌ Ошибка авторизации бота. Свяжитесь с администратором.")
         return
     
-    user = db.get_user(user_id)
-    if not user:
-        db.create_user(
-            user_id=user_id,
-            username=message.from_user.username or f"user_{user_id}",
-            first_name=message.from_user.first_name or "Пользователь"
-        )
-        logger.info(f"✅ Новый пользователь: {user_id}")
-    
-    db.update_user_activity(user_id)
-    
     # Проверяем подписки
     is_subscribed, not_subscribed = await check_subscriptions(user_id)
     
@@ -2984,28 +5465,29 @@ async def cmd_start(message: Message):
         return
     
     # Получаем настройки меню
-    welcome_text = db.get_welcome_text()
+    welcome_text = await adb.get_welcome_text()
     
     # ⚠️ МЕДИА ВРЕМЕННО ОТКЛЮЧЕНО для стабильности
     # Медиа можно будет загрузить через админку позже
     await message.reply(
         welcome_text,
-        reply_markup=get_main_keyboard(user_id)
+        reply_markup=get_main_keyboard(user)
     )
 
 @dp.callback_query_handler(lambda c: c.data == 'check_subscription')
-async def check_subscription_callback(callback: CallbackQuery):
+async def check_subscription_callback(callback: CallbackQuery, user: Optional[Dict] = None):
     """Проверка подписки после нажатия кнопки"""
     user_id = callback.from_user.id
     
-    is_subscribed, not_subscribed = await check_subscriptions(user_id)
+    # Пользователь говорит, что подписался - отрицательный ответ из кэша не годится
+    is_subscribed, not_subscribed = await check_subscriptions(user_id, fresh=True)
     
     if is_subscribed or is_admin(user_id):
-        welcome_text = db.get_welcome_text()
+        welcome_text = await adb.get_welcome_text()
         
         await callback.message.edit_text(
             "✅ <b>Спасибо за подписку!</b>\n\n" + welcome_text,
-            reply_markup=get_main_keyboard(user_id)
+            reply_markup=get_main_keyboard(user)
         )
     else:
         await callback.message.edit_text(
@@ -3014,6 +5496,17 @@ async def check_subscription_callback(callback: CallbackQuery):
             reply_markup=get_subscription_keyboard(not_subscribed)
         )
 
+@dp.chat_member_handler()
+async def channel_member_updated(update: types.ChatMemberUpdated):
+    """Подписка/отписка пользователя в канале, где бот - админ"""
+    await membership_index.on_chat_member(update)
+
+@dp.my_chat_member_handler()
+async def bot_member_updated(update: types.ChatMemberUpdated):
+    """Бота назначили или сняли с админа - пересобираем список отслеживаемых каналов"""
+    if update.chat.type == types.ChatType.CHANNEL:
+        await membership_index.refresh_channels()
+
 @dp.message_handler()
 async def track_all_messages(message: Message):
     """Отслеживание всех сообщений"""
@@ -3021,11 +5514,10 @@ async def track_all_messages(message: Message):
     last_message_time = time.time()
 
 @dp.callback_query_handler(lambda c: c.data == 'main_menu')
-async def main_menu(callback: CallbackQuery):
+async def main_menu(callback: CallbackQuery, user: Optional[Dict] = None):
     """Возврат в главное меню"""
     await callback.answer()
     user_id = callback.from_user.id
-    db.update_user_activity(user_id)
     
     # Проверяем подписки
     is_subscribed, not_subscribed = await check_subscriptions(user_id)
@@ -3038,42 +5530,27 @@ async def main_menu(callback: CallbackQuery):
         )
         return
     
-    welcome_text = db.get_welcome_text()
+    welcome_text = await adb.get_welcome_text()
     
     await callback.message.edit_text(
         welcome_text,
-        reply_markup=get_main_keyboard(user_id)
+        reply_markup=get_main_keyboard(user)
     )
 
 @dp.callback_query_handler(lambda c: c.data == 'profile')
-async def show_profile(callback: CallbackQuery):
+async def show_profile(callback: CallbackQuery, user: Optional[Dict] = None):
     """Показать профиль пользователя"""
     await callback.answer()
     user_id = callback.from_user.id
-    user = db.get_user(user_id)
-    db.update_user_activity(user_id)
     
     if not user:
         await callback.message.edit_text("❌ Ошибка загрузки профиля")
         return
     
-    purchases = 0
-    try:
-        if db.db_url:
-            with db.get_cursor() as cursor:
-                cursor.execute('SELECT COUNT(*) as count FROM transactions WHERE user_id = %s AND status = %s', 
-                              (user_id, 'completed'))
-                purchases = cursor.fetchone()['count'] or 0
-        else:
-            with db.get_cursor() as cursor:
-                cursor.execute('SELECT COUNT(*) as count FROM transactions WHERE user_id = ? AND status = "completed"', 
-                              (user_id,))
-                purchases = cursor.fetchone()['count'] or 0
-    except Exception as e:
-        logger.error(f"Ошибка получения транзакций: {e}")
+    purchases = await adb.count_user_purchases(user_id)
     
     balance_display = get_user_balance_display(user_id, user['stars_balance'])
-    profile_text = db.get_profile_text()
+    profile_text = await adb.get_profile_text()
     
     text = f"""
 {profile_text}
@@ -3105,9 +5582,9 @@ async def admin_edit_menu(callback: CallbackQuery):
     if not is_admin(callback.from_user.id):
         return
     
-    welcome_text = db.get_welcome_text()
-    profile_text = db.get_profile_text()
-    welcome_media = db.get_welcome_media()
+    welcome_text = await adb.get_welcome_text()
+    profile_text = await adb.get_profile_text()
+    welcome_media = await adb.get_welcome_media()
     
     media_status = "✅ Есть" if welcome_media else "❌ Нет"
     
@@ -3132,7 +5609,7 @@ async def edit_welcome_text(callback: CallbackQuery, state: FSMContext):
     """Редактирование текста приветствия"""
     await callback.answer()
     
-    current_text = db.get_welcome_text()
+    current_text = await adb.get_welcome_text()
     
     await callback.message.edit_text(
         f"✏️ <b>Редактирование текста приветствия</b>\n\n"
@@ -3148,7 +5625,7 @@ async def save_welcome_text(message: Message, state: FSMContext):
     """Сохранение текста приветствия"""
     new_text = message.text.strip()
     
-    success = db.set_setting('welcome_text', new_text)
+    success = await adb.set_setting('welcome_text', new_text)
     
     if success:
         await message.reply(
@@ -3172,7 +5649,7 @@ async def edit_profile_text(callback: CallbackQuery, state: FSMContext):
     """Редактирование текста профиля"""
     await callback.answer()
     
-    current_text = db.get_profile_text()
+    current_text = await adb.get_profile_text()
     
     await callback.message.edit_text(
         f"✏️ <b>Редактирование текста профиля</b>\n\n"
@@ -3188,7 +5665,7 @@ async def save_profile_text(message: Message, state: FSMContext):
     """Сохранение текста профиля"""
     new_text = message.text.strip()
     
-    success = db.set_setting('profile_text', new_text)
+    success = await adb.set_setting('profile_text', new_text)
     
     if success:
         await message.reply(
@@ -3242,7 +5719,7 @@ async def handle_media_upload(message: Message):
         await message.reply("❌ Пожалуйста, отправьте фото или GIF-анимацию")
         return
     
-    success = db.set_setting('welcome_media', media_id)
+    success = await adb.set_setting('welcome_media', media_id)
     
     if success:
         # Отправляем превью
@@ -3277,7 +5754,7 @@ async def delete_media(callback: CallbackQuery):
     """Удаление медиа"""
     await callback.answer()
     
-    success = db.set_setting('welcome_media', '')
+    success = await adb.set_setting('welcome_media', '')
     
     if success:
         await callback.message.edit_text(
@@ -3333,10 +5810,11 @@ async def process_stars_amount(message: Message, state: FSMContext):
     payment_id = await StarsPayment.create_payment(user_id, amount)
     
     if payment_id:
+        updated_user = await adb.get_user(user_id)
         await message.reply(
             f"✅ <b>Пополнение успешно!</b>\n\n"
             f"➕ Добавлено: {amount} ⭐️\n"
-            f"💰 Новый баланс: {db.get_user(user_id)['stars_balance']} ⭐️",
+            f"💰 Новый баланс: {updated_user['stars_balance'] if updated_user else '?'} ⭐️",
             reply_markup=InlineKeyboardMarkup().add(
                 InlineKeyboardButton("👤 Профиль", callback_data="profile"),
                 InlineKeyboardButton("📱 Номера", callback_data="numbers_page_1")
@@ -3409,7 +5887,7 @@ async def process_topup_amount(message: Message, state: FSMContext):
     method = data.get('payment_method')
     user_id = message.from_user.id
     
-    topup = db.create_topup(user_id, amount, method)
+    topup = await adb.create_topup(user_id, amount, method)
     
     if not topup:
         await message.reply("❌ Ошибка создания пополнения")
@@ -3475,11 +5953,11 @@ async def check_topup(callback: CallbackQuery):
     
     payment_id = callback.data.replace('check_topup_', '')
     
-    success = db.complete_topup(payment_id)
+    success = await adb.complete_topup(payment_id)
     
     if success:
-        topup = db.get_topup(payment_id)
-        user = db.get_user(topup['user_id'])
+        topup = await adb.get_topup(payment_id)
+        user = await adb.get_user(topup['user_id'])
         
         await callback.message.edit_text(
             f"✅ <b>Пополнение успешно!</b>\n\n"
@@ -3500,19 +5978,38 @@ async def check_topup(callback: CallbackQuery):
 
 # ================= РАЗДЕЛ ПОКУПКИ НОМЕРОВ =================
 
-@dp.callback_query_handler(lambda c: c.data.startswith('numbers_page_'))
+@dp.callback_query_handler(lambda c: c.data.startswith(('numbers_page_', 'numbers_after_',
+                                                      'numbers_before_', 'numbers_from_')))
 async def show_numbers(callback: CallbackQuery):
-    """Показать список доступных номеров с пагинацией"""
+    """Показать список доступных номеров с пагинацией по курсорам"""
     await callback.answer()
-    db.update_user_activity(callback.from_user.id)
     
-    try:
-        page = int(callback.data.split('_')[2])
-    except:
-        page = 1
+    page_size = 5
+    page, direction, position = 1, None, None
+    parts = callback.data.split('_', 3)
+    if len(parts) == 4 and parts[1] in ('after', 'before', 'from'):
+        position = decode_numbers_cursor(parts[3])
+        if position:
+            direction = parts[1]
+            try:
+                page = max(1, int(parts[2]))
+            except ValueError:
+                page = 1
+    
+    numbers, has_more = await adb.get_available_numbers(limit=page_size, **({direction: position} if direction else {}))
+    
+    if direction and (not numbers or (direction == 'before' and len(numbers) < page_size)):
+        # Номера вокруг курсора раскуплены или перед ним меньше полной страницы - показываем начало каталога
+        page, direction = 1, None
+        numbers, has_more = await adb.get_available_numbers(limit=page_size)
+    
+    if direction == 'before':
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = direction is not None and page > 1, has_more
     
-    numbers, total = db.get_available_numbers(page=page, limit=5)
-    total_pages = max(1, (total + 4) // 5)
+    total = await adb.get_available_numbers_count()
+    total_pages = max(1, (total + page_size - 1) // page_size, page)
     
     if not numbers:
         await callback.message.edit_text(
@@ -3535,11 +6032,11 @@ async def show_numbers(callback: CallbackQuery):
     
     text += "Для покупки нажмите /buy_ ID (например: /buy_1)"
     
-    keyboard = get_numbers_keyboard(page, total_pages)
+    keyboard = get_numbers_keyboard(page, total_pages, numbers, has_prev, has_next)
     await callback.message.edit_text(text, reply_markup=keyboard)
 
 @dp.message_handler(lambda message: message.text and message.text.startswith('/buy_'))
-async def buy_number_command(message: Message, state: FSMContext):
+async def buy_number_command(message: Message, state: FSMContext, user: Optional[Dict] = None):
     """Обработка команды покупки по ID"""
     try:
         number_id = int(message.text.split('_')[1])
@@ -3548,7 +6045,6 @@ async def buy_number_command(message: Message, state: FSMContext):
         return
     
     user_id = message.from_user.id
-    db.update_user_activity(user_id)
     
     # Проверяем подписки
     is_subscribed, not_subscribed = await check_subscriptions(user_id)
@@ -3561,22 +6057,25 @@ async def buy_number_command(message: Message, state: FSMContext):
         )
         return
     
-    number = db.get_number(number_id)
+    number = await adb.get_number(number_id)
     
     if not number:
         await message.reply("❌ Номер не найден")
         return
     
+    if number['status'] == 'held':
+        await message.reply("⏳ Номер сейчас забронирован и ожидает оплаты. Попробуйте позже или выберите другой.")
+        return
+    
     if number['status'] != 'available':
         await message.reply("❌ Номер уже недоступен")
         return
     
-    user = db.get_user(user_id)
     if not user:
         await message.reply("❌ Сначала запустите бота командой /start")
         return
     
-    if not can_afford(user_id, number['price_stars']):
+    if not can_afford(user, number['price_stars']):
         balance_display = get_user_balance_display(user_id, user['stars_balance'])
         await message.reply(
             f"❌ Недостаточно звёзд!\n\n"
@@ -3608,13 +6107,13 @@ async def pay_yoomoney(callback: CallbackQuery, state: FSMContext):
     """Оплата через ЮMoney"""
     await callback.answer()
     user_id = callback.from_user.id
-    db.update_user_activity(user_id)
     
     number_id = int(callback.data.split('_')[2])
-    number = db.get_number(number_id)
+    # Бронируем номер за покупателем, пока идёт внешняя оплата
+    number = await adb.hold_number(number_id, user_id, NUMBER_HOLD_TTL)
     
-    if not number or number['status'] != 'available':
-        await callback.message.edit_text("❌ Номер уже недоступен")
+    if not number:
+        await callback.message.edit_text("❌ Номер уже недоступен или забронирован другим покупателем")
         return
     
     payment_id = str(uuid.uuid4())
@@ -3625,20 +6124,9 @@ async def pay_yoomoney(callback: CallbackQuery, state: FSMContext):
     )
     
     if payment_url:
-        if db.db_url:
-            with db.get_cursor() as cursor:
-                cursor.execute('''
-                    INSERT INTO payments (id, user_id, number_id, amount_rub, stars_amount, payment_system, created_at, payment_url)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                ''', (payment_id, user_id, number_id, number['price_rub'], number['price_stars'], 
-                      'yoomoney', time.time(), payment_url))
-        else:
-            with db.get_cursor() as cursor:
-                cursor.execute('''
-                    INSERT INTO payments (id, user_id, number_id, amount_rub, stars_amount, payment_system, created_at, payment_url)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (payment_id, user_id, number_id, number['price_rub'], number['price_stars'], 
-                      'yoomoney', time.time(), payment_url))
+        await adb.create_payment(payment_id, user_id, number_id, number['price_rub'], number['price_stars'],
+                                 'yoomoney', payment_url)
+        await adb.attach_hold_payment(number_id, user_id, payment_id)
         
         logger.info(f"✅ Создан платеж {payment_id} для пользователя {user_id}")
         
@@ -3649,6 +6137,7 @@ async def pay_yoomoney(callback: CallbackQuery, state: FSMContext):
             f"1. Нажмите кнопку «💳 Оплатить»\n"
             f"2. Оплатите в ЮMoney\n"
             f"3. Нажмите «✅ Я оплатил»\n\n"
+            f"⏳ Номер забронирован за вами на {NUMBER_HOLD_TTL // 60} мин.\n"
             f"После подтверждения вы получите код!",
             reply_markup=InlineKeyboardMarkup().add(
                 InlineKeyboardButton("💳 Оплатить", url=payment_url),
@@ -3657,6 +6146,7 @@ async def pay_yoomoney(callback: CallbackQuery, state: FSMContext):
             )
         )
     else:
+        await adb.release_hold(number_id, user_id)
         await callback.message.edit_text(
             "❌ Ошибка создания платежа. Попробуйте позже.",
             reply_markup=get_back_keyboard("numbers_page_1")
@@ -3667,13 +6157,13 @@ async def pay_cryptobot(callback: CallbackQuery, state: FSMContext):
     """Оплата через Crypto Bot"""
     await callback.answer()
     user_id = callback.from_user.id
-    db.update_user_activity(user_id)
     
     number_id = int(callback.data.split('_')[2])
-    number = db.get_number(number_id)
+    # Бронируем номер за покупателем, пока идёт внешняя оплата
+    number = await adb.hold_number(number_id, user_id, NUMBER_HOLD_TTL)
     
-    if not number or number['status'] != 'available':
-        await callback.message.edit_text("❌ Номер уже недоступен")
+    if not number:
+        await callback.message.edit_text("❌ Номер уже недоступен или забронирован другим покупателем")
         return
     
     payment_id = str(uuid.uuid4())
@@ -3684,20 +6174,9 @@ async def pay_cryptobot(callback: CallbackQuery, state: FSMContext):
     )
     
     if payment_url:
-        if db.db_url:
-            with db.get_cursor() as cursor:
-                cursor.execute('''
-                    INSERT INTO payments (id, user_id, number_id, amount_rub, stars_amount, payment_system, created_at, payment_url)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                ''', (payment_id, user_id, number_id, number['price_rub'], number['price_stars'], 
-                      'cryptobot', time.time(), payment_url))
-        else:
-            with db.get_cursor() as cursor:
-                cursor.execute('''
-                    INSERT INTO payments (id, user_id, number_id, amount_rub, stars_amount, payment_system, created_at, payment_url)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (payment_id, user_id, number_id, number['price_rub'], number['price_stars'], 
-                      'cryptobot', time.time(), payment_url))
+        await adb.create_payment(payment_id, user_id, number_id, number['price_rub'], number['price_stars'],
+                                 'cryptobot', payment_url)
+        await adb.attach_hold_payment(number_id, user_id, payment_id)
         
         logger.info(f"✅ Создан платеж {payment_id} для пользователя {user_id}")
         
@@ -3708,6 +6187,7 @@ async def pay_cryptobot(callback: CallbackQuery, state: FSMContext):
             f"1. Нажмите кнопку «₿ Оплатить»\n"
             f"2. Оплатите в Crypto Bot\n"
             f"3. Нажмите «✅ Я оплатил»\n\n"
+            f"⏳ Номер забронирован за вами на {NUMBER_HOLD_TTL // 60} мин.\n"
             f"После подтверждения вы получите код!",
             reply_markup=InlineKeyboardMarkup().add(
                 InlineKeyboardButton("₿ Оплатить", url=payment_url),
@@ -3716,6 +6196,7 @@ async def pay_cryptobot(callback: CallbackQuery, state: FSMContext):
             )
         )
     else:
+        await adb.release_hold(number_id, user_id)
         await callback.message.edit_text(
             "❌ Ошибка создания платежа. Попробуйте позже.",
             reply_markup=get_back_keyboard("numbers_page_1")
@@ -3726,88 +6207,54 @@ async def check_payment(callback: CallbackQuery, state: FSMContext):
     """Проверка статуса платежа"""
     await callback.answer()
     user_id = callback.from_user.id
-    db.update_user_activity(user_id)
     
     payment_id = callback.data.replace('check_payment_', '')
     
-    payment = None
-    if db.db_url:
-        with db.get_cursor() as cursor:
-            cursor.execute('SELECT * FROM payments WHERE id = %s', (payment_id,))
-            payment = cursor.fetchone()
-    else:
-        with db.get_cursor() as cursor:
-            cursor.execute('SELECT * FROM payments WHERE id = ?', (payment_id,))
-            payment = cursor.fetchone()
+    payment = await adb.get_payment(payment_id)
     
     if not payment:
         await callback.message.edit_text("❌ Платёж не найден")
         return
     
-    payment = dict(payment)
-    
     if payment['status'] == 'completed':
         await callback.message.edit_text("✅ Платёж уже обработан!")
         return
     
-    # Для админов не списываем звёзды, но проводим покупку
+    # Платёж, резерв номера и списание проводятся одной транзакцией;
+    # для админов звёзды не списываются, но номер резервируется так же
+    result, new_balance = await adb.complete_payment(payment, charge=not is_admin(user_id))
+    
+    if result == 'already_completed':
+        await callback.message.edit_text("✅ Платёж уже обработан!")
+        return
+    if result == 'number_unavailable':
+        await callback.message.edit_text(
+            "❌ Этот номер уже купил другой пользователь.\n\n"
+            "Обратитесь к администратору для возврата средств.",
+            reply_markup=get_back_keyboard("numbers_page_1")
+        )
+        return
+    if result == 'insufficient_funds':
+        await callback.message.edit_text(
+            "❌ Недостаточно звёзд для завершения покупки.\n\n"
+            "Пополните баланс в разделе Профиль",
+            reply_markup=get_back_keyboard("profile")
+        )
+        return
+    
     if is_admin(user_id):
-        # Админы могут покупать без списания
-        success = True
         new_balance = "∞"
         logger.info(f"👑 Админ {user_id} купил номер {payment['number_id']} (бесплатно)")
-    else:
-        # Обычным пользователям списываем
-        if db.db_url:
-            with db.get_cursor() as cursor:
-                cursor.execute('''
-                    UPDATE payments SET status = 'completed', completed_at = %s WHERE id = %s
-                ''', (time.time(), payment_id))
-                
-                cursor.execute('''
-                    UPDATE users SET stars_balance = stars_balance - %s WHERE user_id = %s
-                ''', (payment['stars_amount'], payment['user_id']))
-                
-                cursor.execute('''
-                    UPDATE transactions SET status = 'completed', completed_at = %s 
-                    WHERE user_id = %s AND number_id = %s
-                ''', (time.time(), payment['user_id'], payment['number_id']))
-                
-                cursor.execute('SELECT stars_balance FROM users WHERE user_id = %s', (payment['user_id'],))
-                row = cursor.fetchone()
-                new_balance = row['stars_balance'] if row else 0
-        else:
-            with db.get_cursor() as cursor:
-                cursor.execute('''
-                    UPDATE payments SET status = 'completed', completed_at = ? WHERE id = ?
-                ''', (time.time(), payment_id))
-                
-                cursor.execute('''
-                    UPDATE users SET stars_balance = stars_balance - ? WHERE user_id = ?
-                ''', (payment['stars_amount'], payment['user_id']))
-                
-                cursor.execute('''
-                    UPDATE transactions SET status = 'completed', completed_at = ? 
-                    WHERE user_id = ? AND number_id = ?
-                ''', (time.time(), payment['user_id'], payment['number_id']))
-                
-                cursor.execute('SELECT stars_balance FROM users WHERE user_id = ?', (payment['user_id'],))
-                row = cursor.fetchone()
-                new_balance = row['stars_balance'] if row else 0
     
     logger.info(f"✅ Платеж {payment_id} завершен, пользователь {payment['user_id']} получил доступ к номеру")
+    await log_sink.system('INFO', 'payments',
+                          f"платеж {payment_id} завершен: user={payment['user_id']} number={payment['number_id']}")
     
-    account = db.get_available_tg_account()
-    if account:
-        success = await session_manager.request_code(
-            account['phone'], 
-            payment['number_id'], 
-            payment['user_id']
-        )
-        
-        if success:
+    phone, attempts = await session_manager.request_code_any(payment['number_id'], payment['user_id'])
+    if attempts:
+        if phone:
             await state.update_data(
-                phone=account['phone'],
+                phone=phone,
                 number_id=payment['number_id'],
                 payment_id=payment_id
             )
@@ -3818,7 +6265,7 @@ async def check_payment(callback: CallbackQuery, state: FSMContext):
                 f"✅ <b>Оплата успешна!</b>\n\n"
                 f"💰 На ваш баланс зачислено: {payment['stars_amount']} ⭐️\n"
                 f"💎 Новый баланс: {balance_text} ⭐️\n\n"
-                f"📲 На номер {account['phone']} отправлен код подтверждения.\n"
+                f"📲 На номер {phone} отправлен код подтверждения.\n"
                 f"✏️ Введите код из Telegram:",
                 reply_markup=InlineKeyboardMarkup().add(
                     InlineKeyboardButton("❌ Отмена", callback_data="main_menu")
@@ -3844,12 +6291,67 @@ async def check_payment(callback: CallbackQuery, state: FSMContext):
             )
         )
 
+async def deliver_purchase_code(user_id: int, number_id: int, code: str):
+    """Выдача купленного номера с кодом покупателю и уведомление админов"""
+    number = await adb.get_number(number_id)
+    await adb.delete_sold_number(number_id)
+    
+    await bot.send_message(
+        user_id,
+        f"✅ <b>Номер успешно получен!</b>\n\n"
+        f"📞 <b>Номер:</b> <code>{number['phone_number']}</code>\n"
+        f"🔑 <b>Код:</b> <code>{code}</code>\n\n"
+        f"📝 <b>Инструкция:</b>\n"
+        f"1. Откройте Telegram\n"
+        f"2. Введите номер {number['phone_number']}\n"
+        f"3. Введите код {code}\n"
+        f"4. Готово!\n\n"
+        f"⏱ Код действителен 1 час.\n\n"
+        f"🔐 Аккаунт теперь ваш! Сессия будет жить вечно.",
+        reply_markup=InlineKeyboardMarkup().add(
+            InlineKeyboardButton("📱 Купить ещё", callback_data="numbers_page_1"),
+            InlineKeyboardButton("👤 Профиль", callback_data="profile")
+        )
+    )
+    logger.info(f"✅ Пользователь {user_id} получил код для номера {number['phone_number']}")
+    
+    for admin_id in ADMIN_IDS:
+        try:
+            await bot.send_message(
+                admin_id,
+                f"💰 <b>Продажа!</b>\n\n"
+                f"👤 Покупатель: {user_id}\n"
+                f"📞 Номер: {number['phone_number']}\n"
+                f"💰 Цена: {number['price_stars']}⭐\n"
+                f"🔑 Код: {code}"
+            )
+        except Exception as e:
+            logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
+
+async def deliver_login_result(user_id: int, phone: str, number_id: int, result: Dict):
+    """Выдача результата входа покупателю: номер с кодом или запрос пароля 2FA"""
+    state = dp.current_state(chat=user_id, user=user_id)
+    
+    if 'code' in result:
+        await deliver_purchase_code(user_id, number_id, result['code'])
+        await state.finish()
+    elif result.get('error') == '2fa_required':
+        await state.update_data(phone=phone, number_id=number_id)
+        await bot.send_message(
+            user_id,
+            "🔐 <b>Требуется двухфакторная аутентификация</b>\n\n"
+            "Введите пароль 2FA:",
+            reply_markup=InlineKeyboardMarkup().add(
+                InlineKeyboardButton("❌ Отмена", callback_data="main_menu")
+            )
+        )
+        await state.set_state(BuyStates.waiting_for_2fa)
+
 @dp.message_handler(state=BuyStates.waiting_for_code)
 async def process_code(message: Message, state: FSMContext):
     """Обработка введенного кода"""
     code = message.text.strip()
     user_id = message.from_user.id
-    db.update_user_activity(user_id)
     
     data = await state.get_data()
     phone = data.get('phone')
@@ -3863,52 +6365,11 @@ async def process_code(message: Message, state: FSMContext):
     
     result = await session_manager.submit_code(phone, code)
     
-    if result and 'code' in result:
-        number = db.get_number(number_id)
-        db.delete_sold_number(number_id)
-        
-        await message.reply(
-            f"✅ <b>Номер успешно получен!</b>\n\n"
-            f"📞 <b>Номер:</b> <code>{number['phone_number']}</code>\n"
-            f"🔑 <b>Код:</b> <code>{result['code']}</code>\n\n"
-            f"📝 <b>Инструкция:</b>\n"
-            f"1. Откройте Telegram\n"
-            f"2. Введите номер {number['phone_number']}\n"
-            f"3. Введите код {result['code']}\n"
-            f"4. Готово!\n\n"
-            f"⏱ Код действителен 1 час.\n\n"
-            f"🔐 Аккаунт теперь ваш! Сессия будет жить вечно.",
-            reply_markup=InlineKeyboardMarkup().add(
-                InlineKeyboardButton("📱 Купить ещё", callback_data="numbers_page_1"),
-                InlineKeyboardButton("👤 Профиль", callback_data="profile")
-            )
-        )
-        logger.info(f"✅ Пользователь {user_id} получил код для номера {number['phone_number']}")
-        
-        for admin_id in ADMIN_IDS:
-            try:
-                await bot.send_message(
-                    admin_id,
-                    f"💰 <b>Продажа!</b>\n\n"
-                    f"👤 Покупатель: {user_id}\n"
-                    f"📞 Номер: {number['phone_number']}\n"
-                    f"💰 Цена: {number['price_stars']}⭐\n"
-                    f"🔑 Код: {result['code']}"
-                )
-            except Exception as e:
-                logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
-        
-        await state.finish()
-    elif result and result.get('error') == '2fa_required':
-        await state.update_data(phone=phone, number_id=number_id)
-        await message.reply(
-            "🔐 <b>Требуется двухфакторная аутентификация</b>\n\n"
-            "Введите пароль 2FA:",
-            reply_markup=InlineKeyboardMarkup().add(
-                InlineKeyboardButton("❌ Отмена", callback_data="main_menu")
-            )
-        )
-        await BuyStates.waiting_for_2fa.set()
+    if result and ('code' in result or result.get('error') == '2fa_required'):
+        await deliver_login_result(user_id, phone, number_id, result)
+    elif result is None and await state.get_state() is None:
+        # Код уже перехвачен автоматически, номер выдан, пока покупатель вводил его вручную
+        return
     elif result and result.get('error') == 'invalid_code':
         await message.reply("❌ Неверный код. Попробуйте ещё раз:")
     else:
@@ -3937,26 +6398,7 @@ async def process_2fa(message: Message, state: FSMContext):
     result = await session_manager.submit_2fa(phone, password)
     
     if result and 'code' in result:
-        number = db.get_number(number_id)
-        db.delete_sold_number(number_id)
-        
-        await message.reply(
-            f"✅ <b>Номер успешно получен!</b>\n\n"
-            f"📞 <b>Номер:</b> <code>{number['phone_number']}</code>\n"
-            f"🔑 <b>Код:</b> <code>{result['code']}</code>\n\n"
-            f"📝 <b>Инструкция:</b>\n"
-            f"1. Откройте Telegram\n"
-            f"2. Введите номер {number['phone_number']}\n"
-            f"3. Введите код {result['code']}\n"
-            f"4. Готово!\n\n"
-            f"⏱ Код действителен 1 час.\n\n"
-            f"🔐 Аккаунт теперь ваш! Сессия будет жить вечно.",
-            reply_markup=InlineKeyboardMarkup().add(
-                InlineKeyboardButton("📱 Купить ещё", callback_data="numbers_page_1"),
-                InlineKeyboardButton("👤 Профиль", callback_data="profile")
-            )
-        )
-        logger.info(f"✅ Пользователь {message.from_user.id} получил код с 2FA")
+        await deliver_purchase_code(message.from_user.id, number_id, result['code'])
         await state.finish()
     elif result and result.get('error') == 'invalid_password':
         await message.reply("❌ Неверный пароль 2FA. Попробуйте ещё раз:")
@@ -3980,7 +6422,7 @@ async def admin_panel(callback: CallbackQuery):
         await callback.message.edit_text("⛔ У вас нет доступа к админ-панели")
         return
     
-    stats = db.get_stats()
+    stats = await adb.get_stats()
     
     cpu_percent = psutil.cpu_percent(interval=1)
     memory = psutil.virtual_memory()
@@ -3988,7 +6430,7 @@ async def admin_panel(callback: CallbackQuery):
     uptime = time.time() - start_time
     ping_count_global = ping_count
     
-    welcome_media = db.get_welcome_media()
+    welcome_media = await adb.get_welcome_media()
     media_status = "✅ Есть" if welcome_media else "❌ Нет"
     
     # Добавляем информацию о памяти
@@ -4061,7 +6503,7 @@ async def admin_accounts(callback: CallbackQuery):
     """Список всех аккаунтов"""
     await callback.answer()
     
-    accounts = db.get_all_tg_accounts()
+    accounts = await adb.get_all_tg_accounts()
     
     if not accounts:
         await callback.message.edit_text(
@@ -4073,6 +6515,7 @@ async def admin_accounts(callback: CallbackQuery):
         )
         return
     
+    session_phones = await adb.get_tg_session_phones()
     text = "📱 <b>Аккаунты Telegram:</b>\n\n"
     for acc in accounts[:10]:
         status_emoji = "✅" if acc['status'] == 'active' else "⏳" if acc['status'] == 'pending' else "❌"
@@ -4086,12 +6529,10 @@ async def admin_accounts(callback: CallbackQuery):
         if acc.get('last_code'):
             text += f"   🔑 Последний код: {acc['last_code']}\n"
         text += f"   📅 Добавлен: {datetime.fromtimestamp(acc['added_at']).strftime('%d.%m.%Y')}\n"
-        # Проверяем наличие файла сессии
-        session_path = os.path.join(SESSIONS_DIR, acc['session_name'])
-        if os.path.exists(f"{session_path}.session"):
-            text += f"   💾 Файл сессии: ✅\n"
+        if acc['phone'] in session_phones:
+            text += f"   💾 Сессия: ✅\n"
         else:
-            text += f"   💾 Файл сессии: ❌\n"
+            text += f"   💾 Сессия: ❌\n"
         text += "\n"
     
     await callback.message.edit_text(
@@ -4108,7 +6549,7 @@ async def account_detail(callback: CallbackQuery):
     await callback.answer()
     
     phone = callback.data.replace('account_', '')
-    account = db.get_tg_account(phone)
+    account = await adb.get_tg_account(phone)
     
     if not account:
         await callback.message.edit_text("❌ Аккаунт не найден")
@@ -4131,9 +6572,6 @@ async def account_detail(callback: CallbackQuery):
 <b>Действия:</b>
 """
     
-    session_path = os.path.join(SESSIONS_DIR, account['session_name'])
-    has_file = os.path.exists(f"{session_path}.session")
-    
     await callback.message.edit_text(
         text,
         reply_markup=get_account_detail_keyboard(phone)
@@ -4300,15 +6738,7 @@ async def admin_numbers(callback: CallbackQuery):
     """Список всех номеров"""
     await callback.answer()
     
-    numbers = []
-    if db.db_url:
-        with db.get_cursor() as cursor:
-            cursor.execute('SELECT * FROM numbers ORDER BY id DESC LIMIT 20')
-            numbers = [dict(row) for row in cursor.fetchall()]
-    else:
-        with db.get_cursor() as cursor:
-            cursor.execute('SELECT * FROM numbers ORDER BY id DESC LIMIT 20')
-            numbers = [dict(row) for row in cursor.fetchall()]
+    numbers = await adb.get_recent_numbers(limit=20)
     
     if not numbers:
         await callback.message.edit_text(
@@ -4348,7 +6778,7 @@ async def number_detail(callback: CallbackQuery):
     await callback.answer()
     
     number_id = int(callback.data.replace('number_view_', ''))
-    number = db.get_number(number_id)
+    number = await adb.get_number(number_id)
     
     if not number:
         await callback.message.edit_text("❌ Номер не найден")
@@ -4356,7 +6786,7 @@ async def number_detail(callback: CallbackQuery):
     
     buyer_info = "Нет"
     if number.get('sold_to'):
-        buyer = db.get_user(number['sold_to'])
+        buyer = await adb.get_user(number['sold_to'])
         buyer_info = f"{number['sold_to']} (@{buyer['username'] if buyer else 'неизвестно'})"
     
     text = f"""
@@ -4390,7 +6820,7 @@ async def delete_number(callback: CallbackQuery):
     
     number_id = int(callback.data.replace('delete_number_', ''))
     
-    success = db.delete_number(number_id)
+    success = await adb.delete_number(number_id)
     
     if success:
         await callback.message.edit_text(
@@ -4477,7 +6907,7 @@ async def admin_add_number_price(message: Message, state: FSMContext):
     
     data = await state.get_data()
     
-    success = db.add_number(
+    success = await adb.add_number(
         phone=data['phone'],
         country=data['country'],
         description=data['desc'],
@@ -4600,7 +7030,7 @@ async def channel_add_link(message: Message, state: FSMContext):
     else:
         channel_url = invite_link
     
-    success = db.add_channel(
+    success = await adb.add_channel(
         channel_id=channel_id,
         channel_name=channel_name,
         channel_url=channel_url,
@@ -4609,6 +7039,7 @@ async def channel_add_link(message: Message, state: FSMContext):
     )
     
     if success:
+        asyncio.create_task(membership_index.refresh_channels())
         await message.reply(
             f"✅ <b>Канал успешно добавлен!</b>\n\n"
             f"📢 {channel_name}\n"
@@ -4635,8 +7066,7 @@ async def channel_view(callback: CallbackQuery):
     
     channel_id = callback.data.replace('channel_view_', '')
     
-    channels = db.get_all_channels()
-    channel = next((c for c in channels if c['channel_id'] == channel_id), None)
+    channel = db.get_channel(channel_id)
     
     if not channel:
         await callback.message.edit_text("❌ Канал не найден")
@@ -4683,15 +7113,25 @@ async def channel_toggle(callback: CallbackQuery):
     
     channel_id = callback.data.replace('channel_toggle_', '')
     
-    # Здесь нужно добавить метод для обновления статуса канала
-    # Для простоты пока удалим и предложим добавить заново
+    is_mandatory = await adb.toggle_channel_mandatory(channel_id)
+    
+    if is_mandatory is None:
+        await callback.message.edit_text(
+            "❌ Канал не найден",
+            reply_markup=InlineKeyboardMarkup().add(
+                InlineKeyboardButton("◀️ Назад", callback_data="admin_channels")
+            )
+        )
+        return
     
+    status = "✅ обязательно" if is_mandatory else "❌ необязательно"
     await callback.message.edit_text(
-        "❌ Функция в разработке. Удалите и добавьте канал заново с нужным статусом.",
+        f"✅ <b>Статус канала изменён:</b> {status}",
         reply_markup=InlineKeyboardMarkup().add(
-            InlineKeyboardButton("◀️ Назад", callback_data="admin_channels")
+            InlineKeyboardButton("◀️ Назад к каналу", callback_data=f"channel_view_{channel_id}")
         )
     )
+    logger.info(f"✅ Канал {channel_id}: {status}")
 
 @dp.callback_query_handler(lambda c: c.data.startswith('channel_delete_'))
 async def channel_delete(callback: CallbackQuery):
@@ -4700,9 +7140,10 @@ async def channel_delete(callback: CallbackQuery):
     
     channel_id = callback.data.replace('channel_delete_', '')
     
-    success = db.delete_channel(channel_id)
+    success = await adb.delete_channel(channel_id)
     
     if success:
+        asyncio.create_task(membership_index.refresh_channels())
         await callback.message.edit_text(
             "✅ <b>Канал успешно удален</b>",
             reply_markup=InlineKeyboardMarkup().add(
@@ -4725,15 +7166,7 @@ async def admin_users(callback: CallbackQuery):
     """Список всех пользователей"""
     await callback.answer()
     
-    users = []
-    if db.db_url:
-        with db.get_cursor() as cursor:
-            cursor.execute('SELECT user_id, username, first_name, stars_balance, is_admin, banned, registered_at FROM users ORDER BY registered_at DESC LIMIT 20')
-            users = [dict(row) for row in cursor.fetchall()]
-    else:
-        with db.get_cursor() as cursor:
-            cursor.execute('SELECT user_id, username, first_name, stars_balance, is_admin, banned, registered_at FROM users ORDER BY registered_at DESC LIMIT 20')
-            users = [dict(row) for row in cursor.fetchall()]
+    users = await adb.get_recent_users(limit=20)
     
     if not users:
         await callback.message.edit_text("👥 Нет пользователей")
@@ -4762,38 +7195,13 @@ async def admin_stats(callback: CallbackQuery):
     """Детальная статистика"""
     await callback.answer()
     
-    stats = db.get_stats()
+    stats = await adb.get_stats()
     
-    completed_transactions = 0
-    today_transactions = 0
     total_stars_sold = stats['total_stars_sold']
-    avg_price = 0
-    
-    try:
-        if db.db_url:
-            with db.get_cursor() as cursor:
-                cursor.execute('SELECT COUNT(*) as count FROM transactions WHERE status = %s', ('completed',))
-                completed_transactions = cursor.fetchone()['count'] or 0
-                
-                cursor.execute('SELECT COUNT(*) as count FROM transactions WHERE status = %s AND date(created_at, "unixepoch") = date("now")', ('completed',))
-                today_transactions = cursor.fetchone()['count'] or 0
-                
-                cursor.execute('SELECT AVG(amount_stars) as avg FROM transactions WHERE status = %s', ('completed',))
-                row = cursor.fetchone()
-                avg_price = row['avg'] or 0
-        else:
-            with db.get_cursor() as cursor:
-                cursor.execute('SELECT COUNT(*) as count FROM transactions WHERE status = "completed"')
-                completed_transactions = cursor.fetchone()['count'] or 0
-                
-                cursor.execute('SELECT COUNT(*) as count FROM transactions WHERE status = "completed" AND date(created_at, "unixepoch") = date("now")')
-                today_transactions = cursor.fetchone()['count'] or 0
-                
-                cursor.execute('SELECT AVG(amount_stars) as avg FROM transactions WHERE status = "completed"')
-                row = cursor.fetchone()
-                avg_price = row['avg'] or 0
-    except Exception as e:
-        logger.error(f"Ошибка получения статистики транзакций: {e}")
+    tx_stats = await adb.get_transaction_stats()
+    completed_transactions = tx_stats['completed']
+    today_transactions = tx_stats['today']
+    avg_price = tx_stats['avg_price']
     
     text = f"""
 📊 <b>Детальная статистика</b>
@@ -4806,6 +7214,7 @@ async def admin_stats(callback: CallbackQuery):
 • В продаже: {stats['available_numbers']}
 • Продано: {stats['sold_numbers']}
 • В обработке: {stats['pending_numbers']}
+• Забронировано (ждут оплаты): {stats['held_numbers']}
 • Всего аккаунтов TG: {stats['total_accounts']}
 
 📢 <b>Каналы подписки:</b>
@@ -4855,7 +7264,7 @@ async def admin_add_stars_user(message: Message, state: FSMContext):
         await message.reply("❌ Введите числовой ID")
         return
     
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     if not user:
         await message.reply("❌ Пользователь не найден")
         await state.finish()
@@ -4889,18 +7298,20 @@ async def admin_add_stars_amount(message: Message, state: FSMContext):
     username = data.get('target_username', f"ID {user_id}")
     
     # Получаем информацию о пользователе для проверки
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     if not user:
         await message.reply("❌ Пользователь не найден")
         await state.finish()
         return
     
     # Выдаём звёзды
-    success = db.add_stars(user_id, amount, "admin", f"admin_{message.from_user.id}")
+    success = await adb.add_stars(user_id, amount, "admin", f"admin_{message.from_user.id}")
     
     if success:
+        await log_sink.system('INFO', 'admin', f"админ {message.from_user.id} выдал {amount}⭐ пользователю {user_id}")
+        
         # Получаем обновленный баланс
-        updated_user = db.get_user(user_id)
+        updated_user = await adb.get_user(user_id)
         new_balance = updated_user['stars_balance'] if updated_user else 0
         
         # Уведомляем пользователя
@@ -4945,24 +7356,7 @@ async def show_transactions(callback: CallbackQuery):
     await callback.answer()
     user_id = callback.from_user.id
     
-    if db.db_url:
-        with db.get_cursor() as cursor:
-            cursor.execute('''
-                SELECT * FROM transactions 
-                WHERE user_id = %s 
-                ORDER BY created_at DESC 
-                LIMIT 20
-            ''', (user_id,))
-            transactions = [dict(row) for row in cursor.fetchall()]
-    else:
-        with db.get_cursor() as cursor:
-            cursor.execute('''
-                SELECT * FROM transactions 
-                WHERE user_id = ? 
-                ORDER BY created_at DESC 
-                LIMIT 20
-            ''', (user_id,))
-            transactions = [dict(row) for row in cursor.fetchall()]
+    transactions = await adb.get_user_transactions(user_id, limit=20)
     
     if not transactions:
         await callback.message.edit_text(
@@ -5001,6 +7395,7 @@ async def memory_monitor():
             memory = psutil.virtual_memory()
             if memory.percent > 80:  # Если память > 80%
                 logger.warning(f"⚠️ Высокое использование памяти: {memory.percent}%")
+                await log_sink.system('WARNING', 'monitor', f"использование памяти {memory.percent}%")
                 
                 # Отправляем предупреждение админу
                 for admin_id in ADMIN_IDS:
@@ -5056,6 +7451,9 @@ async def on_startup(dp):
         return
     on_startup.called = True
     
+    # Буфер записи логов в БД нужен до загрузки сессий
+    log_sink.start()
+    
     print("🔴 1. Проверка авторизации бота...")
     sys.stdout.flush()
     
@@ -5095,8 +7493,14 @@ async def on_startup(dp):
     # Загружаем сохраненные сессии
     try:
         await session_manager.load_saved_sessions()
-        print("✅ Сессии загружены")
+        restored = await session_manager.restore_pending_logins()
+        await restore_login_states(restored)
+        print(f"✅ Сессии загружены, восстановлено ожидающих входов: {len(restored)}")
         sys.stdout.flush()
+        
+        # Прогрев пула в фоне, чтобы первая покупка после перезапуска не ждала подключения
+        asyncio.create_task(session_manager.warm_up())
+        asyncio.create_task(membership_index.refresh_channels())
     except Exception as e:
         print(f"❌ Ошибка загрузки сессий: {e}")
         sys.stdout.flush()
@@ -5106,6 +7510,12 @@ async def on_startup(dp):
     
     # Запускаем фоновые задачи
     asyncio.create_task(cleanup_task())
+    asyncio.create_task(activity_flusher())
+    asyncio.create_task(stats_reconcile_task())
+    asyncio.create_task(number_holds_sweeper())
+    asyncio.create_task(client_pool_reaper())
+    asyncio.create_task(session_supervisor())
+    asyncio.create_task(pending_logins_expirer())
     asyncio.create_task(stats_logger())
     asyncio.create_task(health_monitor())
     asyncio.create_task(memory_monitor())
@@ -5114,11 +7524,12 @@ async def on_startup(dp):
     print("✅ Фоновые задачи запущены")
     sys.stdout.flush()
     
-    stats = db.get_stats()
-    welcome_media = db.get_welcome_media()
+    stats = await adb.get_stats()
+    welcome_media = await adb.get_welcome_media()
     
     print(f"📊 Статистика: Users={stats['total_users']}, Numbers={stats['available_numbers']}")
     sys.stdout.flush()
+    await log_sink.system('INFO', 'lifecycle', f"бот запущен, pid={os.getpid()}")
     
     print("🔴 5. Отправка уведомлений админам...")
     sys.stdout.flush()
@@ -5145,13 +7556,79 @@ async def on_startup(dp):
 # Устанавливаем флаг для проверки повторного вызова
 on_startup.called = False
 
+async def restore_login_states(pending: List[Dict]):
+    """Возврат пользователей в состояние ввода кода/2FA после перезапуска"""
+    states = {
+        (None, 'code'): BuyStates.waiting_for_code,
+        (None, '2fa'): BuyStates.waiting_for_2fa,
+        ('add_account', 'code'): AddAccountStates.waiting_for_code,
+        ('add_account_2fa', '2fa'): AddAccountStates.waiting_for_2fa,
+    }
+    for row in pending:
+        state = states.get((row['action'], row['stage']))
+        user_id = row['user_id']
+        if not state or not user_id:
+            continue
+        try:
+            data = {'phone': row['phone']}
+            if row['number_id']:
+                data['number_id'] = row['number_id']
+            await dp.storage.set_state(chat=user_id, user=user_id, state=state.state)
+            await dp.storage.set_data(chat=user_id, user=user_id, data=data)
+            
+            prompt = "пароль 2FA" if row['stage'] == '2fa' else "код из Telegram"
+            await bot.send_message(
+                user_id,
+                f"🔄 Бот был перезапущен, но ваш вход для <code>{row['phone']}</code> сохранён.\n\n"
+                f"✏️ Введите {prompt}:"
+            )
+        except Exception as e:
+            logger.error(f"❌ Ошибка восстановления состояния входа для {user_id}: {e}")
+
 # ================= ИСПРАВЛЕННЫЙ ON_SHUTDOWN =================
 
+class ShutdownPhases:
+    """Фазы остановки в пределах общего дедлайна с замером длительности каждой"""
+    
+    def __init__(self, deadline: float):
+        self.deadline = time.monotonic() + deadline
+        self.timings = {}  # фаза -> сек
+        self.timed_out = []
+        self.failed = []
+    
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+    
+    async def run(self, name: str, aw, timeout: float = None):
+        """Выполнение фазы: не дольше timeout и не позже общего дедлайна. Ошибки логируются, возвращается None"""
+        limit = self.remaining() if timeout is None else max(0.0, min(timeout, self.remaining()))
+        started = time.monotonic()
+        try:
+            return await asyncio.wait_for(aw, timeout=limit)
+        except asyncio.TimeoutError:
+            self.timed_out.append(name)
+            logger.error(f"❌ Фаза остановки '{name}' не уложилась в {limit:.1f} сек")
+        except Exception as e:
+            self.failed.append(name)
+            logger.error(f"❌ Ошибка в фазе остановки '{name}': {e}")
+        finally:
+            self.timings[name] = time.monotonic() - started
+        return None
+    
+    def ok(self, name: str) -> bool:
+        return name in self.timings and name not in self.timed_out and name not in self.failed
+    
+    def summary(self) -> str:
+        parts = [f"{name}={elapsed:.2f}s" + (" (таймаут)" if name in self.timed_out else "")
+                 for name, elapsed in self.timings.items()]
+        return ", ".join(parts)
+
 async def on_shutdown(dp):
-    """Действия при остановке бота"""
+    """Действия при остановке бота: фазы параллельно и под общим дедлайном SHUTDOWN_DEADLINE"""
     global running, ping_active, web_runner, shutdown_reason
     running = False
     ping_active = False
+    phases = ShutdownPhases(SHUTDOWN_DEADLINE)
     
     print(f"\n🛑 Бот останавливается. Причина: {shutdown_reason}")
     sys.stdout.flush()
@@ -5167,38 +7644,27 @@ async def on_shutdown(dp):
     
     # Останавливаем веб-сервер
     if web_runner:
-        try:
-            await web_runner.cleanup()
+        await phases.run('web', web_runner.cleanup(), SHUTDOWN_DRAIN_TIMEOUT)
+        if phases.ok('web'):
             print("✅ Веб-сервер остановлен")
             sys.stdout.flush()
             logger.info("✅ Веб-сервер остановлен")
-        except Exception as e:
-            print(f"❌ Ошибка при остановке веб-сервера: {e}")
-            sys.stdout.flush()
-            logger.error(f"❌ Ошибка при остановке веб-сервера: {e}")
-    
-    closed_sessions = 0
-    for phone, client in session_manager.active_sessions.items():
-        try:
-            await client.disconnect()
-            closed_sessions += 1
-        except Exception as e:
-            logger.error(f"❌ Ошибка при закрытии сессии {phone}: {e}")
     
+    # Апдейты, которые уже обрабатываются, должны успеть завершиться до закрытия сессий и БД
+    await phases.run('drain', in_flight.drain(), SHUTDOWN_DRAIN_TIMEOUT)
+    if not phases.ok('drain'):
+        logger.warning(f"⚠️ Не дождались завершения {in_flight.in_flight} апдейтов")
+    
+    await phases.run('sessions', session_manager.close_all(), phases.remaining() - SHUTDOWN_FLUSH_RESERVE)
+    # При таймауте фазы считаем тех, кого успели закрыть, а не 0
+    progress = session_manager.shutdown_progress
+    closed_sessions = str(progress['closed'])
+    if not phases.ok('sessions'):
+        closed_sessions += f" из {progress['total']} (не завершено)"
     print(f"✅ Закрыто активных сессий: {closed_sessions}")
     sys.stdout.flush()
     logger.info(f"✅ Закрыто активных сессий: {closed_sessions}")
     
-    try:
-        if not db.db_url:
-            backup_file = os.path.join(DATABASE_BACKUP_DIR, f"final_backup_{int(time.time())}.db")
-            shutil.copy2(db.db_path, backup_file)
-            print(f"✅ Создан финальный бекап: {backup_file}")
-            sys.stdout.flush()
-            logger.info(f"✅ Создан финальный бекап: {backup_file}")
-    except Exception as e:
-        logger.error(f"❌ Ошибка создания финального бекапа: {e}")
-    
     # Удаляем PID файл
     try:
         if os.path.exists('bot.pid'):
@@ -5206,43 +7672,133 @@ async def on_shutdown(dp):
     except:
         pass
     
+    async def flush_buffers():
+        await log_sink.system('INFO', 'lifecycle', f"бот остановлен: {shutdown_reason}")
+        flushed = await adb.flush_user_activity()
+        if flushed:
+            logger.info(f"✅ Сохранена активность пользователей: {flushed}")
+        await log_sink.stop()
+        sink_stats = log_sink.get_stats()
+        logger.info(f"✅ Буфер логов сброшен: записано={sink_stats['written']}, ошибок={sink_stats['failed']}")
+    
+    await phases.run('flush', flush_buffers())
+    
+    if not db.db_url:
+        backup_file = os.path.join(DATABASE_BACKUP_DIR, f"final_backup_{int(time.time())}.db")
+        await phases.run('backup', adb.create_backup(backup_file))
+        if phases.ok('backup'):
+            print(f"✅ Создан финальный бекап: {backup_file}")
+            sys.stdout.flush()
+            logger.info(f"✅ Создан финальный бекап: {backup_file}")
+    
+    def close_db():
+        # Если какая-то фаза уже не уложилась, зависшие запросы не ждём
+        adb.shutdown(wait=not phases.timed_out)
+        db.close()
+    
+    # Ожидание пула потоков блокирующее - уводим его из event loop и держим в пределах дедлайна
+    await phases.run('db_close', asyncio.get_running_loop().run_in_executor(None, close_db))
+    
     uptime = time.time() - start_time
     uptime_str = str(timedelta(seconds=int(uptime)))
     
-    for admin_id in ADMIN_IDS:
+    async def notify_admin(admin_id):
         try:
             await bot.send_message(
                 admin_id,
                 f"🛑 <b>Бот остановлен</b>\n\n"
                 f"⏱ Время работы: {uptime_str}\n"
                 f"❓ Причина: {shutdown_reason}\n"
-                f"✅ Все сессии закрыты, файлы сохранены\n"
+                f"{'✅' if phases.ok('flush') else '⚠️'} Закрыто сессий: {closed_sessions}, "
+                f"буферы {'сохранены' if phases.ok('flush') else 'сохранены не полностью'}\n"
+                f"⏳ Остановка: {phases.summary()}\n"
                 f"🏓 Всего внутренних пингов: {ping_count}\n"
                 f"🌐 Внешний самопинг остановлен"
             )
         except Exception as e:
             logger.error(f"❌ Не удалось отправить уведомление: {e}")
     
+    await phases.run('notify', asyncio.gather(*(notify_admin(admin_id) for admin_id in ADMIN_IDS)))
+    
+    logger.info(f"⏳ Фазы остановки: {phases.summary()}")
     print(f"✅ Бот остановлен. Время работы: {uptime_str}, причина: {shutdown_reason}")
     sys.stdout.flush()
     logger.info(f"✅ Бот остановлен. Время работы: {uptime_str}, причина: {shutdown_reason}")
 
 # ================= ФОНОВЫЕ ЗАДАЧИ =================
 
+async def client_pool_reaper():
+    """Отключение простаивающих клиентов Pyrogram"""
+    while running:
+        await asyncio.sleep(CLIENT_REAP_INTERVAL)
+        try:
+            reaped = await session_manager.reap_idle_clients()
+            if reaped:
+                logger.info(f"🔌 Отключено простаивающих клиентов: {reaped}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка в client_pool_reaper: {e}")
+
+async def pending_logins_expirer():
+    """Снятие ожидающих кода/2FA входов точно по дедлайну"""
+    while running:
+        try:
+            await session_manager.wait_for_expiry()
+            await session_manager.expire_pending_logins()
+        except Exception as e:
+            logger.error(f"❌ Ошибка в pending_logins_expirer: {e}")
+            await asyncio.sleep(1)
+
+async def session_supervisor():
+    """Надзор за подключенными сессиями (одна задача на все аккаунты)"""
+    while running:
+        await asyncio.sleep(SESSION_SUPERVISE_INTERVAL)
+        try:
+            await session_manager.supervise_sessions()
+        except Exception as e:
+            logger.error(f"❌ Ошибка в session_supervisor: {e}")
+
+async def number_holds_sweeper():
+    """Возврат в продажу номеров с просроченной бронью"""
+    while running:
+        await asyncio.sleep(NUMBER_HOLD_SWEEP_INTERVAL)
+        try:
+            released = await adb.sweep_number_holds()
+            if released:
+                logger.info(f"🔓 Снято просроченных броней: {released}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка в number_holds_sweeper: {e}")
+
+async def stats_reconcile_task():
+    """Периодическая сверка счётчиков статистики с исходными таблицами"""
+    while running:
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL)
+        try:
+            drift = await adb.reconcile_stats()
+            if drift:
+                await log_sink.system('WARNING', 'stats', f"счётчики статистики расходились: {drift}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка в stats_reconcile_task: {e}")
+
+async def activity_flusher():
+    """Периодический пакетный сброс last_activity в БД"""
+    while running:
+        await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        try:
+            await adb.flush_user_activity()
+        except Exception as e:
+            logger.error(f"❌ Ошибка в activity_flusher: {e}")
+
 async def cleanup_task():
     """Периодическая очистка сессий"""
     while running:
         try:
             await session_manager.cleanup()
             
-            if db.db_url:
-                with db.get_cursor() as cursor:
-                    week_ago = time.time() - 7 * 24 * 3600
-                    cursor.execute('DELETE FROM session_logs WHERE created_at < %s', (week_ago,))
-            else:
-                with db.get_cursor() as cursor:
-                    week_ago = time.time() - 7 * 24 * 3600
-                    cursor.execute('DELETE FROM session_logs WHERE created_at < ?', (week_ago,))
+            await adb.cleanup_session_logs(7 * 24 * 3600)
+            
+            purged = db.cache.purge_expired()
+            if purged:
+                logger.info(f"🧹 Удалено устаревших записей кэша: {purged}")
         except Exception as e:
             logger.error(f"❌ Ошибка в cleanup_task: {e}")
         
@@ -5252,7 +7808,7 @@ async def stats_logger():
     """Периодическое логирование статистики"""
     while running:
         try:
-            stats = db.get_stats()
+            stats = await adb.get_stats()
             
             cpu_percent = psutil.cpu_percent(interval=1)
             memory = psutil.virtual_memory()
@@ -5263,6 +7819,29 @@ async def stats_logger():
                        f"Accounts={stats['active_accounts']}, "
                        f"Channels={stats['total_channels']}, "
                        f"CPU={cpu_percent}%, RAM={memory.percent}%")
+            
+            pool_stats = db.get_pool_stats()
+            logger.info(f"🗄 Пул БД: {pool_stats['in_use']}/{pool_stats['max_size']} занято, "
+                       f"пик={pool_stats['max_in_use']}, ожиданий={pool_stats['waits']}, "
+                       f"таймаутов={pool_stats['timeouts']}, создано={pool_stats['created']}")
+            
+            cache_stats = db.get_cache_stats()
+            cache_parts = ", ".join(
+                f"{ns}: {s['hits']}/{s['hits'] + s['misses']} попаданий, вытеснено={s['evictions']}"
+                for ns, s in cache_stats['namespaces'].items()
+            )
+            logger.info(f"🧠 Кэш: {cache_stats['size']}/{cache_stats['max_size']} записей ({cache_parts})")
+            
+            client_stats = session_manager.get_pool_stats()
+            logger.info(f"🔌 Клиенты: {client_stats['live']}/{client_stats['max']} подключено, "
+                       f"подключается={client_stats['connecting']}, вытеснено={client_stats['evicted_lru']}+{client_stats['evicted_idle']}, "
+                       f"переподключений={client_stats['reconnects']} (ср. {client_stats['reconnect_avg_ms']} мс)")
+            
+            trace_stats = tracing.get_stats()
+            slowest = sorted(trace_stats['handlers'].items(), key=lambda item: item[1]['p95_ms'], reverse=True)[:3]
+            slowest_parts = ", ".join(f"{name} {s['p95_ms']} мс" for name, s in slowest) or "-"
+            logger.info(f"⏱ Апдейты: {trace_stats['updates']}, медленных={trace_stats['slow']}, ошибок={trace_stats['errors']}, "
+                       f"очередь p95={trace_stats['queue_delay']['p95_ms']} мс, медленнее всех (p95): {slowest_parts}")
         except Exception as e:
             logger.error(f"❌ Ошибка в stats_logger: {e}")
         
@@ -5303,7 +7882,7 @@ async def health_monitor():
             
             # Проверяем базу данных
             try:
-                db.get_stats()
+                await adb.get_stats()
                 error_count = max(0, error_count - 1)
             except Exception as e:
                 error_count += 1
@@ -5364,6 +7943,7 @@ def start_bot():
             executor.start_polling(
                 dp,
                 skip_updates=True,
+                allowed_updates=types.AllowedUpdates.all(),  # chat_member по умолчанию не приходит
                 on_startup=on_startup,
                 on_shutdown=on_shutdown,
                 timeout=30,  # Добавляем таймаут
@@ -5421,7 +8001,7 @@ if __name__ == "__main__":
     print("✅ Редактирование текста приветствия и профиля")
     print("✅ Загрузка фото и GIF в главное меню (ЧЕРЕЗ АДМИНКУ)")
     print("✅ Удаление сессий и номеров")
-    print("✅ Сессии СОХРАНЯЮТСЯ в файлы")
+    print("✅ Сессии СОХРАНЯЮТСЯ в БД (зашифрованы)")
     print("✅ Параллельная работа веб-сервера (НЕ БЛОКИРУЕТ БОТА)")
     print("✅ УСИЛЕННАЯ ЗАЩИТА ОТ ДВОЙНОГО ЗАПУСКА (3 уровня)")
     print("✅ ПЛАНОВЫЙ ПЕРЕЗАПУСК ОТКЛЮЧЕН")
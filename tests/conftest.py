@@ -0,0 +1,33 @@
+"""Общие настройки тестов.
+
+bot.py при импорте читает переменные окружения и создаёт файлы (shop.db, bot.pid, логи)
+в текущей папке, поэтому импортируем его из временной папки с тестовым окружением.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix='bot-tests-')
+
+os.environ.setdefault('BOT_TOKEN', '123456:TEST-TOKEN')
+os.environ.setdefault('ADMIN_IDS', '1')
+os.environ.setdefault('PORT', '18080')
+os.environ.pop('DATABASE_URL', None)
+os.environ.pop('RENDER', None)
+
+sys.path.insert(0, ROOT)
+os.chdir(WORKDIR)
+
+import bot  # noqa: E402
+
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    """Отдельная SQLite база во временной папке"""
+    monkeypatch.chdir(tmp_path)
+    database = bot.Database()
+    yield database
+    database.close()
@@ -0,0 +1,126 @@
+"""Гонки покупателей: сотни параллельных покупок и завершений платежей через AsyncDatabase.
+Номер продаётся ровно одному покупателю, звёзды списываются ровно один раз и не уходят в минус."""
+import asyncio
+from collections import Counter
+
+import bot
+
+BUYERS = 300
+NUMBERS = 5
+PRICE = 10
+START_BALANCE = 25  # Хватает ровно на две покупки
+
+
+def seed(database, first_user_id):
+    user_ids = list(range(first_user_id, first_user_id + BUYERS))
+    for user_id in user_ids:
+        database.create_user(user_id, f'user_{user_id}', 'Buyer')
+        database.add_stars(user_id, START_BALANCE, 'test')
+    for i in range(NUMBERS):
+        database.add_number(f'+7000000{first_user_id}{i}', 'RU', 'test', PRICE)
+    with database.get_read_cursor() as cursor:
+        cursor.execute("SELECT id FROM numbers WHERE status = 'available' ORDER BY id")
+        number_ids = [row['id'] for row in cursor.fetchall()]
+    return user_ids, number_ids
+
+
+def balances(database, user_ids):
+    with database.get_read_cursor() as cursor:
+        cursor.execute(f"SELECT user_id, stars_balance FROM users WHERE user_id IN ({','.join('?' * len(user_ids))})",
+                       user_ids)
+        return {row['user_id']: row['stars_balance'] for row in cursor.fetchall()}
+
+
+def sold_to(database, number_ids):
+    with database.get_read_cursor() as cursor:
+        cursor.execute(f"SELECT id, status, sold_to FROM numbers WHERE id IN ({','.join('?' * len(number_ids))})",
+                       number_ids)
+        return {row['id']: (row['status'], row['sold_to']) for row in cursor.fetchall()}
+
+
+def test_parallel_purchases_sell_each_number_once(fresh_db):
+    adb = bot.AsyncDatabase(fresh_db, 32)
+    user_ids, number_ids = seed(fresh_db, 10000)
+
+    async def race():
+        attempts = [(number_id, user_id) for user_id in user_ids for number_id in number_ids]
+        results = await asyncio.gather(*(adb.purchase_number(number_id, user_id)
+                                         for number_id, user_id in attempts))
+        return [(number_id, user_id) for (number_id, user_id), number in zip(attempts, results) if number]
+
+    try:
+        winners = asyncio.run(race())
+    finally:
+        adb.shutdown()
+
+    # Ровно один победитель на номер
+    assert sorted(number_id for number_id, _ in winners) == sorted(number_ids)
+    owners = sold_to(fresh_db, number_ids)
+    for number_id, user_id in winners:
+        assert owners[number_id] == ('pending', user_id)
+
+    # Списано ровно за выигранные номера, баланс не отрицательный
+    wins = Counter(user_id for _, user_id in winners)
+    for user_id, balance in balances(fresh_db, user_ids).items():
+        assert balance == START_BALANCE - PRICE * wins[user_id]
+        assert balance >= 0
+
+    with fresh_db.get_read_cursor() as cursor:
+        cursor.execute('SELECT COUNT(*) AS n FROM transactions WHERE number_id IS NOT NULL')
+        assert cursor.fetchone()['n'] == NUMBERS
+
+
+def test_parallel_payment_completion_charges_once(fresh_db):
+    adb = bot.AsyncDatabase(fresh_db, 32)
+    user_ids, number_ids = seed(fresh_db, 20000)
+
+    # Каждый покупатель оплачивает каждый номер; каждый платёж ещё и "нажимают" дважды
+    payments = []
+    for user_id in user_ids:
+        for number_id in number_ids:
+            payment_id = f'pay-{user_id}-{number_id}'
+            fresh_db.create_payment(payment_id, user_id, number_id, PRICE * bot.STAR_TO_RUB, PRICE, 'test', '')
+            payments.append(fresh_db.get_payment(payment_id))
+
+    clicks = [payment for payment in payments for _ in range(2)]
+
+    async def race():
+        return await asyncio.gather(*(adb.complete_payment(payment) for payment in clicks))
+
+    try:
+        results = asyncio.run(race())
+    finally:
+        adb.shutdown()
+
+    completed = [payment for payment, (result, _) in zip(clicks, results) if result == 'ok']
+    assert len(completed) == NUMBERS
+    assert sorted(payment['number_id'] for payment in completed) == sorted(number_ids)
+
+    owners = sold_to(fresh_db, number_ids)
+    for payment in completed:
+        assert owners[payment['number_id']] == ('pending', payment['user_id'])
+
+    wins = Counter(payment['user_id'] for payment in completed)
+    for user_id, balance in balances(fresh_db, user_ids).items():
+        assert balance == START_BALANCE - PRICE * wins[user_id]
+        assert balance >= 0
+
+    with fresh_db.get_read_cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) AS n FROM payments WHERE status = 'completed'")
+        assert cursor.fetchone()['n'] == NUMBERS
+
+
+def test_failed_nested_purchase_keeps_outer_transaction(fresh_db):
+    user_ids, number_ids = seed(fresh_db, 30000)
+    poor, rich = user_ids[0], user_ids[1]
+    fresh_db.add_stars(poor, -START_BALANCE, 'test')
+
+    with fresh_db.get_cursor() as cursor:
+        cursor.execute('UPDATE users SET stars_balance = stars_balance + 1 WHERE user_id = ?', (rich,))
+        # Отказ во вложенной покупке откатывает только её, а не запись внешней транзакции
+        assert fresh_db.purchase_number(number_ids[0], poor) is None
+        assert fresh_db.complete_payment({'id': 'missing', 'number_id': number_ids[0], 'user_id': poor,
+                                          'stars_amount': PRICE})[0] == 'already_completed'
+
+    assert balances(fresh_db, [poor, rich]) == {poor: 0, rich: START_BALANCE + 1}
+    assert sold_to(fresh_db, [number_ids[0]])[number_ids[0]] == ('available', None)
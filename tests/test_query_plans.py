@@ -0,0 +1,113 @@
+"""Планы горячих запросов на синтетических данных: запросы, которые действительно выполняют
+методы Database, должны идти по своему индексу из Database.INDEXES, а не полным перебором
+таблицы (SCAN <таблица>). Тексты запросов записываются трассировкой соединений SQLite."""
+import random
+import re
+import sqlite3
+import time
+
+import pytest
+
+import bot
+
+NOW = time.time()
+
+# Индекс -> вызовы методов Database, чьи запросы он обслуживает
+HOT_PATHS = {
+    'idx_numbers_status_price': [
+        lambda database: database.get_available_numbers(5),
+        lambda database: database.get_available_numbers(5, after=(50, 100)),
+        lambda database: database.get_available_numbers(5, before=(50, 100)),
+        lambda database: database.get_available_numbers(5, start=(50, 100)),
+    ],
+    'idx_transactions_user_created': [
+        lambda database: database.get_user_transactions(7),
+    ],
+    'idx_topups_payment_id': [
+        lambda database: database.get_topup('topup-42'),
+    ],
+    'idx_tg_accounts_available': [
+        lambda database: database.get_available_tg_accounts(),
+    ],
+    'idx_session_logs_created': [
+        lambda database: database.cleanup_session_logs(86400),
+    ],
+    'idx_number_holds_expires': [
+        lambda database: database.sweep_number_holds(),
+    ],
+}
+
+
+def seed(database):
+    rnd = random.Random(1)
+    with database.get_cursor() as cursor:
+        cursor.executemany(
+            'INSERT INTO numbers (phone_number, country, price_stars, price_rub, status) VALUES (?, ?, ?, ?, ?)',
+            [(f'+7900{i:07d}', 'RU', rnd.randint(10, 500), 0, rnd.choice(['available', 'sold', 'sold', 'held']))
+             for i in range(5000)])
+        cursor.executemany(
+            'INSERT INTO transactions (user_id, number_id, amount_stars, status, created_at) VALUES (?, ?, ?, ?, ?)',
+            [(rnd.randint(1, 1000), rnd.randint(1, 5000), 10, 'completed', NOW - rnd.randint(0, 10 ** 6))
+             for _ in range(20000)])
+        cursor.executemany(
+            'INSERT INTO topups (user_id, stars_amount, payment_id, created_at) VALUES (?, ?, ?, ?)',
+            [(rnd.randint(1, 1000), 100, f'topup-{i}', NOW) for i in range(5000)])
+        cursor.executemany(
+            'INSERT INTO tg_accounts (phone, status, banned, spam_block, last_used) VALUES (?, ?, ?, ?, ?)',
+            [(f'+7800{i:07d}', rnd.choice(['active', 'active', 'inactive']), rnd.randint(0, 1), 0, NOW - i)
+             for i in range(2000)])
+        cursor.executemany(
+            'INSERT INTO session_logs (phone, action, result, created_at) VALUES (?, ?, ?, ?)',
+            [('+7800', 'check', 'ok', NOW - rnd.randint(0, 30 * 86400)) for _ in range(20000)])
+        cursor.executemany(
+            'INSERT INTO number_holds (number_id, user_id, created_at, expires_at) VALUES (?, ?, ?, ?)',
+            [(i, rnd.randint(1, 1000), NOW, NOW + rnd.randint(-600, 600)) for i in range(1, 2001)])
+        cursor.execute('ANALYZE')
+
+
+@pytest.fixture
+def traced_db(request, monkeypatch):
+    """База на синтетических данных; каждое её соединение (писатель и читатели) записывает
+    выполненные запросы с подставленными параметрами"""
+    statements = []
+    configure = bot.Database._configure_sqlite
+
+    def configure_traced(conn):
+        configure(conn)
+        conn.set_trace_callback(statements.append)
+
+    monkeypatch.setattr(bot.Database, '_configure_sqlite', staticmethod(configure_traced))
+    database = request.getfixturevalue('fresh_db')
+    seed(database)
+    statements.clear()
+    return database, statements
+
+
+@pytest.fixture
+def plan_conn(traced_db):
+    database, _ = traced_db
+    conn = sqlite3.connect(database.db_path)
+    yield conn
+    conn.close()
+
+
+def test_every_index_has_hot_paths():
+    assert {name for name, _, _ in bot.Database.INDEXES} == set(HOT_PATHS)
+
+
+@pytest.mark.parametrize('index, call', [
+    pytest.param(index, call, id=f'{index}-{i}')
+    for index, calls in HOT_PATHS.items() for i, call in enumerate(calls)
+])
+def test_hot_path_uses_index(traced_db, plan_conn, index, call):
+    database, statements = traced_db
+    table = next(table for name, table, _ in bot.Database.INDEXES if name == index)
+
+    call(database)
+    queries = [sql for sql in statements if re.search(rf'\b{table}\b', sql)]
+    assert queries, statements
+
+    for sql in queries:
+        plan = [row[3] for row in plan_conn.execute(f'EXPLAIN QUERY PLAN {sql}')]
+        assert f'SCAN {table}' not in plan, (sql, plan)
+        assert any(index in detail for detail in plan), (sql, plan)
@@ -0,0 +1,41 @@
+def counters(database):
+    with database.get_read_cursor() as cursor:
+        cursor.execute('SELECT name, value FROM shop_counters')
+        return {row['name']: row['value'] for row in cursor.fetchall()}
+
+
+def test_reconcile_stats_repairs_drift(fresh_db):
+    for user_id in range(1, 11):
+        fresh_db.create_user(user_id, f'user_{user_id}', 'User')
+    fresh_db.add_number('+79000000001', 'RU', 'test', 10)
+    assert counters(fresh_db)['users_total'] == 10
+
+    with fresh_db.get_cursor() as cursor:
+        cursor.execute("UPDATE shop_counters SET value = 3 WHERE name = 'users_total'")
+        cursor.execute("DELETE FROM shop_counters WHERE name = 'numbers_available'")
+
+    assert fresh_db.reconcile_stats() == {'users_total': 7, 'numbers_available': 1}
+    repaired = counters(fresh_db)
+    assert repaired['users_total'] == 10
+    assert repaired['numbers_available'] == 1
+    assert fresh_db.reconcile_stats() == {}
+
+
+def test_reconcile_stats_keeps_writes_made_after_the_snapshot(fresh_db, monkeypatch):
+    fresh_db.create_user(1, 'user_1', 'User')
+    with fresh_db.get_cursor() as cursor:
+        cursor.execute("UPDATE shop_counters SET value = 0 WHERE name = 'users_total'")
+
+    # Пользователь регистрируется между чтением снимка и применением разницы
+    get_cursor = fresh_db.get_cursor
+
+    def get_cursor_after_write():
+        monkeypatch.undo()
+        fresh_db.create_user(2, 'user_2', 'User')
+        return get_cursor()
+
+    monkeypatch.setattr(fresh_db, 'get_cursor', get_cursor_after_write)
+    assert fresh_db.reconcile_stats() == {'users_total': 1}
+
+    assert counters(fresh_db)['users_total'] == 2
+    assert fresh_db.reconcile_stats() == {}
@@ -0,0 +1,23 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import bot
+
+
+def test_process_stars_amount_reports_new_balance():
+    user_id = 900001
+    bot.db.create_user(user_id, 'buyer', 'Buyer')
+
+    message = MagicMock()
+    message.text = '50'
+    message.from_user.id = user_id
+    message.reply = AsyncMock()
+    state = MagicMock()
+    state.finish = AsyncMock()
+
+    asyncio.run(bot.process_stars_amount(message, state))
+
+    text = message.reply.await_args.args[0]
+    assert 'Пополнение успешно' in text
+    assert 'Новый баланс: 50 ⭐️' in text
+    state.finish.assert_awaited_once()
@@ -0,0 +1,44 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock
+
+import bot
+
+
+def test_received_at_forgets_updates_that_never_reached_the_middleware(monkeypatch):
+    monkeypatch.setattr(bot.Bot, 'request', AsyncMock(return_value=[{'update_id': 3}, {'update_id': 4}]))
+    traced = bot.TracedBot(token='123456:TEST-TOKEN')
+    stale = time.monotonic() - traced.RECEIVED_TTL - 1
+    traced.received_at[1] = stale
+    traced.received_at[2] = stale
+
+    asyncio.run(traced.request('getUpdates'))
+
+    assert list(traced.received_at) == [3, 4]
+
+
+def test_tracing_middleware_records_handler_and_calls():
+    traced = bot.TracedBot(token='123456:TEST-TOKEN')
+    tracing = bot.TracingMiddleware(traced, slow_threshold=60, sample_rate=0)
+    update = bot.types.Update(update_id=7)
+    traced.received_at[7] = time.monotonic()
+
+    async def handle():
+        data = {}
+        await tracing.on_pre_process_update(update, data)
+        bot.count_trace('db')
+        bot.count_trace('api')
+        bot.count_trace('api')
+        bot.current_trace.get()['handler'] = 'show_profile'
+        await tracing.on_post_process_update(update, [], data)
+
+    asyncio.run(handle())
+
+    assert traced.received_at == {}
+    assert bot.current_trace.get() is None
+    stats = tracing.get_stats()
+    assert stats['updates'] == 1
+    assert stats['handlers']['show_profile']['count'] == 1
+    assert stats['handlers']['show_profile']['db_per_update'] == 1
+    assert stats['handlers']['show_profile']['api_per_update'] == 2
+    assert stats['queue_delay']['count'] == 1